@@ -32,12 +32,10 @@ Prins, N. (2013). The psi-marginal adaptive method: How to give nuisance paramet
 """
 
 import numpy as np
-from sklearn.utils.extmath import cartesian
-import scipy
-from scipy.stats import norm, beta, gamma
-from scipy.special import erfc
 import threading
-import matplotlib.pyplot as plt
+
+# sklearn, scipy and matplotlib are imported where they are used (the grid, the priors and plot),
+# so that importing this module only costs numpy
 
 
 def pf(parameters, psyfun='cGauss'):
@@ -84,6 +82,7 @@ def pf(parameters, psyfun='cGauss'):
     ones = np.ones(np.shape(mu))
     if psyfun == 'cGauss':
         # F(x; mu, sigma) = Normcdf(mu, sigma) = 1/2 * erfc(-sigma * (x-mu) /sqrt(2))
+        from scipy.special import erfc
         z = np.divide(np.subtract(x, mu), sigma)
         p = 0.5 * erfc(-z / np.sqrt(2))
     elif psyfun == 'Gumbel':
@@ -261,6 +260,7 @@ class Psi:
         self.gammaEQlambda = all((all(self.guessRate == self.lapseRate), all(self.priorGamma == self.priorLambda)))
         # likelihood: table of conditional probabilities p(response | alpha,sigma,gamma,lambda,x)
         # prior: prior probability over all parameters p_0(alpha,sigma,gamma,lambda)
+        from sklearn.utils.extmath import cartesian
         if self.gammaEQlambda:
             self.dimensions = (len(self.threshold), len(self.slope), len(self.lapseRate), len(self.stimRange))
             self.likelihood = np.reshape(
@@ -324,10 +324,13 @@ class Psi:
             nx = len(x)
             p = np.ones(nx) / nx
         elif distr == 'normal':
+            from scipy.stats import norm
             p = norm.pdf(x, mu, sig)
         elif distr == 'beta':
+            from scipy.stats import beta
             p = beta.pdf(x, mu, sig)
         elif distr == 'gamma':
+            from scipy.stats import gamma
             p = gamma.pdf(x, mu, scale=sig)
         else:
             nx = len(x)
@@ -337,6 +340,7 @@ class Psi:
     def meta_data(self):
         import time
         import sys
+        import scipy
         metadata = {}
         date = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()))
         metadata['date'] = date
@@ -506,6 +510,8 @@ class Psi:
                     False: don't save figure
         """
 
+        import matplotlib.pyplot as plt
+
         if all((muRef, sigmaRef, lapseRef)):
             ref = True  # reference values exist
             if guessRef:
@@ -1,7 +1,4 @@
 #!/bin/zsh
 
-for f in *.json
-do
-	python3 -mjson.tool $f >> "${f%%.*}"_tidy.json
-    rm $f
-done
+# Kept for habit; the work is done by tidy_sessions.py (see its docstring)
+exec python3 "$(dirname "$0")/../tidy_sessions.py" "$@"
@@ -0,0 +1,513 @@
+'''
+benchmark.py
+
+[Objective]
+Timing of the analysis pipeline on a synthetic cohort,
+so that a change in speed can be measured instead of guessed
+
+The synthetic session files have the same layout as the ones saved by the app
+(53 trials, catch trials at 12, 28 and 44, see json_processing.py)
+With --data FOLDER, a copy of the real session files in FOLDER is used instead
+
+[Usage]
+python3 benchmark.py parse [--files 200] [--subjects 5] [--jobs 1 2 4 8]
+    Throughput of parsing the session files with 1, 2, 4, ... processes
+
+python3 benchmark.py dataset [--files 200] [--subjects 5] [--jobs 1]
+    Consolidated dataset built from scratch, from the cache, and after one new file arrived
+
+python3 benchmark.py figures [--files 20] [--subjects 5] [--jobs 1 2 4 8]
+    Subject figures drawn with 1, 2, 4, ... processes, then again with all of them up to date
+
+python3 benchmark.py refit [--files 200] [--subjects 5] [--jobs 1 2 4 8]
+    Posteriors of every staircase refitted in batches, checked against trial-by-trial updates
+
+python3 benchmark.py bootstrap [--files 2] [--subjects 5] [--jobs 1 2 4 8]
+    Bootstrap intervals of the thresholds (200 replicates), checked to be the same for every number of jobs
+
+python3 benchmark.py imports [--repeat 5]
+    Import time (python -X importtime, in a fresh interpreter) of the modules loaded at the start of the apps
+    and of the engine modules the compute worker loads for the first staircases;
+    exits with status 1 if one of them costs more than its budget (STARTUP_IMPORTS, ENGINE_IMPORTS)
+    or loads a module that should only be imported on first use (DEFERRED_IMPORTS, and numpy at the start)
+
+python3 benchmark.py engine [--repeat 5]
+    The NumPy erfc of psi_engine checked against math.erfc, the priors against the formulas of the original app,
+    and against SciPy (erfc and whole staircases) when it is installed; then the import time of psi_engine
+    and the size of the packages it loads, with the NumPy functions and with SciPy (PSI_ENGINE_SCIPY=1);
+    exits with status 1 if a check fails
+
+python3 benchmark.py sessions [--sessions 40] [--jobs 1 2 4 8]
+    Psi-Marginal tests of simulated subjects (coarse grid, see pm_protocol.py) run by 1, 2, 4, ... threads,
+    one ExperimentSession per test, all saving to one SafeJsonStore; every subject is checked in the
+    session file and the archive afterwards; then every restart scenario in a session using the compute worker,
+    checked to leave nothing alive once its session is closed (staircases, protocol, tags in the worker);
+    exits with status 1 if a subject is missing or not as tested, or if a closed session is kept alive
+'''
+
+import gc
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import weakref
+import subprocess
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import psi_engine
+import json_processing as jp
+
+# Modules without kivy imported at the start of the apps, and the most their import may cost (ms);
+# they must not load numpy, which the window would wait for
+STARTUP_IMPORTS = [('session_store', 100), ('experiment_session', 100), ('psi_worker', 100)]
+# Imported in the compute worker, by the first staircases of psi_warmup (ms, numpy included)
+ENGINE_IMPORTS = [('psi_engine', 300), ('pm_protocol', 300), ('PsiMarginal', 300)]
+# Only imported on first use (Psi.plot, SciPy when asked for, the sklearn grid of PsiMarginal)
+DEFERRED_IMPORTS = ['scipy', 'sklearn', 'matplotlib']
+
+
+def make_sessions(folder, n_files, subj_per_file, seed = 0):
+    '''
+    Write 'n_files' pretty-printed session files of 'subj_per_file' random subjects each
+    '''
+    rng = random.Random(seed)
+    stim_levels = list(psi_engine.stimLevels)
+    subj_num = 0
+    for i in range(n_files):
+        session = dict()
+        for j in range(subj_per_file):
+            trials = dict()
+            for k in range(53):
+                if k in jp.catch_trials:
+                    trials['_'.join(['TRIAL', str(k)])] = {'trial_num': k, 'Visual_stimulus(deg)': 20.0, 'correct_ans': 'left', 'response': 'left', 'response_correct': int(rng.random() < 0.9)}
+                else:
+                    stim = rng.choice(stim_levels)
+                    psi = rng.choice(['A', 'B'])
+                    trials['_'.join(['TRIAL', str(k)])] = {'trial_num': k, 'Psi_obj': psi, 'Psi_stimulus(deg)': stim, 'Visual_stimulus(deg)': 55 - stim if psi == 'A' else 45 + stim, 'correct_ans': 'left', 'response': 'left', 'response_correct': int(rng.random() < min(0.98, 0.5 + stim / 20.0))}
+            session['_'.join(['SUBJ', str(subj_num)])] = {'subj_info': {'age': str(rng.randint(6, 80)), 'gender': rng.choice(['M', 'F']), 'right_used': rng.random() < 0.9, 'Staircase used': 'Psi-Marginal'}, 'subj_anth': {'flen': '70', 'fwid': '15', 'init_step': 'N/A', 'MPJR': '10'}, 'subj_trial_info': trials}
+            subj_num += 1
+        with open(os.path.join(folder, '.'.join(['session_%04d' % i, 'json'])), 'w') as f:
+            json.dump(session, f, indent = 4)
+
+
+def bench_parse(folder, jobs_list):
+    '''
+    Parse every session file in 'folder' once per number of jobs and print the throughput
+    '''
+    n_files = len([x for x in os.listdir(folder) if x[-5:] == '.json'])
+    base = None
+    print('parser: ' + jp.loads.__module__)
+    for jobs in jobs_list:
+        t0 = time.perf_counter()
+        n_subj = sum(1 for _ in jp.iter_subjects(folder, jobs = jobs))
+        elapsed = time.perf_counter() - t0
+        if base is None:
+            base = elapsed
+        print('jobs = %2d: %7.3f s, %8.1f files/s, %8.1f subjects/s, speed-up x%.2f' % (jobs, elapsed, n_files / elapsed, n_subj / elapsed, base / elapsed))
+
+
+def bench_dataset(folder, jobs):
+    '''
+    Time load_dataset without a cache, with an up-to-date cache and with one new file
+    '''
+    shutil.rmtree(os.path.join(folder, jp.CACHE_DIR), ignore_errors = True)
+    for label in ['no cache', 'cache up to date', 'one new file']:
+        if label == 'one new file':
+            new_folder = tempfile.mkdtemp()
+            make_sessions(new_folder, 1, 5, seed = 1)
+            shutil.move(os.path.join(new_folder, 'session_0000.json'), os.path.join(folder, 'zz_new_session.json'))
+            shutil.rmtree(new_folder)
+        t0 = time.perf_counter()
+        data = jp.load_dataset(folder, jobs = jobs, duplicates = None)
+        elapsed = time.perf_counter() - t0
+        print('%-16s: %7.3f s, %d subjects' % (label, elapsed, len(data['subj_ids'])))
+
+
+def bench_figures(folder, jobs_list):
+    '''
+    Draw the figures of every subject once per number of jobs, then once more with nothing to do
+    '''
+    dataset = jp.load_dataset(folder, jobs = 1, duplicates = None, use_cache = False)
+    out = os.path.join(folder, 'figures')
+    base = None
+    for jobs in jobs_list:
+        shutil.rmtree(out, ignore_errors = True)
+        os.makedirs(out)
+        t0 = time.perf_counter()
+        n_drawn = len(jp.plot_sub_performance(dataset, folder = out, jobs = jobs))
+        elapsed = time.perf_counter() - t0
+        if base is None:
+            base = elapsed
+        print('jobs = %2d: %7.3f s, %6.2f figures/s, speed-up x%.2f' % (jobs, elapsed, n_drawn / elapsed, base / elapsed))
+    t0 = time.perf_counter()
+    n_drawn = len(jp.plot_sub_performance(dataset, folder = out, jobs = jobs_list[-1]))
+    print('up to date: %7.3f s, %d figures drawn' % (time.perf_counter() - t0, n_drawn))
+
+
+def bench_refit(folder, jobs_list, n_check = 5):
+    '''
+    Refit the staircases of every subject once per number of jobs,
+    and check the first 'n_check' of them against a trial-by-trial update of the posterior
+    '''
+    dataset = jp.load_dataset(folder, jobs = 1, duplicates = None, use_cache = False)
+    t0 = time.perf_counter()
+    grid = psi_engine.PsiGrid()
+    print('grid: %7.3f s' % (time.perf_counter() - t0))
+    base = None
+    for jobs in jobs_list:
+        t0 = time.perf_counter()
+        fits = jp.refit_dataset(dataset, grid, jobs = jobs)
+        elapsed = time.perf_counter() - t0
+        if base is None:
+            base = elapsed
+        print('jobs = %2d: %7.3f s, %8.1f staircases/s, speed-up x%.2f' % (jobs, elapsed, 2 * len(dataset['subj_ids']) / elapsed, base / elapsed))
+
+    # The update of Psi.addData, one trial at a time
+    likelihood = np.exp(grid.logSuccess).T.reshape(grid.dimensions + (len(grid.stimRange),))
+    worst = 0.0
+    t0 = time.perf_counter()
+    n_checked = 0
+    for row in range(min(n_check, len(dataset['subj_ids']))):
+        for name, mask in [('A', dataset['is_a']), ('B', dataset['is_b'])]:
+            pdf = np.ones(grid.dimensions) / np.prod(grid.dimensions)
+            for i in np.flatnonzero(mask[row]):
+                x = grid.stim_index(dataset['psi_stim'][row, i])
+                like = likelihood[..., x]
+                pdf = pdf * (like if dataset['if_corr'][row, i] == 1 else 1 - like)
+                pdf = pdf / np.sum(pdf)
+            p_threshold = np.sum(pdf, axis = tuple(range(1, pdf.ndim)))
+            worst = max(worst, abs(np.dot(p_threshold, grid.threshold) - fits[name]['eThreshold'][row]))
+            n_checked += 1
+    elapsed = time.perf_counter() - t0
+    print('trial by trial: %7.3f s per staircase, largest difference of eThreshold %.3g' % (elapsed / max(1, n_checked), worst))
+
+
+def bench_bootstrap(folder, jobs_list, n_boot = 200):
+    '''
+    Bootstrap the thresholds of every subject once per number of jobs
+    '''
+    dataset = jp.load_dataset(folder, jobs = 1, duplicates = None, use_cache = False)
+    grid = psi_engine.PsiGrid()
+    base, first = None, None
+    for jobs in jobs_list:
+        t0 = time.perf_counter()
+        intervals = jp.bootstrap_dataset(dataset, grid, n_boot = n_boot, jobs = jobs)
+        elapsed = time.perf_counter() - t0
+        if base is None:
+            base, first = elapsed, intervals
+        same = all(np.array_equal(first[x]['ciLow'], intervals[x]['ciLow'], equal_nan = True) for x in ['A', 'B'])
+        print('jobs = %2d: %7.3f s, %6.2f staircases/s, speed-up x%.2f, same intervals: %s' % (jobs, elapsed, 2 * len(dataset['subj_ids']) / elapsed, base / elapsed, same))
+
+
+def import_profile(statement, environ = None):
+    '''
+    Modules imported by 'statement' in a fresh interpreter, {name: cumulative time (ms)}
+    (python -X importtime; the modules of the interpreter's own start are left out),
+    None if the statement failed
+
+    environ: extra environment variables of the interpreter
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([here, os.path.join(here, 'Psi-marginal')] + [x for x in os.environ.get('PYTHONPATH', '').split(os.pathsep) if x]), **(environ or {}))
+    profile = dict()
+    for code in ['pass', statement]:
+        run = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env = env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+        if run.returncode != 0:
+            return None
+        modules = dict()
+        for line in run.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_us, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    # nested imports are indented by two spaces per level
+                    modules[name[1:].rstrip()] = int(cumulative) / 1000.0
+        if code == 'pass':
+            startup = set(x.strip() for x in modules)
+        else:
+            profile = dict((x, t) for x, t in modules.items() if x.strip() not in startup)
+    return profile
+
+
+def bench_imports(repeat):
+    '''
+    Import each module of STARTUP_IMPORTS and ENGINE_IMPORTS 'repeat' times, keep the fastest;
+    False if one is over its budget or loads one of DEFERRED_IMPORTS (or numpy, for STARTUP_IMPORTS)
+    '''
+    passed = True
+    for module, budget in STARTUP_IMPORTS + ENGINE_IMPORTS:
+        not_yet = DEFERRED_IMPORTS + (['numpy'] if (module, budget) in STARTUP_IMPORTS else [])
+        best, deferred = None, set()
+        for i in range(repeat):
+            profile = import_profile('import ' + module)
+            if profile is None:
+                break
+            # Only the modules imported by the statement itself, not by one of them
+            total = sum(t for x, t in profile.items() if not x.startswith(' '))
+            best = total if best is None else min(best, total)
+            deferred.update(x.strip().split('.')[0] for x in profile if x.strip().split('.')[0] in not_yet)
+        if profile is None:
+            print('%-14s import failed  FAILED' % module)
+            passed = False
+            continue
+        ok = best <= budget and not deferred
+        passed = passed and ok
+        print('%-18s %8.1f ms (budget %4d ms)%s  %s' % (module, best, budget, ', imports ' + ' '.join(sorted(deferred)) if deferred else '', 'ok' if ok else 'FAILED'))
+    return passed
+
+
+def package_size(name):
+    '''
+    Size on disk (bytes) of the installed package 'name', with the libraries its wheel ships
+    next to it (name.libs); None if it is not installed
+    '''
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    if not spec.has_location:
+        return 0
+    if not spec.submodule_search_locations:
+        return os.path.getsize(spec.origin)
+    size = 0
+    for folder in list(spec.submodule_search_locations) + [os.path.join(os.path.dirname(spec.submodule_search_locations[0]), name + '.libs')]:
+        for root, dirs, files in os.walk(folder):
+            size += sum(os.path.getsize(os.path.join(root, x)) for x in files)
+    return size
+
+def engine_staircase(responses):
+    '''
+    Stimuli of a cGauss staircase with normal, gamma and beta priors given 'responses',
+    and its posterior at the end
+    '''
+    psi = psi_engine.Psi(np.linspace(-3, 3, 41), Pfunction = 'cGauss', nTrials = len(responses),
+                         threshold = np.linspace(-3, 3, 31), thresholdPrior = ('normal', 0, 1),
+                         slope = np.linspace(0.2, 3, 15), slopePrior = ('gamma', 2, 0.5),
+                         guessRate = 0.5, lapseRate = np.arange(0.01, 0.12, 0.02), lapsePrior = ('beta', 1, 10), thread = False)
+    stims = [psi.xCurrent]
+    for r in responses:
+        psi.addData(r)
+        stims.append(psi.xCurrent)
+    return stims, psi.pdf
+
+def baseline_prior(x, distr, mu, sig):
+    '''
+    The priors of Psi.__genprior in the original app (main.py, V2/main.py), written out again
+    '''
+    if distr == 'normal':
+        return np.exp(-(x - mu)**2 / (2.0 * sig**2)) / np.sqrt(2.0 * np.pi * sig**2)
+    if distr == 'beta':
+        return np.exp((sig - 1.0) * np.log1p(-x) + (mu - 1.0) * np.log(x) - np.log(abs(math.gamma(mu) * math.gamma(sig) / math.gamma(mu + sig))))
+    return x ** (mu - 1) * np.exp(-x) / math.gamma(sig)
+
+def check_engine():
+    '''
+    Compare the NumPy erfc of psi_engine with math.erfc and with SciPy (when installed),
+    and its priors with the original app's; False if one of them differs by more than its tolerance
+    '''
+    passed = True
+
+    def report(name, error, tolerance):
+        ok = error <= tolerance
+        print('%-34s max rel. error %.1e (tolerance %.0e)  %s' % (name, error, tolerance, 'ok' if ok else 'FAILED'))
+        return ok
+
+    def rel_error(a, b):
+        a, b = np.asarray(a, dtype = float), np.asarray(b, dtype = float)
+        same = (a == b) | (np.isnan(a) & np.isnan(b))
+        return float(np.max(np.where(same, 0.0, np.abs(a - b) / np.maximum(np.abs(b), 1e-300))))
+
+    psi_engine.use_scipy(False)
+    # Down to the smallest normal double (erfc(26.5) ~ 1e-307)
+    x = np.concatenate([np.linspace(-26.5, 26.5, 200001), [0.0, 1.0, -1.0, 8.0, -8.0, np.inf, -np.inf, np.nan]])
+    passed &= report('erfc / math.erfc', rel_error(psi_engine.erfc(x), [math.erfc(v) for v in x]), 1e-13)
+    # The priors are those of the original app (the slope prior of V1 is ('gamma', 2, 20)), with SciPy too
+    genprior = psi_engine.Psi._Psi__genprior
+    priors = [(np.linspace(0.05, 1, 21), 'gamma', 2, 20), (np.linspace(0.2, 3, 15), 'gamma', 2, 0.5),
+              (np.linspace(-3, 3, 31), 'normal', 0, 1), (np.arange(0.01, 0.12, 0.02), 'beta', 1, 10)]
+    def prior_error():
+        return max(rel_error(genprior(None, x_prior, distr, a, b), baseline_prior(x_prior, distr, a, b)) for x_prior, distr, a, b in priors)
+    passed &= report('priors / original app', prior_error(), 0.0)
+
+    if not psi_engine.use_scipy():
+        print('The comparison with SciPy is skipped')
+        return passed
+    from scipy import special
+    passed &= report('priors / original app (SciPy)', prior_error(), 0.0)
+    psi_engine.use_scipy(False)
+    passed &= report('erfc / scipy.special.erfc', rel_error(psi_engine.erfc(x), special.erfc(x)), 1e-13)
+
+    # Whole staircases: the same stimuli, and the same posterior to rounding
+    responses = list(np.random.default_rng(0).integers(0, 2, 30))
+    stims, pdf = engine_staircase(responses)
+    psi_engine.use_scipy()
+    scipy_stims, scipy_pdf = engine_staircase(responses)
+    psi_engine.use_scipy(False)
+    same = stims == scipy_stims
+    print('%-34s %s' % ('staircase stimuli (30 trials)', 'ok' if same else 'FAILED'))
+    passed &= same
+    passed &= report('staircase posterior', rel_error(pdf, scipy_pdf), 1e-9)
+    return passed
+
+def bench_engine(repeat):
+    '''
+    Check the functions (check_engine), then import psi_engine 'repeat' times with the NumPy functions
+    and with SciPy; the fastest import and the size of the packages it loaded
+    '''
+    passed = check_engine()
+    for label, environ in [('NumPy', None), ('SciPy', {'PSI_ENGINE_SCIPY': '1'})]:
+        best, packages = None, set()
+        for i in range(repeat):
+            profile = import_profile('import psi_engine', environ)
+            if profile is None:
+                break
+            best = min(best or np.inf, sum(t for x, t in profile.items() if not x.startswith(' ')))
+            packages = set(x.strip().split('.')[0] for x in profile)
+        if profile is None:
+            print('import psi_engine (%s) failed' % label)
+            passed = False
+            continue
+        if label == 'SciPy' and package_size('scipy') is None:
+            print('import psi_engine (SciPy)           SciPy is not installed')
+            continue
+        # The packages installed with the app, not the standard library
+        sizes = dict((x, package_size(x)) for x in sorted(packages) if x not in ['psi_engine'] + list(getattr(sys, 'stdlib_module_names', [])))
+        sizes = dict((x, size) for x, size in sizes.items() if size and size > 1e5)
+        print('import psi_engine (%s) %11.1f ms, %6.1f MB of packages (%s)' % (label, best, sum(sizes.values()) / 1e6, ', '.join('%s %.1f MB' % (x, size / 1e6) for x, size in sizes.items())))
+    return passed
+
+
+def session_subject(store, prototype, seed, i):
+    '''
+    The test of simulated subject 'i' in a session of its own, saved to 'store'
+
+    Returns (subject ID, subj_info, subj_trial_info)
+    '''
+    # pm_protocol, experiment_session and session_store (kivy) are only needed here
+    import pm_protocol as pm
+    from experiment_session import ExperimentSession
+
+    rng = np.random.default_rng([seed, i])
+    session = ExperimentSession(store)
+    session.new_subject('SUBJ_%04d' % i, {'age': str(rng.integers(6, 80)), 'gender': str(rng.choice(['M', 'F'])), 'right_used': True, 'Staircase used': 'Psi-Marginal'})
+    session.set_anthropometry({'flen': '70', 'fwid': '15', 'init_step': 'N/A', 'MPJR': '10'})
+    subj_info = dict(session.subj_info)
+    responder = pm.SimulatedResponder(rng.uniform(2.0, 20.0), rng.choice(pm.GRIDS['coarse']['slope']), rng = rng)
+    protocol = pm.run_session(prototype, responder, session = session)
+    return session.subid, subj_info, protocol.subj_trial_info
+
+
+def bench_sessions(folder, n_sessions, jobs_list, seed = 0):
+    '''
+    'n_sessions' tests run in parallel sessions once per number of threads, checked in the saved files
+    '''
+    import pm_protocol as pm
+    from session_store import SafeJsonStore, SessionArchive
+
+    prototype = pm.make_prototype('coarse')
+    passed = True
+    base = None
+    for jobs in jobs_list:
+        filename = os.path.join(folder, 'sessions_%d.json' % jobs)
+        store = SafeJsonStore(filename, batch_size = 3, archive = SessionArchive(filename[:-len('json')] + 'jsonl.gz'))
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            subjects = list(pool.map(lambda i: session_subject(store, prototype, seed, i), range(n_sessions)))
+        store.flush()
+        elapsed = time.perf_counter() - t0
+        if base is None:
+            base = elapsed
+
+        with open(filename) as f:
+            saved = json.load(f)
+        archived = [key for key, value in jp.read_archive(filename[:-len('json')] + 'jsonl.gz')]
+        # As in the files: the trial records through json
+        wrong = [subid for subid, subj_info, trials in subjects
+                 if subid not in saved or saved[subid]['subj_info'] != subj_info or saved[subid]['subj_trial_info'] != json.loads(json.dumps(trials))]
+        ok = not wrong and len(saved) == n_sessions and sorted(archived) == sorted(saved)
+        passed = passed and ok
+        print('threads = %2d: %7.3f s, %6.1f sessions/s, speed-up x%.2f, %d subjects saved, %d archived %s' % (jobs, elapsed, n_sessions / elapsed, base / elapsed, len(saved), len(archived), 'ok' if ok else '%d not as tested' % len(wrong)))
+    return passed
+
+
+def check_released(folder):
+    '''
+    Every scripted scenario (pm_protocol.SCENARIOS) in a session using the compute worker, as the app does;
+    once the session is closed, its staircases (the new ones of the clearances too) and its protocol
+    must be garbage-collected and the worker must not know any of its tags
+    '''
+    import pm_protocol as pm
+    from experiment_session import ExperimentSession
+    from psi_worker import shared_worker
+    from session_store import SafeJsonStore
+
+    worker = shared_worker()
+    prototype = pm.make_prototype('coarse')
+    store = SafeJsonStore(os.path.join(folder, 'released.json'))
+    alive = list()
+    for name, (script, fucked_up_cnt, note) in pm.SCENARIOS.items():
+        session = ExperimentSession(store, worker = worker)
+        session.new_subject('SUBJ_%s' % name.replace(' ', '_'), {})
+        protocol = pm.run_session(prototype, pm.ScriptedResponder(script), session = session)
+        refs = [weakref.ref(x) for x in protocol.psi] + [weakref.ref(protocol)]
+        del protocol, session
+        gc.collect()
+        alive += [name for x in refs if x() is not None]
+    passed = not alive and not worker.generations and not worker.live
+    print('closed sessions released: %d scenarios, %d objects still alive, %d tags in the worker %s' % (len(pm.SCENARIOS), len(alive), len(worker.live), 'ok' if passed else 'FAILED'))
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the analysis pipeline')
+    parser.add_argument('benchmark', choices = ['parse', 'dataset', 'figures', 'refit', 'bootstrap', 'imports', 'engine', 'sessions'])
+    parser.add_argument('--files', type = int, default = 200, help = 'number of synthetic session files')
+    parser.add_argument('--subjects', type = int, default = 5, help = 'subjects per session file')
+    parser.add_argument('--jobs', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--data', default = None, help = 'use the session files in this folder instead of synthetic ones')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'imports, engine: runs of each import, the fastest is kept')
+    parser.add_argument('--sessions', type = int, default = 40, help = 'sessions: number of simulated subjects')
+    args = parser.parse_args()
+
+    # No session files needed
+    if args.benchmark == 'imports':
+        sys.exit(0 if bench_imports(args.repeat) else 1)
+    if args.benchmark == 'engine':
+        sys.exit(0 if bench_engine(args.repeat) else 1)
+    if args.benchmark == 'sessions':
+        folder = tempfile.mkdtemp()
+        try:
+            passed = bench_sessions(folder, args.sessions, args.jobs)
+            passed = check_released(folder) and passed
+        finally:
+            shutil.rmtree(folder)
+        sys.exit(0 if passed else 1)
+
+    # The benchmarks write into their folder, so real data is copied first
+    folder = tempfile.mkdtemp()
+    if args.data is None:
+        make_sessions(folder, args.files, args.subjects)
+    else:
+        for a_file in os.listdir(args.data):
+            if a_file[-5:] == '.json' or a_file[-9:] == '.jsonl.gz':
+                shutil.copy2(os.path.join(args.data, a_file), folder)
+
+    try:
+        if args.benchmark == 'parse':
+            bench_parse(folder, args.jobs)
+        elif args.benchmark == 'dataset':
+            bench_dataset(folder, args.jobs[0])
+        elif args.benchmark == 'figures':
+            bench_figures(folder, args.jobs)
+        elif args.benchmark == 'refit':
+            bench_refit(folder, args.jobs)
+        elif args.benchmark == 'bootstrap':
+            bench_bootstrap(folder, args.jobs)
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,179 @@
+'''
+color_screen.py
+
+[Objective]
+Geometry of the color screens (the stimulus display of TestScreenPM, TestScreenAS and PMTrialScreen),
+computed once in python instead of in the kv files
+
+The kv rules used to repeat the same chain of cm(), cos, tan and radians
+in the Quad, in quad_points, in x_correct and in the position of the MP point,
+and kivy evaluated every copy again whenever one of the properties they use changed.
+Here the geometry is computed by one method each time one of
+(degree, false_ref, degree_dir, dir, mprad, theta, diag, pos, size) changes,
+and the results are properties the kv rules bind to:
+    - mp_x: x of the MP joint, on the bottom edge of the screen
+    - mp_pos: position of the circle (0.5cm) drawn on the MP joint
+    - mp_drop: height of the bottom edge below the center of the parent screen
+    - quad_points: the quadrilateral drawn over the screen (x, y of 4 corners);
+      quad_points[4] is the top of the slant line, quad_points[6] the MP joint
+    - x_correct: top of the line at the real finger angle (theta)
+
+The canvas instructions themselves stay in proprioceptive.kv (<ColorScreen>, <ColorScreenAS>).
+
+SemicircleScreen is the half-disc display of V2: the part of the quadrilateral inside the
+half-ellipse is clipped on the CPU and drawn as a single Mesh (triangle fan),
+whose vertices are replaced in place when the stimulus changes,
+instead of masking the Quad with stencil passes at every redraw:
+    - fan_vertices, fan_indices: the clipped region (x, y, u, v per vertex)
+'''
+
+import math
+from kivy.uix.widget import Widget
+from kivy.metrics import cm
+from kivy.properties import NumericProperty, ListProperty
+
+# Diameter of the circle drawn on the MP joint (cm)
+MP_CIRCLE = 0.5
+
+# Segments of the half-ellipse, as many as kivy's Ellipse uses for its outline
+ARC_SEGMENTS = 180
+# (sin, cos) of the arc from the left end (-90 deg) over the top to the right end (+90 deg);
+# kivy measures the angles of an Ellipse clockwise from 12 o'clock
+ARC = [(math.sin(math.radians(-90 + 180.0 * i / ARC_SEGMENTS)), math.cos(math.radians(-90 + 180.0 * i / ARC_SEGMENTS))) for i in range(ARC_SEGMENTS + 1)]
+
+
+def clip_polygon(points, inside):
+    '''
+    Part of a convex polygon on the side of a line where inside(x, y) >= 0
+    (Sutherland-Hodgman with a single edge; 'inside' must be linear in x and y)
+
+    Arguments
+    ---------
+        points : list of (x, y), in order around the polygon
+
+        inside : function of (x, y), positive inside, zero on the line
+
+    Returns
+    -------
+    list of (x, y), the clipped polygon (still convex, possibly empty)
+    '''
+    clipped = list()
+    prev = points[-1]
+    d_prev = inside(*prev)
+    for point in points:
+        d = inside(*point)
+        if (d >= 0) != (d_prev >= 0):
+            t = d_prev / (d_prev - d)
+            clipped.append((prev[0] + t * (point[0] - prev[0]), prev[1] + t * (point[1] - prev[1])))
+        if d >= 0:
+            clipped.append(point)
+        prev, d_prev = point, d
+    return clipped
+
+
+class ColorScreenBase(Widget):
+    '''
+    Properties and geometry shared by ColorScreen and ColorScreenAS
+    (separate classes, so that the kv rule of one is not applied to the other);
+    the slant line is the Psi-Marginal one, ColorScreenAS has its own
+    '''
+    # Initial screen color on the right: Blue / on the left: Red
+    bg_color_before = ListProperty([0, 0, 1, 1])
+    bg_color_after = ListProperty([1, 0, 0, 1])
+
+    # parameters(will be overridden later)
+    # 1: Right / -1: Left
+    dir = NumericProperty(1)
+    # psi_obj.xCurrent(Psi-Marginal stimulus) - can think of this as the step size
+    degree = NumericProperty(15)
+    # Psi stimulus is either added or subtracted from the false reference
+    degree_dir = NumericProperty(-1)
+    false_ref = NumericProperty(55)
+    mprad = NumericProperty(5)
+    # device angle
+    theta = NumericProperty(50)
+    # diagonal distance
+    diag = NumericProperty(3)
+    # space left at the top (cm)
+    topspace = NumericProperty(1.0)
+
+    # Computed by update_geometry
+    mp_x = NumericProperty(0)
+    mp_pos = ListProperty([0, 0])
+    mp_drop = NumericProperty(0)
+    quad_points = ListProperty([0] * 8)
+    x_correct = NumericProperty(0)
+
+    def __init__(self, **kwargs):
+        super(ColorScreenBase, self).__init__(**kwargs)
+        for name in ['degree', 'false_ref', 'degree_dir', 'dir', 'mprad', 'theta', 'diag', 'pos', 'size']:
+            self.fbind(name, self.update_geometry)
+        self.update_geometry()
+
+    def line_top_x(self, mp_x):
+        '''
+        x of the top of the slant line starting at the MP joint 'mp_x',
+        at false_ref + degree_dir * degree from the horizontal (Psi-Marginal)
+        '''
+        return mp_x - self.dir * self.height * math.tan(math.radians(90 - (self.false_ref + self.degree_dir * self.degree)))
+
+    def update_geometry(self, *args):
+        theta = math.radians(self.theta)
+        mp_offset = cm(self.mprad / 10.0 + 0.25)
+        self.mp_drop = math.sin(theta) * cm(self.diag) - math.cos(theta) * mp_offset
+        mp_x = self.center_x + self.dir * (cm(self.diag) * math.cos(theta) + mp_offset * math.sin(theta))
+        self.mp_x = mp_x
+        self.mp_pos = [mp_x - cm(MP_CIRCLE / 2.0), self.y - cm(MP_CIRCLE / 2.0)]
+        self.x_correct = mp_x - self.dir * self.height * math.tan(math.radians(90 - self.theta))
+        self.quad_points = [self.x, self.y, self.x, self.top, self.line_top_x(mp_x), self.top, mp_x, self.y]
+
+
+class ColorScreen(ColorScreenBase):
+    '''
+    Psi-Marginal screen: the slant line is at false_ref + degree_dir * degree from the horizontal
+    (the geometry of ColorScreenBase, with the <ColorScreen> kv rule)
+    '''
+    pass
+
+
+class ColorScreenAS(ColorScreenBase):
+    '''
+    Adaptive staircase screen: the slant line is at 'degree' from the vertical
+    (degree in ColorScreenAS is different from the equivalent in ColorScreen!)
+    '''
+    degree = NumericProperty(25)
+
+    def line_top_x(self, mp_x):
+        return mp_x + self.height * math.tan(math.radians(self.degree))
+
+
+class SemicircleScreen(ColorScreen):
+    '''
+    ColorScreen drawn on a half-ellipse (bottom edge to top, full width), as in V2
+    '''
+    fan_vertices = ListProperty([])
+    fan_indices = ListProperty([])
+
+    def update_geometry(self, *args):
+        super(SemicircleScreen, self).update_geometry()
+        if self.width <= 0 or self.height <= 0:
+            self.fan_vertices, self.fan_indices = [], []
+            return
+
+        # Half-ellipse centered on the bottom edge
+        rx, cx, y0 = self.width / 2.0, self.center_x, self.y
+        half_disc = [(cx + rx * s, y0 + self.height * c) for s, c in ARC]
+        # Quadrilateral: left of the slant line from the MP joint to the top,
+        # and right of its left edge, which is the diagonal from the bottom left corner
+        # when the line leaves the screen on the left (how the Quad was rasterized)
+        x0, x1 = self.quad_points[6], self.quad_points[4]
+        slope = (x1 - x0) / float(self.height)
+        left_slope = min(x1 - self.x, 0) / float(self.height)
+        region = clip_polygon(half_disc, lambda x, y: x0 + slope * (y - y0) - x)
+        region = clip_polygon(region, lambda x, y: x - self.x - left_slope * (y - y0)) if region and left_slope else region
+
+        vertices = list()
+        for x, y in region:
+            vertices.extend([x, y, 0, 0])
+        self.fan_vertices = vertices
+        self.fan_indices = list(range(len(region)))
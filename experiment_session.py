@@ -0,0 +1,127 @@
+'''
+experiment_session.py
+
+[Objective]
+Everything about the subject being tested in one object, instead of module globals of main.py
+
+subid, subj_info and subj_anth were globals of main.py set by the parameter screens with
+'global' statements, and the staircases (psi_obj, psi_obj2) were globals set by the test screen.
+Whatever ran in a thread could find them half replaced by the next subject,
+and a process could only ever test one subject at a time.
+ExperimentSession holds them for one experimenter:
+    - the subject: subid, subj_info (first parameter screen), subj_anth (second parameter screen)
+    - the engines: the 'A' and 'B' staircases and the PMProtocol of the test (pm_protocol.py)
+    - the store the subjects are written to (a SafeJsonStore can be shared by sessions, see session_store.py)
+Every read and change of the subject goes through the session's lock,
+so that several sessions can run in parallel threads of one process (benchmark.py sessions).
+The apps make one session (ProprioceptiveApp.session); nothing here needs kivy,
+and pm_protocol (with numpy) is only imported by start_test, once the staircases are made.
+
+[Usage]
+    session = ExperimentSession(store, worker = shared_worker())
+    session.new_subject("SUBJ_01", {'age': '25', ...})
+    session.set_anthropometry({'flen': '8', ...})
+    session.set_staircases(new_staircases(25))
+    protocol = session.start_test(psi_order, catch, 25, make_staircase)
+    ... protocol.respond(...) ...
+    session.save(protocol.subj_trial_info)        # store.put(subid, subj_info = ..., subj_anth = ..., subj_trial_info = ...)
+    session.close()
+'''
+
+import threading
+
+
+class ExperimentSession(object):
+    '''
+    The subject, staircases, test and store of one experimenter (see [Objective])
+
+    Arguments
+    ---------
+        store : where the subjects are written (SafeJsonStore, or any store with put(key, **values));
+            None: save() only returns the record
+
+        worker : PsiWorker computing the staircases (None: in the calling thread);
+            the sessions of a process can share it, its jobs are tagged by staircase
+    '''
+    def __init__(self, store = None, worker = None):
+        self.store = store
+        self.worker = worker
+        self.lock = threading.RLock()
+        self.subid = None
+        self.subj_info = {}
+        self.subj_anth = {}
+        self.staircases = None
+        self.protocol = None
+
+    def new_subject(self, subid, subj_info):
+        '''
+        The subject 'subid' starts, with the answers of the first parameter screen
+        '''
+        with self.lock:
+            self.subid = subid
+            self.subj_info = dict(subj_info)
+            self.subj_anth = {}
+
+    def set_anthropometry(self, subj_anth):
+        with self.lock:
+            self.subj_anth = dict(subj_anth)
+
+    def set_staircases(self, staircases):
+        '''
+        The staircases of the next test, e.g. from psi_warmup; the test of the previous ones is over
+        '''
+        with self.lock:
+            self.close()
+            self.staircases = tuple(staircases)
+
+    def start_test(self, psi_order, catch, psi_nTrials, make_staircase):
+        '''
+        The Psi-Marginal test of the subject on the staircases (see PMProtocol)
+        '''
+        from pm_protocol import PMProtocol
+        with self.lock:
+            if self.staircases is None:
+                raise RuntimeError('the session has no staircases, see set_staircases')
+            self.protocol = PMProtocol(self.staircases, psi_order, catch, psi_nTrials, make_staircase, worker = self.worker)
+            return self.protocol
+
+    def subject_record(self, subj_trial_info, **fields):
+        '''
+        (subid, record) of the subject as it is now, for put() later on
+
+        subj_trial_info is kept as is (the touch-up times of the last trial are filled in after the response),
+        subj_info and subj_anth are copied
+        '''
+        with self.lock:
+            if self.subid is None:
+                raise RuntimeError('the session has no subject, see new_subject')
+            record = dict(subj_info = dict(self.subj_info), subj_anth = dict(self.subj_anth), subj_trial_info = subj_trial_info)
+            record.update(fields)
+            return self.subid, record
+
+    def put(self, subid, record):
+        '''
+        Write a record of subject_record to the store
+        '''
+        if self.store is not None:
+            self.store.put(subid, **record)
+        return record
+
+    def save(self, subj_trial_info, **fields):
+        '''
+        Write the subject with its trial records (and 'fields', e.g. the latency of the test) now
+        '''
+        return self.put(*self.subject_record(subj_trial_info, **fields))
+
+    def close(self):
+        '''
+        The test is over: nothing more is computed for its staircases
+        '''
+        with self.lock:
+            if self.protocol is not None:
+                self.protocol.close()
+            elif self.worker is not None and self.staircases is not None:
+                for psi_obj in self.staircases:
+                    self.worker.supersede(psi_obj)
+            self.protocol = None
+            self.staircases = None
@@ -6,6 +6,14 @@ Written by JINSEOK OH
 json_processing.py will read all the json data files in a folder
 and merge them in preparation of future analyses
 
+It is a library (loading, extraction, plotting); importing it does not read or draw anything
+and does not import matplotlib until a figure is drawn
+
+[Usage]
+python3 json_processing.py [FOLDER] [--subjects SUBJ_1 ...] [--plots performance signed]
+                           [--format png] [--out FOLDER] [--jobs N] [--no-cache] [--force] [--timing]
+    Load every session file in FOLDER (current folder by default) and draw the figures of the subjects
+
 [Data structure]
 Each .json file would be a nested dictionary
 Keys of a dictionary would be the subject ID's (e.g. SUBJ_001)
@@ -37,177 +45,864 @@ Each key would again have a dictionary as a corresponding value
             - correct_ans: right or left
             - response
             - response_correct: 0 (wrong) or 1 (correct)
+
+[Compressed archives]
+The app also writes a compressed copy of every session (.jsonl.gz)
+Every subject is a line {"SUBJ_XX": {...}} compressed as its own gzip member,
+so the archives are read line by line without inflating the whole file
+An archive is a copy of the session file next to it ('X.jsonl.gz' of 'X.json'),
+and so are the outputs of tidy_sessions.py ('X_tidy.json', 'X_compact.json', 'X_binary.jsonl.gz'):
+only one copy of a session is read, the first one found in the order of SESSION_COPIES
+(e.g. the archive only when nothing else of the session was copied off the device)
+A subject saved again in the same session is a new line of the archive: its last line is its record
 '''
 
 import os
+import gzip
+import hashlib
 import numpy as np
 import json
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
-
-# Run this script in the folder where the json files are located
-all_files = os.listdir('./')
-
-# filter out the json files
-json_files = list(filter(lambda x: x[-5:] == '.json', all_files))
-
-# A complete dictionary is prepared
-c_dict = dict()
-
-# Iterating over the list of json files
-# and merge them to 'c_dict'
-for a_file in json_files:
-    with open(a_file, 'r') as f:
-        temp = json.load(f)
-        c_dict.update(temp)
-    f.close()
-
-# Variables that may be useful
-
-# Subject ID's
-subj_ids = [*c_dict]
-
-# Ages of the subjects
-age_dist = [c_dict[key]['subj_info']['age'] for key in c_dict.keys()]
-
-# Gender
-gender_dist = [c_dict[key]['subj_info']['gender'] for key in c_dict.keys()]
-
-# Handedness
-hand_dist = [c_dict[key]['subj_info']['right_used'] for key in c_dict.keys()]
-
-subj_infos = {key:c_dict[key]['subj_info'] for key in c_dict.keys()}
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import psi_engine
+
+# orjson parses the session files several times faster, but it is optional
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# The copies of a session file 'X.json', in the order they are preferred:
+# the file itself, the outputs of tidy_sessions.py and the archive of the app
+SESSION_COPIES = ('.json', '_tidy.json', '_compact.json', '_binary.jsonl.gz', '.jsonl.gz')
+
+def read_archive(filename):
+    '''
+    Stream the subjects of a compressed session archive (.jsonl.gz)
+
+    Only one line is decompressed at a time.
+    If the last subject was cut off (e.g. the device died while writing it),
+    the subjects before it are still returned.
+
+    Yields (subject ID, subject record)
+    '''
+    with gzip.open(filename, 'rt', encoding = 'utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield from loads(line).items()
+        except EOFError:
+            print(' '.join([filename, 'ends with an incomplete subject, which is skipped']))
+
+def load_session(path):
+    '''
+    Parse one session file (.json or .jsonl.gz)
+
+    Returns the list of (subject ID, subject record) in the order of the file
+    (the last record of a subject saved more than once in an archive)
+    '''
+    if path[-9:] == '.jsonl.gz':
+        return list(dict(read_archive(path)).items())
+    with open(path, 'rb') as f:
+        return list(loads(f.read()).items())
+
+def parse_sessions(paths, jobs = 1, parse = load_session):
+    '''
+    Parse session files, in parallel if jobs > 1
+
+    The results always come back in the order of 'paths', whatever the number of jobs.
+    At most 2 * jobs files are parsed ahead of the one being consumed,
+    so the memory use does not grow with the number of files.
+
+    parse: the function applied to every path (a module level function, so that it can be sent to the workers)
+
+    Yields (path, parse(path))
+    '''
+    if jobs is None or jobs > 1:
+        ahead = 2 * (jobs or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers = jobs) as pool:
+            pending = deque()
+            for path in paths:
+                pending.append((path, pool.submit(parse, path)))
+                if len(pending) >= ahead:
+                    path_done, future = pending.popleft()
+                    yield path_done, future.result()
+            while pending:
+                path_done, future = pending.popleft()
+                yield path_done, future.result()
+    else:
+        for path in paths:
+            yield path, parse(path)
+
+def session_copy(name):
+    '''
+    (X, rank in SESSION_COPIES) of a copy of the session file 'X.json', None if 'name' is not a session file
+    '''
+    suffixes = [x for x in SESSION_COPIES if name.endswith(x)]
+    if not suffixes:
+        return None
+    suffix = max(suffixes, key = len)
+    return name[:-len(suffix)], SESSION_COPIES.index(suffix)
+
+def list_sessions(folder):
+    '''
+    Names of the json files and compressed archives in a folder, sorted
+    Hidden files (e.g. the manifest of the figures) are not session files,
+    and only one copy of every session is listed (the same subjects, see [Compressed archives])
+    '''
+    copies = sorted((session_copy(x), x) for x in os.listdir(folder) if x[0] != '.' and session_copy(x))
+    first = dict()
+    for (session, rank), name in copies:
+        first.setdefault(session, name)
+    return sorted(first.values())
+
+def iter_subjects(folder = './', duplicates = None, jobs = 1):
+    '''
+    Stream the subjects of all the json files and compressed archives in a folder
+
+    Only a few files are held in memory at a time,
+    so going through the whole cohort does not need more memory than a handful of session files.
+    The files are read in the order of their names, whatever the number of jobs.
+
+    duplicates: what to do with a subject ID found in more than one file
+        - None: nothing is checked and every record is yielded
+        - 'warn': the record of the last file is kept (it was saved last), the earlier ones are reported and skipped;
+                  the subject IDs of every file are read first, so the files are parsed twice
+        - 'error': ValueError is raised
+
+    jobs: number of processes parsing the files (None: one per core)
+
+    Yields (subject ID, subject record, file name)
+    '''
+    session_files = list_sessions(folder)
+    paths = [os.path.join(folder, x) for x in session_files]
+
+    # The file with the last record of every subject
+    last = dict()
+    if duplicates == 'warn':
+        for a_file, (path, records) in zip(session_files, parse_sessions(paths, jobs)):
+            for subj, record in records:
+                last[subj] = a_file
+
+    seen = dict()
+    for a_file, (path, records) in zip(session_files, parse_sessions(paths, jobs)):
+        for subj, record in records:
+            if duplicates == 'warn' and last[subj] != a_file:
+                print(' '.join([subj, 'in', a_file, 'is replaced by the record in', last[subj]]))
+                continue
+            if duplicates == 'error':
+                if subj in seen:
+                    raise ValueError(' '.join([subj, 'in', a_file, 'was already loaded from', seen[subj]]))
+                seen[subj] = a_file
+            yield subj, record, a_file
 
 '''
-A set of three variables
+A set of three variables, one row per subject and one column per trial
     - Psi-stimulus for each trial(psi_stim)
     - Psi-object(psi_obj)
     - The correctness of the response for that stimulus(if_corr)
 
-Data structure for the two variables: dictionary
-    1) psi_stim: key = SUBJ_XX, value = the list of psi_stimuli for the total of 50 trials
-    2) psi_obj: key = SUBJ_XX, value = the list of psi_objs used for the total of 50 trials
-    3) if_corr: key = SUBJ_XX, value = the list of right or wrong for the total of 50 trials
+Data structure for the three variables: numpy arrays of subjects x trials
+    1) psi_stim: Psi-stimulus(deg), NaN for the trials without one (catch, Adaptive-Staircase, missing or cleared trials)
+    2) psi_obj: the same coding as psi_order in the app
+                PSI_A (0): 'A', PSI_B (1): 'B', CATCH (2): catch trial, MISSING (-1): no record
+                and ADAPTIVE (3): a trial of an Adaptive-Staircase subject (no Psi_obj either, but not a catch trial)
+    3) if_corr: 0 (wrong) or 1 (correct), -1 for the trials without a record
 
 There are now 3 catch trials: 12, 28, 44 for short(Total 53 trials)
+The long version has more trials, so the number of columns is that of the longest session (at least 53)
 '''
 catch_trials = [12,28,44]
-psi_trials = [i for i in range(53) if i not in catch_trials]
+n_trials = 53
 
-psi_stim = dict()
-psi_obj = dict()
-if_corr = dict()
-for subj in c_dict.keys():
-    psi_stim[subj] = [c_dict[subj]['subj_trial_info']['_'.join(['TRIAL', str(i)])]['Psi_stimulus(deg)'] for i in psi_trials]
-    psi_obj[subj] = [c_dict[subj]['subj_trial_info']['_'.join(['TRIAL', str(i)])]['Psi_obj'] for i in psi_trials]
-    if_corr[subj] = [c_dict[subj]['subj_trial_info']['_'.join(['TRIAL', str(i)])]['response_correct'] for i in range(53)]
+PSI_A = 0
+PSI_B = 1
+CATCH = 2
+ADAPTIVE = 3
+MISSING = -1
 
+# Value of a trial that has no record
+TRIAL_FILL = {'psi_stim': np.nan, 'psi_obj': MISSING, 'if_corr': -1}
+
+'''
+[Consolidated dataset]
+The variables above are kept for the whole cohort as numpy arrays (one row per subject)
+    - subj_ids, age, gender, right_used, staircase: subject information
+    - psi_stim, psi_obj, if_corr: subjects x trials
+    - source: index of the session file the subject was read from
+load_dataset also adds the masks (subjects x trials) that every analysis needs
+    - is_a, is_b: Psi trials of the object 'A' / 'B'
+    - is_psi: is_a or is_b
+    - is_catch: catch trials
+    - is_adaptive: trials of the Adaptive-Staircase subjects
+and catch_hit, the rate of correct catch trials of every subject (NaN without catch trials, e.g. Adaptive-Staircase),
+and age_years, the age as a number (NaN if it cannot be read)
+
+They are cached in CACHE_DIR of the data folder
+    - <variable>.npy: one array per variable, for every subject of every file (duplicates included)
+    - manifest.json: name, size, mtime and sha256 of every file in the cache
+A file is parsed again only when it is new or its content changed,
+so the daily analysis costs as much as the new data, not the whole cohort
+
+When no file changed, the arrays returned by load_dataset are memory-mapped from the cache:
+nothing is parsed or copied and only the parts that are used are read from the disk,
+so opening a large cohort takes milliseconds (np.load(..., mmap_mode = 'r'), read-only)
+query() then selects subjects by age, gender, handedness and staircase
+'''
+CACHE_DIR = '.consolidated'
+CACHE_VERSION = 5
+INFO_FIELDS = ['subj_ids', 'age', 'gender', 'right_used', 'staircase']
+TRIAL_FIELDS = ['psi_stim', 'psi_obj', 'if_corr']
+SUBJ_FIELDS = INFO_FIELDS + TRIAL_FIELDS
+
+def extract_session(path):
+    '''
+    Parse one session file and keep only the variables of the consolidated dataset
+
+    Every trial record is visited once; the values are then written
+    into the subjects x trials arrays in a single indexed assignment per variable.
+
+    Returns a dictionary of arrays, one row per subject
+    '''
+    info = {key: list() for key in INFO_FIELDS}
+    rows, cols, stims, objs, corrs = list(), list(), list(), list(), list()
+    width = n_trials
+    for row, (subj, record) in enumerate(load_session(path)):
+        subj_info = record['subj_info']
+        info['subj_ids'].append(subj)
+        info['age'].append(str(subj_info['age']))
+        info['gender'].append(str(subj_info['gender']))
+        info['right_used'].append(bool(subj_info['right_used']))
+        info['staircase'].append(str(subj_info['Staircase used']))
+        adaptive = subj_info['Staircase used'] == 'Adaptive-Staircase'
+        # 'NOTE' (left by a clearance) is not a trial
+        for key, trial in record['subj_trial_info'].items():
+            if key[:6] != 'TRIAL_':
+                continue
+            col = int(key[6:])
+            rows.append(row)
+            cols.append(col)
+            width = max(width, col + 1)
+            if 'Psi_obj' in trial:
+                objs.append(PSI_A if trial['Psi_obj'] == 'A' else PSI_B)
+                stims.append(trial['Psi_stimulus(deg)'])
+            elif adaptive or 'block_num' in trial:
+                # The trials of the Adaptive-Staircase have no Psi_obj either (block_num, rev_cnt instead)
+                objs.append(ADAPTIVE)
+                stims.append(np.nan)
+            else:
+                objs.append(CATCH)
+                stims.append(np.nan)
+            corrs.append(trial['response_correct'])
+
+    data = {'subj_ids': np.array(info['subj_ids'], dtype = str),
+            'age': np.array(info['age'], dtype = str),
+            'gender': np.array(info['gender'], dtype = str),
+            'right_used': np.array(info['right_used'], dtype = bool),
+            'staircase': np.array(info['staircase'], dtype = str)}
+    n = len(info['subj_ids'])
+    data['psi_stim'] = np.full((n, width), TRIAL_FILL['psi_stim'], dtype = float)
+    data['psi_obj'] = np.full((n, width), TRIAL_FILL['psi_obj'], dtype = np.int8)
+    data['if_corr'] = np.full((n, width), TRIAL_FILL['if_corr'], dtype = np.int8)
+    data['psi_stim'][rows, cols] = stims
+    data['psi_obj'][rows, cols] = objs
+    data['if_corr'][rows, cols] = corrs
+    return data
+
+def pad_trials(data, width):
+    '''
+    Widen the subjects x trials arrays of 'data' to 'width' trials
+    '''
+    padded = dict(data)
+    for key in TRIAL_FIELDS:
+        missing = width - data[key].shape[1]
+        if missing > 0:
+            padded[key] = np.pad(data[key], ((0, 0), (0, missing)), constant_values = TRIAL_FILL[key])
+    return padded
+
+def add_masks(data):
+    '''
+    Add the masks and the catch trial hit rate (see [Consolidated dataset]) to 'data'
+    '''
+    data['is_a'] = data['psi_obj'] == PSI_A
+    data['is_b'] = data['psi_obj'] == PSI_B
+    data['is_psi'] = data['is_a'] | data['is_b']
+    data['is_catch'] = data['psi_obj'] == CATCH
+    data['is_adaptive'] = data['psi_obj'] == ADAPTIVE
+    n_catch = np.sum(data['is_catch'], axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        data['catch_hit'] = np.sum(data['is_catch'] & (data['if_corr'] == 1), axis = 1) / n_catch
+    data['age_years'] = np.array([float(x) if x.replace('.', '', 1).isdigit() else np.nan for x in data['age']], dtype = float)
+    return data
+
+def refittable(dataset, grid):
+    '''
+    True for the subjects of the dataset whose staircases can be refitted on 'grid'
+
+    The refit assumes uniform priors, as in V2/main.py. The V1 app (main.py) puts its stimuli
+    on a 0.1 deg grid and uses a gamma slope prior from its second subject on, so its subjects
+    cannot be refitted; they are told apart by their stimuli (not on the grid) and by their test,
+    which has no catch trials (V2 has 3 or 5, see pm_protocol.psi_schedule).
+    Subjects without Psi trials (e.g. Adaptive-Staircase) are kept: their fits are empty.
+    '''
+    psi = dataset['is_psi']
+    off_grid = np.any(psi & ~grid.on_grid(dataset['psi_stim']), axis = 1)
+    no_catch = np.any(psi, axis = 1) & ~np.any(dataset['is_catch'], axis = 1)
+    return ~(off_grid | no_catch)
+
+def check_refit(dataset, grid):
+    '''
+    Raise ValueError if some subjects of the dataset cannot be refitted on 'grid' (see refittable)
+    '''
+    rejected = ~refittable(dataset, grid)
+    if np.any(rejected):
+        subjects = list(dataset['subj_ids'][rejected])
+        raise ValueError('%d subjects cannot be refitted with uniform priors on this grid '
+                         '(V1 protocol: stimuli off the grid or no catch trials): %s; '
+                         'leave them out with take_rows(dataset, refittable(dataset, grid))'
+                         % (len(subjects), ', '.join(subjects[:10] + ['...'] * (len(subjects) > 10))))
+
+def refit_dataset(dataset, grid = None, jobs = 1):
+    '''
+    Final posteriors of the two staircases ('A' and 'B') of every subject,
+    refitted from the recorded stimuli and responses (see psi_engine.refit_posteriors)
+
+    grid: psi_engine.PsiGrid, the V2 grid by default; it is the slow part, so reuse it
+    jobs: number of threads (None: one per core)
+
+    Only the subjects of the V2 protocol can be refitted: ValueError is raised
+    before anything is computed if there are others (see check_refit)
+
+    Returns {'A': posteriors, 'B': posteriors}, one row per subject of the dataset
+    '''
+    if grid is None:
+        grid = psi_engine.PsiGrid()
+    check_refit(dataset, grid)
+    fits = dict()
+    for name, mask in [('A', dataset['is_a']), ('B', dataset['is_b'])]:
+        stims = np.where(mask, dataset['psi_stim'], np.nan)
+        fits[name] = psi_engine.refit_posteriors(stims, dataset['if_corr'], grid, jobs = jobs)
+    return fits
+
+def bootstrap_dataset(dataset, grid = None, n_boot = 1000, confidence = 0.95, seed = 0, jobs = 1):
+    '''
+    Bootstrap confidence intervals of the thresholds of the two staircases ('A' and 'B')
+    of every subject (see psi_engine.bootstrap_thresholds)
+
+    The result only depends on 'seed', not on 'jobs' (number of threads, None: one per core)
+    As refit_dataset, only the subjects of the V2 protocol (see check_refit)
+
+    Returns {'A': intervals, 'B': intervals}, one row per subject of the dataset
+    '''
+    if grid is None:
+        grid = psi_engine.PsiGrid()
+    check_refit(dataset, grid)
+    seeds = np.random.SeedSequence(seed).spawn(2)
+    intervals = dict()
+    for (name, mask), child in zip([('A', dataset['is_a']), ('B', dataset['is_b'])], seeds):
+        stims = np.where(mask, dataset['psi_stim'], np.nan)
+        intervals[name] = psi_engine.bootstrap_thresholds(stims, dataset['if_corr'], grid, nBoot = n_boot, confidence = confidence, seed = child, jobs = jobs)
+    return intervals
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_cache(folder):
+    '''
+    Returns (manifest, arrays) of the cache in 'folder', or (None, None) if there is no usable cache
+    The arrays are memory-mapped, read-only
+    '''
+    cache = os.path.join(folder, CACHE_DIR)
+    try:
+        with open(os.path.join(cache, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_VERSION:
+            return None, None
+        arrays = {key: np.load(os.path.join(cache, key + '.npy'), mmap_mode = 'r', allow_pickle = False) for key in manifest['arrays']}
+        return manifest, arrays
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+def write_cache(folder, manifest, arrays):
+    '''
+    Write the cache, the arrays first and the manifest last, each with an atomic rename
+    '''
+    cache = os.path.join(folder, CACHE_DIR)
+    os.makedirs(cache, exist_ok = True)
+    for key, val in arrays.items():
+        tmp = os.path.join(cache, key + '.tmp.npy')
+        np.save(tmp, val, allow_pickle = False)
+        os.replace(tmp, os.path.join(cache, key + '.npy'))
+    manifest = dict(manifest, arrays = sorted(arrays))
+    tmp = os.path.join(cache, 'manifest.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(tmp, os.path.join(cache, 'manifest.json'))
+    # Left by the earlier versions of the cache
+    if os.path.exists(os.path.join(cache, 'arrays.npz')):
+        os.remove(os.path.join(cache, 'arrays.npz'))
+
+def load_dataset(folder = './', jobs = 1, duplicates = 'warn', use_cache = True):
+    '''
+    Build the consolidated dataset of all the session files in a folder
+
+    Only the new or changed files are parsed (in parallel if jobs > 1);
+    the subjects of the other files come from the cache.
+    duplicates: as in iter_subjects ('warn', 'error' or None); 'warn' keeps the record of the last file
+
+    Returns a dictionary of arrays (see [Consolidated dataset]) plus 'files', the list of file names
+    '''
+    session_files = list_sessions(folder)
+
+    manifest, cached = read_cache(folder) if use_cache else (None, None)
+    old_entries = dict()
+    if manifest is not None:
+        old_entries = {entry['name']: (i, entry) for i, entry in enumerate(manifest['files'])}
+
+    # Decide which files can be taken from the cache
+    entries = list()
+    chunks = dict()
+    to_parse = list()
+    changed = manifest is None or len(old_entries) != len(session_files)
+    for a_file in session_files:
+        st = os.stat(os.path.join(folder, a_file))
+        entry = {'name': a_file, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': None}
+        old = old_entries.get(a_file)
+        if old is not None and (old[1]['size'], old[1]['mtime']) == (entry['size'], entry['mtime']):
+            entry['sha256'] = old[1]['sha256']
+        elif old is not None and old[1]['size'] == entry['size'] and old[1]['sha256'] == file_hash(os.path.join(folder, a_file)):
+            # Only touched; the content is the same
+            entry['sha256'] = old[1]['sha256']
+            changed = True
+        else:
+            old = None
+            changed = True
+        if old is not None:
+            mask = cached['source'] == old[0]
+            chunks[a_file] = {key: cached[key][mask] for key in SUBJ_FIELDS}
+        else:
+            to_parse.append(a_file)
+        entries.append(entry)
+
+    paths = [os.path.join(folder, x) for x in to_parse]
+    for a_file, (path, arrays) in zip(to_parse, parse_sessions(paths, jobs, parse = extract_session)):
+        chunks[a_file] = arrays
+    for entry in entries:
+        if entry['sha256'] is None:
+            entry['sha256'] = file_hash(os.path.join(folder, entry['name']))
+
+    if not changed:
+        # Nothing to do: the memory-mapped cache is the dataset
+        data = dict(cached)
+    else:
+        # Everything, in the order of the file names
+        if session_files:
+            width = max(chunks[x]['psi_stim'].shape[1] for x in session_files)
+            padded = [pad_trials(chunks[x], width) for x in session_files]
+            data = {key: np.concatenate([x[key] for x in padded]) for key in SUBJ_FIELDS}
+            data['source'] = np.concatenate([np.full(len(chunks[x]['subj_ids']), i, dtype = np.int32) for i, x in enumerate(session_files)])
+        else:
+            data = {key: np.zeros(0, dtype = str) for key in INFO_FIELDS}
+            data.update({key: np.full((0, n_trials), TRIAL_FILL[key]) for key in TRIAL_FIELDS})
+            data['source'] = np.zeros(0, dtype = np.int32)
+        add_masks(data)
+        if use_cache:
+            write_cache(folder, {'version': CACHE_VERSION, 'files': entries}, data)
+
+    # A subject ID found in more than one file: the last file has the record saved last
+    if duplicates is not None:
+        seen = dict()
+        keep = np.ones(len(data['subj_ids']), dtype = bool)
+        for i in range(len(data['subj_ids']) - 1, -1, -1):
+            subj = data['subj_ids'][i]
+            if subj in seen:
+                if duplicates == 'error':
+                    raise ValueError(' '.join([subj, 'in', session_files[seen[subj]], 'was already loaded from', session_files[data['source'][i]]]))
+                print(' '.join([subj, 'in', session_files[data['source'][i]], 'is replaced by the record in', session_files[seen[subj]]]))
+                keep[i] = False
+            else:
+                seen[subj] = data['source'][i]
+        data = take_rows(data, keep)
+
+    data['files'] = session_files
+    return data
+
+def take_rows(dataset, keep):
+    '''
+    The rows of the dataset where 'keep' (boolean array) is True
+
+    A contiguous run of rows (e.g. all of them) is returned as views of the original
+    arrays, so a memory-mapped dataset is not read; other selections are copied
+    '''
+    rows = np.flatnonzero(keep)
+    if len(rows) == 0 or rows[-1] - rows[0] + 1 == len(rows):
+        rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+    return {key: (val if key == 'files' else val[rows]) for key, val in dataset.items()}
+
+def query(dataset, age = None, gender = None, right_used = None, staircase = None):
+    '''
+    The subjects of the dataset that match all the given criteria
+
+    age: (youngest, oldest), inclusive; either can be None
+    gender: 'M', 'F' or a list of them
+    right_used: True or False
+    staircase: 'Psi-Marginal', 'Adaptive-Staircase' or a list of them
+
+    Only the subject information is scanned; see take_rows for what is copied
+    '''
+    keep = np.ones(len(dataset['subj_ids']), dtype = bool)
+    if age is not None:
+        youngest, oldest = age
+        if youngest is not None:
+            keep &= dataset['age_years'] >= youngest
+        if oldest is not None:
+            keep &= dataset['age_years'] <= oldest
+    if gender is not None:
+        keep &= np.isin(dataset['gender'], gender)
+    if right_used is not None:
+        keep &= dataset['right_used'] == bool(right_used)
+    if staircase is not None:
+        keep &= np.isin(dataset['staircase'], staircase)
+    return take_rows(dataset, keep)
+
+def select_subjects(dataset, subj_ids):
+    '''
+    The rows of the dataset of the subject IDs in 'subj_ids', in the order of the dataset
+    '''
+    return take_rows(dataset, np.isin(dataset['subj_ids'], subj_ids))
+
+def subject_infos(dataset):
+    '''
+    {subject ID: subj_info} as saved by the app
+    '''
+    return {key: {'age': a, 'gender': g, 'right_used': bool(r), 'Staircase used': sc} for key, a, g, r, sc in zip(dataset['subj_ids'], dataset['age'], dataset['gender'], dataset['right_used'], dataset['staircase'])}
+
+'''
+[Pooled psychometric curve]
+The Psi trials of a group of subjects pooled per signed stimulus
+    - 'A' trials are counted as -Psi-stimulus(deg), 'B' trials as +Psi-stimulus(deg)
+    - without bins, every stimulus level is its own bin; with bins (number or edges), as np.histogram
+    - Wilson score interval for the proportion correct of every bin
+'''
+def pooled_curve(dataset, subj_ids = None, bins = None, confidence = 0.95):
+    '''
+    Pooled proportion correct per signed stimulus
+
+    subj_ids: only these subjects (all by default)
+    bins: None (every stimulus level), a number of bins or the bin edges, as np.histogram
+    confidence: level of the confidence intervals
+
+    Returns a dictionary of arrays, one value per stimulus level or bin (empty bins are left out)
+        stimulus: the signed stimulus (or the centre of the bin)
+        n: number of trials, correct: number of correct responses
+        p: proportion correct, ci_low / ci_high: confidence interval of p
+    '''
+    from statistics import NormalDist
+
+    valid = dataset['is_psi'] & (dataset['if_corr'] >= 0)
+    if subj_ids is not None:
+        valid &= np.isin(dataset['subj_ids'], subj_ids)[:, None]
+    signed = np.where(dataset['is_a'], -dataset['psi_stim'], dataset['psi_stim'])[valid]
+    correct = dataset['if_corr'][valid]
+
+    if bins is None:
+        stimulus, index = np.unique(signed, return_inverse = True)
+        n = np.bincount(index, minlength = len(stimulus))
+        n_correct = np.bincount(index, weights = correct, minlength = len(stimulus))
+    else:
+        n, edges = np.histogram(signed, bins = bins)
+        n_correct = np.histogram(signed, bins = edges, weights = correct)[0]
+        stimulus = (edges[:-1] + edges[1:]) / 2
+        stimulus, n_correct, n = stimulus[n > 0], n_correct[n > 0], n[n > 0]
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        p = n_correct / n
+        centre = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+        half = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return {'stimulus': stimulus, 'n': n, 'correct': n_correct.astype(int), 'p': p, 'ci_low': centre - half, 'ci_high': centre + half}
 
 '''
 plot_sub_performance is a function to draw to plots
     - Performance per trial
     - Performance per Psi-stimulus(deg)
-
-The input parameter should be the c_dict, or a nested dictionay
-The output of this function would be the plots of each subject saved as png format in the
-current working directory
+plot_sub_performance2 draws the signed Psi-stimulus per trial
+
+The input parameter is the dataset returned by load_dataset
+The output of these functions would be the plots of each subject saved in 'folder'
+(the current working directory by default) as png, or any format given by 'fmt' (pdf, svg...)
+
+[Rendering]
+The figures are drawn in a pool of 'jobs' processes (Agg backend, None: all the cores)
+    - The legend handles are built once for the module
+    - Every process draws all its subjects on the same figure, cleared between subjects
+    - FIGURE_MANIFEST in 'folder' keeps the data hash every png was drawn from;
+      a subject whose data did not change is not drawn again unless force = True
 '''
-def plot_sub_performance(subj_ids, psi_stim, psi_obj, if_corr, catch_trials, psi_trials):
-
-    for subj_id in subj_ids:
-
-        e_scheme = ['r' if x == 'A' else 'b' for x in psi_obj[subj_id]]
-        c_scheme = ['r' if (x, y) == ('A', 1) else 'b' if (x, y) == ('B', 1) else 'none' for x, y in zip(psi_obj[subj_id], np.delete(if_corr[subj_id], catch_trials))]
-
-        legend_elements = [Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'r', markeredgecolor = 'r', label = 'A, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'r', label = 'A, Wrong'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'b', markeredgecolor = 'b', label = 'B, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'b', label = 'B, Wrong')]
-        fig, (ax1, ax2) = plt.subplots(nrows = 2, ncols = 1, figsize = (12, 6))
-
-        ax1.scatter(psi_trials, psi_stim[subj_id], c = c_scheme, edgecolors = e_scheme, label = ['A:1', 'A:0', 'B:1', 'B:0'])
-        ax1.axhline(y=5)
-        linesty = ['solid' if if_corr[subj_id][i] is 1 else 'dashed' for i in catch_trials]
-        ax1.vlines(catch_trials, ymin=0, ymax=35, colors='g', linestyles=linesty)
-
-        ax1.legend(handles = legend_elements, loc = 0, ncol = 4)
-
-        ax1.set_xlabel('Trials')
-        ax1.set_ylabel('Psi-stimulus(Deg)')
-        ax1.set_title(':'.join([subj_id, 'Performance per trial / catch_hit rate', str(np.mean([if_corr[subj_id][k] for k in catch_trials]))]))
-
-
-        # Plotting for Psychophysical analysis
-        ax2.scatter(psi_stim[subj_id], np.delete(if_corr[subj_id],catch_trials), c = c_scheme, edgecolors = e_scheme)
-        ax2.set_xlabel('Psi-stimulus(Deg)')
-        ax2.set_ylabel('Response')
-        ax2.set_title(':'.join([subj_id, 'Performance per stimulus']))
-        ax2.legend(handles = legend_elements, loc = 0, ncol = 4)
-
-        fig.tight_layout()
-
-        plt.rc('legend', fontsize = 'small', handlelength = 2)
-
-        plt.savefig('.'.join([subj_id,'png']), dpi = 300, format = 'png')
-
-        plt.close() 
-
-plot_sub_performance(subj_ids, psi_stim, psi_obj, if_corr, catch_trials, psi_trials)
-
-def plot_sub_performance2(c_dict, labelsize = 20, markersize = 15):
-    subj_ids = [*c_dict]
-
-    for subj_id in subj_ids:
-
-        e_scheme = ['r' if x == 'A' else 'b' for x in psi_obj[subj_id]]
-        c_scheme = ['r' if (x, y) == ('A', 1) else 'b' if (x, y) == ('B', 1) else 'none' for x, y in zip(psi_obj[subj_id], if_corr[subj_id])]
-
-        legend_elements = [Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'r', markeredgecolor = 'r', label = 'A, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'r', label = 'A, Wrong'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'b', markeredgecolor = 'b', label = 'B, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'b', label = 'B, Wrong')]
-
-        signed_stim = [(p - 5)*q for p, q in zip(psi_stim[subj_id], [1 if x == 'A' else -1 for x in psi_obj[subj_id]])]
-        fig, ax1 = plt.subplots(figsize = (12, 6))
-
-        ax1.scatter(range(1, 47), signed_stim, c = c_scheme, edgecolors = e_scheme, label = ['A:1', 'A:0', 'B:1', 'B:0'], s = markersize)
-
-        ax1.legend(handles = legend_elements, loc = 0, ncol = 4)
-
-        ax1.set_xlabel('Trials', fontsize = labelsize)
-        ax1.tick_params(axis="x", labelsize = 20)
-        ax1.set_ylabel('Psi-stimulus(Deg)', fontsize = labelsize) 
-        ax1.tick_params(axis="y", labelsize = 20)
-
-        plt.rc('legend', fontsize = 15, handlelength = 2)
-
-        fig.tight_layout()
-
-        plt.savefig(''.join([subj_id,'_signed.png']), dpi = 300, format = 'png')
+FIGURE_MANIFEST = '.figures.json'
+# Change this whenever the look of the figures changes, so that they are all drawn again
+FIGURE_VERSION = 1
+
+# Legend handles and figures that are reused by the current process, one figure per kind of plot
+legend_handles = list()
+templates = dict()
+
+def pyplot():
+    '''
+    matplotlib.pyplot, imported on first use so that importing this module stays cheap
+    '''
+    import matplotlib.pyplot as plt
+    return plt
+
+def legend_elements():
+    '''
+    The legend handles shared by all the figures, built once
+    '''
+    if not legend_handles:
+        from matplotlib.lines import Line2D
+        legend_handles.extend([Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'r', markeredgecolor = 'r', label = 'A, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'r', label = 'A, Wrong'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'b', markeredgecolor = 'b', label = 'B, Correct'), Line2D([0], [0], marker = 'o', color = 'w', markerfacecolor = 'none', markeredgecolor = 'b', label = 'B, Wrong')])
+    return legend_handles
+
+def point_colors(obj, corr):
+    '''
+    Edge and face colors of the points: red for 'A', blue for 'B', filled if correct
+    '''
+    e_scheme = np.where(obj == PSI_A, 'r', 'b')
+    c_scheme = np.where(corr == 1, e_scheme, 'none')
+    return e_scheme, c_scheme
+
+def subject_data(dataset, row):
+    '''
+    The part of the dataset a subject's figures are drawn from
+    '''
+    psi = dataset['is_psi'][row]
+    catch = dataset['is_catch'][row]
+    return {'subj_id': str(dataset['subj_ids'][row]),
+            'trials': np.flatnonzero(psi),
+            'psi_stim': dataset['psi_stim'][row, psi],
+            'psi_obj': dataset['psi_obj'][row, psi],
+            'if_corr': dataset['if_corr'][row, psi],
+            'catch': np.flatnonzero(catch),
+            'catch_corr': dataset['if_corr'][row, catch],
+            'catch_hit': float(dataset['catch_hit'][row])}
+
+def subject_hash(subj, options = ()):
+    '''
+    sha256 of the subject's data and of the drawing options
+    '''
+    h = hashlib.sha256(repr((FIGURE_VERSION,) + tuple(options)).encode('utf-8'))
+    for key in sorted(subj):
+        h.update(key.encode('utf-8'))
+        if isinstance(subj[key], np.ndarray):
+            h.update(np.ascontiguousarray(subj[key]).tobytes())
+        else:
+            h.update(repr(subj[key]).encode('utf-8'))
+    return h.hexdigest()
+
+def figure_template(kind):
+    '''
+    The figure of this process for 'kind' ('performance' or 'signed'), with cleared axes
+    '''
+    if kind not in templates:
+        if kind == 'performance':
+            fig, axes = pyplot().subplots(nrows = 2, ncols = 1, figsize = (12, 6))
+        else:
+            fig, axes = pyplot().subplots(figsize = (12, 6))
+        templates[kind] = (fig, list(np.atleast_1d(axes)))
+    fig, axes = templates[kind]
+    for ax in axes:
+        ax.clear()
+    return fig, axes
+
+def close_templates():
+    for fig, axes in templates.values():
+        pyplot().close(fig)
+    templates.clear()
+
+def draw_performance(subj, filename):
+    fig, (ax1, ax2) = figure_template('performance')
+    e_scheme, c_scheme = point_colors(subj['psi_obj'], subj['if_corr'])
+
+    ax1.scatter(subj['trials'], subj['psi_stim'], c = c_scheme, edgecolors = e_scheme)
+    ax1.axhline(y=5)
+    linesty = list(np.where(subj['catch_corr'] == 1, 'solid', 'dashed'))
+    ax1.vlines(subj['catch'], ymin=0, ymax=35, colors='g', linestyles=linesty)
+
+    ax1.legend(handles = legend_elements(), loc = 0, ncol = 4, fontsize = 'small', handlelength = 2)
+
+    ax1.set_xlabel('Trials')
+    ax1.set_ylabel('Psi-stimulus(Deg)')
+    ax1.set_title(':'.join([subj['subj_id'], 'Performance per trial / catch_hit rate', str(subj['catch_hit'])]))
+
+    # Plotting for Psychophysical analysis
+    ax2.scatter(subj['psi_stim'], subj['if_corr'], c = c_scheme, edgecolors = e_scheme)
+    ax2.set_xlabel('Psi-stimulus(Deg)')
+    ax2.set_ylabel('Response')
+    ax2.set_title(':'.join([subj['subj_id'], 'Performance per stimulus']))
+    ax2.legend(handles = legend_elements(), loc = 0, ncol = 4, fontsize = 'small', handlelength = 2)
+
+    fig.tight_layout()
+    fig.savefig(filename, dpi = 300, format = os.path.splitext(filename)[1][1:])
+
+def draw_signed(subj, filename, labelsize = 20, markersize = 15):
+    fig, (ax1,) = figure_template('signed')
+    e_scheme, c_scheme = point_colors(subj['psi_obj'], subj['if_corr'])
+    signed_stim = (subj['psi_stim'] - 5) * np.where(subj['psi_obj'] == PSI_A, 1, -1)
+
+    ax1.scatter(np.arange(1, len(signed_stim) + 1), signed_stim, c = c_scheme, edgecolors = e_scheme, s = markersize)
+
+    ax1.legend(handles = legend_elements(), loc = 0, ncol = 4, fontsize = 15, handlelength = 2)
+
+    ax1.set_xlabel('Trials', fontsize = labelsize)
+    ax1.tick_params(axis="x", labelsize = 20)
+    ax1.set_ylabel('Psi-stimulus(Deg)', fontsize = labelsize)
+    ax1.tick_params(axis="y", labelsize = 20)
+
+    fig.tight_layout()
+    fig.savefig(filename, dpi = 300, format = os.path.splitext(filename)[1][1:])
+
+def draw_figure(job):
+    '''
+    Draw one figure; job is (kind, subj, filename, digest, options). Returns (filename, digest)
+    '''
+    kind, subj, filename, digest, options = job
+    if kind == 'performance':
+        draw_performance(subj, filename, *options)
+    else:
+        draw_signed(subj, filename, *options)
+    return filename, digest
+
+def use_agg():
+    pyplot().switch_backend('Agg')
+
+def render_figures(figure_jobs, folder = './', jobs = 1, force = False):
+    '''
+    Draw the figures that are missing or out of date, in parallel if jobs > 1 (None: all the cores)
+
+    Returns the list of the png files that were drawn
+    '''
+    manifest_name = os.path.join(folder, FIGURE_MANIFEST)
+    try:
+        with open(manifest_name, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = dict()
+
+    # A subject ID that is in several files is drawn once, from its last record
+    figure_jobs = dict((job[2], job) for job in figure_jobs).values()
+    todo = [job for job in figure_jobs if force or manifest.get(os.path.basename(job[2])) != job[3] or not os.path.exists(job[2])]
+    drawn = list()
+    try:
+        if todo and (jobs is None or jobs > 1):
+            with ProcessPoolExecutor(jobs, initializer = use_agg) as pool:
+                n_workers = jobs or os.cpu_count() or 1
+                for filename, digest in pool.map(draw_figure, todo, chunksize = max(1, len(todo) // (4 * n_workers))):
+                    manifest[os.path.basename(filename)] = digest
+                    drawn.append(filename)
+        else:
+            for job in todo:
+                filename, digest = draw_figure(job)
+                manifest[os.path.basename(filename)] = digest
+                drawn.append(filename)
+            close_templates()
+    finally:
+        # Whatever was drawn before an interruption is not drawn again
+        if drawn:
+            tmp = manifest_name + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent = 1, sort_keys = True)
+            os.replace(tmp, manifest_name)
+    return drawn
+
+def plot_sub_performance(dataset, folder = './', jobs = 1, force = False, fmt = 'png'):
+
+    figure_jobs = list()
+    # The figures are of the Psi trials: not for the Adaptive-Staircase subjects
+    for row in np.flatnonzero(np.any(dataset['is_psi'], axis = 1)):
+        subj = subject_data(dataset, row)
+        filename = os.path.join(folder, '.'.join([subj['subj_id'], fmt]))
+        figure_jobs.append(('performance', subj, filename, subject_hash(subj), ()))
+    return render_figures(figure_jobs, folder, jobs, force)
+
+def plot_sub_performance2(dataset, subj_ids = None, labelsize = 20, markersize = 15, folder = './', jobs = 1, force = False, fmt = 'png'):
+
+    # The figures are of the Psi trials: not for the Adaptive-Staircase subjects
+    keep = np.any(dataset['is_psi'], axis = 1)
+    if subj_ids is not None:
+        keep &= np.isin(dataset['subj_ids'], subj_ids)
+    rows = np.flatnonzero(keep)
+
+    figure_jobs = list()
+    for row in rows:
+        subj = subject_data(dataset, row)
+        filename = os.path.join(folder, ''.join([subj['subj_id'], '_signed.', fmt]))
+        options = (labelsize, markersize)
+        figure_jobs.append(('signed', subj, filename, subject_hash(subj, options), options))
+    return render_figures(figure_jobs, folder, jobs, force)
+
+def main(argv = None):
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Consolidate the session files of a folder and draw the figures of the subjects')
+    parser.add_argument('folder', nargs = '?', default = './', help = 'folder of the session files')
+    parser.add_argument('--subjects', nargs = '+', default = None, help = 'only these subject IDs')
+    parser.add_argument('--plots', nargs = '*', default = ['performance'], choices = ['performance', 'signed'], help = 'figures to draw (none: only load)')
+    parser.add_argument('--format', default = 'png', help = 'format of the figures (png, pdf, svg...)')
+    parser.add_argument('--out', default = None, help = 'folder of the figures (FOLDER by default)')
+    parser.add_argument('--jobs', type = int, default = None, help = 'number of processes (all the cores by default)')
+    parser.add_argument('--no-cache', dest = 'cache', action = 'store_false', help = 'parse every file again')
+    parser.add_argument('--force', action = 'store_true', help = 'draw the figures that are up to date too')
+    parser.add_argument('--timing', action = 'store_true', help = 'print the time of every stage')
+    args = parser.parse_args(argv)
+
+    out = args.folder if args.out is None else args.out
+    os.makedirs(out, exist_ok = True)
+    timings = list()
+
+    t0 = time.perf_counter()
+    # Only the new or changed files are parsed, the rest comes from the cache
+    dataset = load_dataset(args.folder, jobs = args.jobs, duplicates = 'warn', use_cache = args.cache)
+    if args.subjects is not None:
+        dataset = select_subjects(dataset, args.subjects)
+    timings.append(('load', time.perf_counter() - t0))
+    print('%d subjects from %d files' % (len(dataset['subj_ids']), len(dataset['files'])))
+
+    # Only the subjects whose data changed are drawn again
+    if 'performance' in args.plots:
+        t0 = time.perf_counter()
+        drawn = plot_sub_performance(dataset, folder = out, jobs = args.jobs, force = args.force, fmt = args.format)
+        timings.append(('performance plots (%d drawn)' % len(drawn), time.perf_counter() - t0))
+    if 'signed' in args.plots:
+        t0 = time.perf_counter()
+        drawn = plot_sub_performance2(dataset, folder = out, jobs = args.jobs, force = args.force, fmt = args.format)
+        timings.append(('signed plots (%d drawn)' % len(drawn), time.perf_counter() - t0))
+
+    if args.timing:
+        for label, elapsed in timings:
+            print('%-30s %8.3f s' % (label, elapsed))
+    return dataset
+
+# The worker processes of parse_sessions import this module again,
+# so nothing below may run unless this file is run as a script
+if __name__ == '__main__':
+    main()
 
-        plt.close() 
 '''
 This is just for testing purpose
 
-plot_sub_performance2(c_dict)
+dataset = load_dataset('./')
+plot_sub_performance2(dataset)
 
-from collections import defaultdict
-
-probs = defaultdict(list)
 subjs = ['_'.join(['SUBJ', str(x)]) for x in [121, 125, 144, 141, 147, 149, 161]]
-new_dict = defaultdict(list)
-
-for sbj in subjs:
-    new_dict[sbj].append(c_dict[sbj])
 
-plot_sub_performance2(new_dict, 25, 100)
+plot_sub_performance2(dataset, subjs, 25, 100)
 
-for subj in c_dict.keys():
-    for i in range(len(psi_stim[subj])):
-        if (psi_obj[subj][i] == 'A'):
-            probs[-psi_stim[subj][i]].append(if_corr[subj][i])
-        else:
-            probs[psi_stim[subj][i]].append(if_corr[subj][i])
-
-real_probs = defaultdict(list)
-for key in probs.keys():
-    real_probs[key] = sum(probs[key])/len(probs[key])
-    
-for key, val in real_probs.items():
-    if ((val >= 0.5) and (key < 15.1)):
-        plt.scatter(key, val)
+curve = pooled_curve(dataset)
+keep = (curve['p'] >= 0.5) & (curve['stimulus'] < 15.1)
+pyplot().scatter(curve['stimulus'][keep], curve['p'][keep])
 '''
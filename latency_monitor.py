@@ -0,0 +1,246 @@
+'''
+latency_monitor.py
+
+[Objective]
+Opt-in measurement of how fast the test screens respond
+(TestScreenPM and TestScreenAS of main.py and V2/main.py, and PMTrialScreen of V2/main.py)
+
+Three delays are measured, in milliseconds:
+    - frame: time between two frames of the kivy Clock while a watched screen is shown
+    - response: from the touch-down on a response button (the motion event's own timestamp)
+      to the return of the screen's handler (where_is_your_finger / chk_if_corr)
+    - draw: from the moment the next stimulus is set (change_col_setting)
+      to the first frame drawn after it (the window's on_flip)
+Every delay goes into a histogram (HIST_EDGES_MS); the histograms of a subject
+are saved with the trial data ('subj_latency', next to 'subj_trial_info')
+and started again for the next subject.
+
+With the overlay, the last frame times and delays are shown in a corner of the window.
+
+TrialTimer (always on) stamps every trial record of the test screens (both apps) with monotonic times (time.perf_counter(), s):
+    - 'stimulus_onset(s)': when the stimulus of the trial was shown
+    - 'touch_down(s)' / 'touch_up(s)': from the response touch's own timestamps
+    - 'response_time(s)': touch_down - stimulus_onset
+It only reads clocks and fills dictionaries; nothing is written while the finger is down.
+
+[Usage]
+The monitor is off unless the environment variable PROPRIO_LATENCY is set
+    PROPRIO_LATENCY=record python3 V2/main.py     histograms saved with the trial data
+    PROPRIO_LATENCY=overlay python3 V2/main.py    the same, and the debug overlay
+    (the same for the V1 app, main.py)
+When it is off, every method returns at once and nothing is added to the session file.
+'''
+
+import time
+from bisect import bisect_right
+from collections import deque
+from kivy.clock import Clock
+from kivy.core.window import Window
+from kivy.uix.label import Label
+
+# Upper edges of the histogram bins (ms); the last bin holds everything above
+HIST_EDGES_MS = [1, 2, 4, 8, 12, 16.7, 20, 25, 33.3, 50, 100, 250, 500, 1000]
+MEASURES = ['frame', 'response', 'draw']
+# Frames kept for the overlay
+OVERLAY_FRAMES = 120
+MODES = ['record', 'overlay']
+
+
+def event_time(touch, end = False):
+    '''
+    time.perf_counter() of the start (or the end) of a motion event
+
+    kivy stamps the motion events with time.time() when they are read from the input provider;
+    the difference with the wall clock now is taken off the monotonic clock now
+    '''
+    stamp = touch.time_start
+    if end:
+        stamp = touch.time_end if touch.time_end > 0 else touch.time_update
+    return time.perf_counter() - (time.time() - stamp)
+
+
+class LatencyMonitor(object):
+    '''
+    Histograms of the frame, response and draw delays of the watched screens
+
+    Arguments
+    ---------
+        mode : None / '' (off), 'record' or 'overlay'
+    '''
+    def __init__(self, mode = None):
+        if mode and mode not in MODES:
+            print('PROPRIO_LATENCY should be one of %s, the latency monitor is off' % ', '.join(MODES))
+            mode = None
+        self.enabled = bool(mode)
+        self.overlay = mode == 'overlay'
+        self.label = None
+        self.active = 0
+        self.draw_start = None
+        self.recent = dict((x, deque(maxlen = OVERLAY_FRAMES)) for x in MEASURES)
+        self.reset()
+
+    def reset(self):
+        '''
+        Start the histograms of a new subject
+        '''
+        self.counts = dict((x, [0] * (len(HIST_EDGES_MS) + 1)) for x in MEASURES)
+        self.total = dict((x, 0.0) for x in MEASURES)
+        self.largest = dict((x, 0.0) for x in MEASURES)
+
+    def add(self, measure, ms):
+        self.counts[measure][bisect_right(HIST_EDGES_MS, ms)] += 1
+        self.total[measure] += ms
+        self.largest[measure] = max(self.largest[measure], ms)
+        self.recent[measure].append(ms)
+
+    def watch(self, screen):
+        '''
+        Record the frame times while 'screen' is the current screen
+        '''
+        if not self.enabled:
+            return
+        screen.bind(on_enter = self.start, on_leave = self.stop)
+
+    def start(self, *largs):
+        if self.active == 0:
+            Clock.schedule_interval(self.on_frame, 0)
+            Window.bind(on_flip = self.on_flip)
+            if self.overlay:
+                self.show_overlay()
+        self.active += 1
+
+    def stop(self, *largs):
+        self.active = max(0, self.active - 1)
+        if self.active == 0:
+            Clock.unschedule(self.on_frame)
+            Window.unbind(on_flip = self.on_flip)
+            if self.label is not None:
+                Clock.unschedule(self.update_overlay)
+                Window.remove_widget(self.label)
+                self.label = None
+
+    def on_frame(self, dt):
+        self.add('frame', dt * 1000.0)
+
+    def on_flip(self, *largs):
+        if self.draw_start is not None:
+            self.add('draw', (time.perf_counter() - self.draw_start) * 1000.0)
+            self.draw_start = None
+
+    def response_done(self, touch):
+        '''
+        The handler of the touch 'touch' (a button's last_touch) has returned
+        '''
+        if not self.enabled or touch is None:
+            return
+        self.add('response', (time.perf_counter() - event_time(touch)) * 1000.0)
+
+    def stimulus_set(self):
+        '''
+        The next stimulus has been set; it is 'drawn' at the next on_flip
+        '''
+        if self.enabled:
+            self.draw_start = time.perf_counter()
+
+    def session_fields(self):
+        '''
+        Extra fields of the subject's record in the session file:
+        {'subj_latency': ...} when the monitor is on, nothing otherwise
+        '''
+        if not self.enabled:
+            return {}
+        latency = {'bin_edges_ms': HIST_EDGES_MS}
+        for x in MEASURES:
+            n = sum(self.counts[x])
+            latency[x] = {'counts': list(self.counts[x]), 'n': n, 'mean_ms': self.total[x] / n if n else None, 'max_ms': self.largest[x]}
+        return {'subj_latency': latency}
+
+    def show_overlay(self):
+        self.label = Label(size_hint = (None, None), size = (Window.width / 3.0, 90), pos = (0, Window.height - 90), halign = 'left', valign = 'top', color = (1, 1, 1, 1))
+        self.label.text_size = self.label.size
+        Window.add_widget(self.label)
+        Clock.schedule_interval(self.update_overlay, 0.5)
+
+    def update_overlay(self, dt):
+        lines = list()
+        for x in MEASURES:
+            recent = sorted(self.recent[x])
+            if recent:
+                lines.append('%-8s last %6.1f  median %6.1f  max %6.1f ms' % (x, self.recent[x][-1], recent[len(recent) // 2], recent[-1]))
+            else:
+                lines.append('%-8s -' % x)
+        self.label.text = '\n'.join(lines)
+
+
+class TrialTimer(object):
+    '''
+    Monotonic timestamps of the trials of a screen (see [Objective])
+
+    The screen calls stimulus_onset() when a stimulus is shown, response() when a response
+    button is pressed, and touch_up() from its on_touch_up.
+    The response touch is grabbed by the screen, so that its touch-up is seen
+    even when the screen has been left in the meantime (last trial).
+
+    Arguments
+    ---------
+        timeout : seconds after which a callback waiting for the touch-up (after_touch_up)
+            is called anyway, e.g. if the touch was cancelled
+    '''
+    def __init__(self, timeout = 2.0):
+        self.timeout = timeout
+        self.onset = None
+        self.touch = None
+        self.record = None
+        self.waiting = None
+
+    def stimulus_onset(self, *largs):
+        self.onset = time.perf_counter()
+
+    def response(self, widget, touch):
+        '''
+        Timestamps of the response 'touch' (a button's last_touch), to be put in the trial record;
+        'touch_up(s)' is filled in the record given to watch() once the finger is lifted
+        '''
+        if touch is None:
+            return {'stimulus_onset(s)': self.onset, 'touch_down(s)': None, 'touch_up(s)': None, 'response_time(s)': None}
+        down = event_time(touch)
+        self.touch, self.record = touch, None
+        touch.grab(widget)
+        return {'stimulus_onset(s)': self.onset, 'touch_down(s)': down, 'touch_up(s)': None, 'response_time(s)': None if self.onset is None else down - self.onset}
+
+    def watch(self, record):
+        '''
+        The trial record (dict) that receives the touch-up of the last response
+        '''
+        self.record = record
+
+    def touch_up(self, widget, touch):
+        '''
+        To be called first thing in widget.on_touch_up; True if 'touch' was the response touch
+        '''
+        if touch.grab_current is not widget or touch is not self.touch:
+            return False
+        touch.ungrab(widget)
+        if self.record is not None:
+            self.record['touch_up(s)'] = event_time(touch, end = True)
+        self.touch, self.record = None, None
+        self.call_waiting()
+        return True
+
+    def after_touch_up(self, callback):
+        '''
+        Call 'callback' once the response touch is lifted (at once if it is already),
+        e.g. to write the subject only when its last trial is complete
+        '''
+        self.call_waiting()
+        if self.touch is None:
+            callback()
+        else:
+            self.waiting = callback
+            Clock.schedule_once(self.call_waiting, self.timeout)
+
+    def call_waiting(self, *largs):
+        Clock.unschedule(self.call_waiting)
+        callback, self.waiting = self.waiting, None
+        if callback is not None:
+            callback()
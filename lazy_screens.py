@@ -0,0 +1,115 @@
+'''
+lazy_screens.py
+
+[Objective]
+Screens of the screen manager built on first use instead of all at start
+
+<screen_manager> in the kv files used to create every screen before the first frame:
+the Image widgets of the parameter screens decoding HSCL.jpg and hand_image.png,
+and the layouts of the color screens, while only the calibration screen is shown.
+Here the screens after the first one are only declared (name, id, class of the kv rule);
+a screen is built the first time it is shown (current = name, get_screen(name))
+or the first time another screen reads or sets one of its attributes through the ids
+(self.parent.ids.testsc_pm.handedness.dir = 1), so the rest of the app is unchanged.
+
+Pre-warming: once a screen has been entered, the next 'prewarm' declared screens
+are built ahead, one per frame, while the user is busy with the current screen.
+Widgets can only be made on the main thread, so 'background' means in idle frames, not in a thread.
+
+[Usage]
+class screen_manager(LazyScreenManager) in main.py, and in the kv file:
+    lazy: [("param_screen_one", "paramscone", "ParamInputScreenOne"), ...]
+    prewarm: 1
+    CalibrationScreen:
+        id: calibsc
+        name: "calib_screen"
+'''
+
+from kivy.clock import Clock
+from kivy.factory import Factory
+from kivy.properties import ListProperty, NumericProperty
+from kivy.uix.screenmanager import ScreenManager
+
+# Seconds after the start of a transition before pre-warming, so that the transition stays smooth
+PREWARM_DELAY = 0.1
+
+
+class ScreenStub(object):
+    '''
+    Stands for a declared screen in the manager's ids until it is built;
+    reading or setting any attribute builds the screen and is passed on to it
+    '''
+    def __init__(self, manager, name):
+        object.__setattr__(self, 'manager', manager)
+        object.__setattr__(self, 'name', name)
+
+    def __getattr__(self, attr):
+        return getattr(self.manager.get_screen(self.name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.manager.get_screen(self.name), attr, value)
+
+
+class LazyScreenManager(ScreenManager):
+    '''
+    ScreenManager whose declared screens are built on first use
+
+    Arguments
+    ---------
+        lazy : list of (name, id, class name), the declared screens in the order of the protocol
+
+        prewarm : number of declared screens after the current one built ahead (0: none)
+    '''
+    lazy = ListProperty([])
+    prewarm = NumericProperty(1)
+
+    def __init__(self, **kwargs):
+        super(LazyScreenManager, self).__init__(**kwargs)
+        for name, screen_id, cls_name in self.lazy:
+            self.ids[screen_id] = ScreenStub(self, name)
+        self.fbind('current', self.schedule_prewarm)
+        self.schedule_prewarm()
+
+    def declared(self, name):
+        for entry in self.lazy:
+            if entry[0] == name:
+                return entry
+        return None
+
+    def is_built(self, name):
+        return any(x.name == name for x in self.screens)
+
+    def has_screen(self, name):
+        return self.is_built(name) or self.declared(name) is not None
+
+    def get_screen(self, name):
+        if not self.is_built(name) and self.declared(name) is not None:
+            self.build_screen(name)
+        return super(LazyScreenManager, self).get_screen(name)
+
+    def build_screen(self, name):
+        '''
+        Create the declared screen 'name' (its kv rule is applied) and add it to the manager
+        '''
+        name, screen_id, cls_name = self.declared(name)
+        screen = Factory.get(cls_name)(name = name)
+        self.add_widget(screen)
+        self.ids[screen_id] = screen
+        return screen
+
+    def schedule_prewarm(self, *largs):
+        Clock.unschedule(self.prewarm_next)
+        if self.prewarm > 0:
+            Clock.schedule_once(self.prewarm_next, self.transition.duration + PREWARM_DELAY)
+
+    def prewarm_next(self, dt):
+        '''
+        Build the first screen not built yet among the next 'prewarm' ones, and come back at the next frame
+        '''
+        names = [x[0] for x in self.lazy]
+        start = names.index(self.current) + 1 if self.current in names else 0
+        for name in names[start:start + int(self.prewarm)]:
+            if not self.is_built(name):
+                self.build_screen(name)
+                Clock.schedule_once(self.prewarm_next)
+                return
@@ -0,0 +1,573 @@
+'''
+pm_protocol.py
+
+[Objective]
+The Psi-Marginal test of V2 (TestScreenPM) as a state machine without kivy,
+so that the whole protocol can be run without a window
+
+PMProtocol holds what used to live in the screen's methods:
+    - psi_order: which staircase ('A': 0, 'B': 1) or catch trial (2) every trial is (psi_schedule)
+    - the stimulus shown: false_ref + degree_dir * degree, degree being the staircase's xCurrent
+      (55 - x for 'A', 45 + x for 'B', CATCH_DEGREE for the catch trials)
+    - the restart rules (fucked_up_cnt): a miss in the first three 'A' trials starts again with 'B',
+      a miss in the first three 'B' trials goes back to trial 7, and a second failure ends the test
+    - clearance: the trials of a failed start are removed from the records
+      (the staircase they belong to is made anew the first time, in the background
+      as a speculative job of the compute worker if one is given, see psi_worker.py)
+    - subj_trial_info: the trial records saved with the subject
+TestScreenPM keeps the drawing, the popups, the timing of the buttons and the store,
+and gives every response to respond().
+
+The headless runner plays whole sessions with a responder instead of a subject:
+    - SimulatedResponder: an observer with a Gumbel psychometric function (psi_engine.GenerateData)
+    - ScriptedResponder: a fixed sequence of correct / wrong answers (SCENARIOS: every restart rule)
+Every session is checked (check_session): the trial records against psi_order,
+the shown stimuli against the staircases, and the records replayed through fresh staircases (replay.py).
+
+[Usage]
+python3 pm_protocol.py simulate [--sessions 1000] [--trials 25] [--grid coarse] [--jobs 1] [--seed 0]
+    Sessions of random simulated observers; throughput, outcomes and threshold errors
+    --grid v2 uses the grid of the app (about 2 s to make a staircase, 0.4 s per trial),
+    --grid coarse a 1 deg grid (milliseconds per trial) for the thousands of sessions
+
+python3 pm_protocol.py scenarios [--grid coarse] [--worker]
+    Every scripted scenario once, checked against its expected outcome
+    --worker makes the new staircases of the clearances in the compute worker, as the app does
+
+Both exit with status 1 if a session fails its checks
+'''
+
+import sys
+import copy
+import time
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import psi_engine
+from psi_engine import Psi, GenerateData
+from psi_worker import shared_worker, SPECULATIVE
+
+PSI_TYPE = ['A', 'B']
+# False reference and direction of the slant line of each staircase
+FALSE_REF = [55, 45]
+DEGREE_DIR = [-1, 1]
+# Stimulus of the catch trials
+CATCH_DEGREE = 35.0
+
+# Grids of the staircases run by the headless runner
+GRIDS = {
+    # The grid of V2 (psi_engine.py)
+    'v2': dict(stimRange = psi_engine.stimLevels, threshold = psi_engine.mu, slope = psi_engine.sigma, guessRate = psi_engine.guessRate, lapseRate = psi_engine.lapse),
+    # 1 deg steps, 6 slopes and 4 lapse rates: the same protocol with coarser estimates
+    'coarse': dict(stimRange = np.arange(0.0, 67.0, 1.0), threshold = np.arange(0.0, 67.0, 1.0), slope = np.linspace(0.05, 1, 6), guessRate = psi_engine.guessRate, lapseRate = np.arange(0, 0.1, 0.03)),
+}
+
+# Scripted sessions: correct (1) / wrong (0) answers from the first response on (then always correct),
+# with the expected fucked_up_cnt at the end and the NOTE left in the records
+SCENARIOS = {
+    'all correct': ([], 0, None),
+    'missed a first A trial': ([1, 0, 1], 1, "The participant missed one of the first three A trials"),
+    'missed a first B trial': ([1] * 7 + [1, 0, 1], 1, "The participant missed one of the first three B trials"),
+    'missed the first A and B trials': ([0, 1, 1] + [1, 0, 1], 2, "The participant failed both in the first A and B sets so terminated"),
+    'missed the first A trials twice': ([0, 1, 1] + [1] * 5 + [1, 1, 0], 2, "The participant kept failed on 'A' direction so terminated"),
+    'missed the first B trials twice': ([1] * 7 + [0, 1, 1] + [1] * 5 + [1] + [0, 1, 1], 2, "The participant kept failed on 'B' direction so terminated"),
+}
+
+
+def psi_schedule(nTrials):
+    '''
+    Order of the trials of a test with 'nTrials' trials per staircase
+
+    Returns
+    -------
+    psi_order : 1D ndarray, 0 ('A'), 1 ('B') or 2 (catch) for every trial
+
+    catch : list of the catch trials
+    '''
+    # Catch trials at trial_num = {12, 28, 44}
+    if nTrials == 25:
+        list_a = [range(x, y) for x, y in zip([0, 13, 23, 34, 45], [7, 18, 28, 39, 48])]
+        catch = [12, 28, 44]
+    else:
+        list_a = [range(x, y) for x, y in zip([0, 13, 23, 34, 45, 55, 66, 77, 87, 97], [7, 18, 28, 39, 50, 60, 71, 82, 92, 100])]
+        catch = [12, 28, 44, 60, 76]
+
+    psi_order = np.ones(int(nTrials*2 + np.ceil(nTrials/10)))
+    psi_obj1_trials = [int(item) for sublist in list_a for item in sublist]
+    psi_order[psi_obj1_trials] = 0
+    psi_order[catch] = 2
+    return psi_order, catch
+
+def correct_answer(visual, theta = 50, finger_dir = 1):
+    '''
+    Correct response to a slant line at 'visual' degrees from the horizontal,
+    the finger being at 'theta' degrees (as chosen from the geometry of the ColorScreen)
+
+    finger_dir: 1 for the right hand, -1 for the left hand
+    '''
+    if finger_dir == 1:
+        return "left" if visual > theta else "right"
+    return "left" if visual < theta else "right"
+
+
+class PMProtocol(object):
+    '''
+    State of the Psi-Marginal test of one subject (see [Objective])
+
+    Arguments
+    ---------
+        staircases : the 'A' and 'B' staircases (Psi objects)
+
+        psi_order, catch : the order of the trials (psi_schedule)
+
+        psi_nTrials : trials per staircase
+
+        make_staircase : function returning a new staircase, for the clearance of a failed start
+
+        worker : PsiWorker making that staircase in the background, so that the screen does not freeze
+            (None: at once); the test only waits for it when it is the staircase of the next trial
+    '''
+    def __init__(self, staircases, psi_order, catch, psi_nTrials, make_staircase, worker = None):
+        self.psi = list(staircases)
+        self.psi_order = np.array(psi_order)
+        self.catch = list(catch)
+        self.psi_nTrials = psi_nTrials
+        self.make_staircase = make_staircase
+        self.worker = worker
+        # The jobs making the new 'A' and 'B' staircases, until they are taken
+        self.pending = [None, None]
+
+        # check the trial number(within a session)
+        self.trial_num = 0
+        self.psi_stims = list()
+        self.subj_trial_info = {}
+        # Answers of the trials of each staircase, to check the first three
+        self.first_few = {'A': list(), 'B': list()}
+        # index of fucking up...
+        self.fucked_up = False
+        # fucked_up counts
+        self.fucked_up_cnt = 0
+        self.right_or_wrong = None
+        self.done = False
+
+        # The first stimulus is from 'A'
+        self.false_ref = FALSE_REF[0]
+        self.degree_dir = DEGREE_DIR[0]
+        self.degree = float(self.psi[0].xCurrent)
+
+    def visual_stimulus(self):
+        '''
+        Angle of the slant line shown (deg)
+        '''
+        return self.false_ref + self.degree_dir * self.degree
+
+    def staircase(self, kind):
+        '''
+        The staircase 'kind' (0: 'A', 1: 'B'), once the new one of a clearance is made
+        '''
+        job = self.pending[kind]
+        if job is not None:
+            self.pending[kind] = None
+            # The old staircase is kept if making the new one failed (the error is printed)
+            if job.wait() is not None:
+                self.psi[kind] = job.result
+        return self.psi[kind]
+
+    def show(self, kind):
+        '''
+        Next stimulus from the staircase 'kind' (0: 'A', 1: 'B')
+        '''
+        self.degree = float(self.staircase(kind).xCurrent)
+        self.false_ref = FALSE_REF[kind]
+        self.degree_dir = DEGREE_DIR[kind]
+
+    def respond(self, rel_pos, correct_ans):
+        '''
+        Record the response 'rel_pos' ("left" / "right") to the stimulus shown and move to the next one
+
+        Returns True if a failed start made the test start again (the screen tells the subject)
+        '''
+        restarted = self.save_trial(rel_pos, correct_ans)
+
+        # If You are on the final trial, the test is over
+        # Short version: self.psi_nTrials*2 + 3(catch trials)
+        # Long version: self.psi_nTrials*2 + 5(catchtrials)
+        if self.trial_num == len(self.psi_order)-1 or self.fucked_up_cnt == 2:
+            self.done = True
+        elif self.fucked_up:
+            if len(self.first_few['A']) == 0:
+                self.show(1)
+            elif len(self.first_few['B']) == 0:
+                self.show(0)
+            # Fucked up status checked
+            self.fucked_up = not(self.fucked_up)
+        else:
+            kind = int(self.psi_order[self.trial_num])
+            next_kind = int(self.psi_order[self.trial_num + 1])
+            if kind in [0, 1]:
+                self.staircase(kind).addData(self.right_or_wrong)
+                # Wait until calculation is complete
+                self.psi[kind].wait()
+                if next_kind == 2:
+                    self.degree = CATCH_DEGREE
+                elif next_kind != kind:
+                    self.show(next_kind)
+                else:
+                    self.degree = float(self.psi[kind].xCurrent)
+            elif next_kind in [0, 1]:
+                self.show(next_kind)
+            self.trial_num += 1
+
+        return restarted
+
+    def failed_start(self, kind):
+        '''
+        Any miss in the first three trials of the staircase 'kind' ('A' or 'B')
+        '''
+        return any([x == 0 for x in self.first_few[kind][0:3]])
+
+    def save_trial(self, rel_pos, correct_ans):
+        self.psi_stims.append(self.degree)
+
+        # Compare if the response is correct
+        self.right_or_wrong = int(rel_pos == correct_ans)
+
+        # saving the response for the current psi direction: 'A' or 'B'
+        # Don't do this for the catch trials
+        if int(self.psi_order[self.trial_num]) in [0,1]:
+            self.first_few[PSI_TYPE[int(self.psi_order[self.trial_num])]].append(self.right_or_wrong)
+
+        restarted = False
+        if self.fucked_up_cnt == 1:
+            ## If you have failed in the first 7 'A' trials and fail again in 'B' trials,
+            ## erase all those 5 trials and just stop it...
+            if self.trial_num == 2 and self.failed_start('B'):
+                self.clearance(2, "The participant failed both in the first A and B sets so terminated")
+                self.fucked_up_cnt += 1
+            ## If you have failed in the first 7 'A' trials, passed the new 5 'B' trials,
+            ## and again failed on the following 7 'A' trials, you are done.
+            elif self.trial_num == 7 and self.failed_start('A'):
+                self.clearance(7, "The participant kept failed on 'A' direction so terminated")
+                self.fucked_up_cnt += 1
+            ## If you passed the first 7 'A' trials, failed on 'B', passed another 5 'A' trials, and then
+            ## fail on B again, you are done.
+            elif self.trial_num == 15 and self.failed_start('B'):
+                self.clearance(15, "The participant kept failed on 'B' direction so terminated")
+                self.fucked_up_cnt += 1
+            else:
+                self.record(rel_pos, correct_ans)
+
+        elif self.fucked_up_cnt == 0:
+            ## If a user fails in any of the first 3 'A' trials,
+            ## erase all those 3 trials and begin anew with 'B' trials
+            if self.trial_num == 2 and self.failed_start('A'):
+                self.clearance(2, "The participant missed one of the first three A trials", restart = True)
+                # Start again from B
+                self.trial_num = 0
+                self.fucked_up_cnt += 1
+                list_a = [range(x, y) for x, y in zip([5, 18, 29, 39, 50], [12, 23, 34, 44, 53])]
+                psi_obj1_trials = [int(item) for sublist in list_a for item in sublist]
+                # Psi-order should be renewed
+                psi_order = np.ones(int(self.psi_nTrials*2 + np.ceil(self.psi_nTrials/10)))
+                psi_order[psi_obj1_trials] = 0
+                psi_order[self.catch] = 2
+                self.psi_order = psi_order
+                ## Fucked up status turns on
+                self.fucked_up = True
+                # Previous record removed
+                self.first_few['A'] = []
+                restarted = True
+
+            ## If you have passed the first 7 'A' trials, but fail in the first 3
+            ## 'B' trials, then erase those 'B' trials and continue with the 'A' trials
+            elif self.trial_num == 9 and self.failed_start('B'):
+                self.clearance([7, 9], "The participant missed one of the first three B trials", restart = True)
+                # Return to the point where the participant was still okay.
+                self.trial_num = 7
+                self.fucked_up_cnt += 1
+                list_a = [range(x, y) for x, y in zip([7, 18, 29, 45], [12, 23, 34, 48])]
+                psi_obj1_trials = [int(item) for sublist in list_a for item in sublist]
+                psi_order = np.concatenate((self.psi_order[0:7], np.ones(len(self.psi_order) - 7)))
+                psi_order[psi_obj1_trials] = 0
+                psi_order[self.catch] = 2
+                self.psi_order = psi_order
+                self.fucked_up = True
+                self.first_few['B'] = []
+                restarted = True
+
+            ## If you see no issue, go save your trial info!
+            self.record(rel_pos, correct_ans)
+
+        return restarted
+
+    def record(self, rel_pos, correct_ans):
+        '''
+        Trial record of the response, under the current trial number
+        '''
+        kind = int(self.psi_order[self.trial_num])
+        if kind == 2:
+            trial = {'trial_num': self.trial_num, 'Visual_stimulus(deg)': self.visual_stimulus(), 'correct_ans': correct_ans, 'response': rel_pos, 'response_correct': self.right_or_wrong}
+        else:
+            trial = {'trial_num': self.trial_num, 'Psi_obj': PSI_TYPE[kind], 'Psi_stimulus(deg)': self.degree, 'Visual_stimulus(deg)': self.visual_stimulus(), 'correct_ans': correct_ans, 'response': rel_pos, 'response_correct': self.right_or_wrong}
+        self.subj_trial_info["_".join(["TRIAL", str(self.trial_num)])] = trial
+
+    def last_record(self):
+        '''
+        The record under the current trial number, if any
+        '''
+        return self.subj_trial_info.get("_".join(["TRIAL", str(self.trial_num)]))
+
+    def clearance(self, n, msg, restart = False):
+        '''
+        Remove the trial records range(n[0], n[1]) ('B' trials) or range(n) ('A' trials),
+        and make that staircase anew if 'restart'; msg is the NOTE saved with the records
+        '''
+        kind = 1 if type(n) is list else 0
+        for i in (range(n[0], n[1]) if kind == 1 else range(n)):
+            self.subj_trial_info.pop("_".join(["TRIAL", str(i)]), None)
+        if restart and self.worker is None:
+            self.psi[kind] = self.make_staircase()
+        elif restart:
+            # Whatever is still computed for the old staircase is dropped
+            self.worker.supersede(self.psi[kind])
+            self.worker.supersede((self, kind))
+            self.pending[kind] = self.worker.submit((self, kind), self.make_staircase, priority = SPECULATIVE)
+
+        self.subj_trial_info["NOTE"] = msg
+
+    def close(self):
+        '''
+        The test is over: cancel the jobs still queued or running for its staircases
+        '''
+        if self.worker is not None:
+            for kind in [0, 1]:
+                self.worker.supersede((self, kind))
+                self.worker.supersede(self.psi[kind])
+            self.pending = [None, None]
+
+    def performance(self):
+        '''
+        Mean of the last 11 stimuli shown, from the finger (5 deg)
+        '''
+        return np.mean(np.array(self.psi_stims[-11:])) - 5.0
+
+
+class SimulatedResponder(object):
+    '''
+    An observer whose answers are correct with the probability of a Gumbel psychometric function
+    of the stimulus shown (psi_engine.GenerateData)
+
+    Arguments
+    ---------
+        threshold, slope, guessRate, lapseRate : parameters of the psychometric function
+
+        rng : numpy Generator of the answers
+    '''
+    def __init__(self, threshold, slope, guessRate = 0.5, lapseRate = 0.02, rng = None):
+        self.parameters = [threshold, slope, guessRate, lapseRate]
+        self.rng = np.random.default_rng() if rng is None else rng
+
+    def __call__(self, protocol, correct_ans):
+        correct = GenerateData(np.array([self.parameters + [protocol.degree]]), psyfun = 'Gumbel', rng = self.rng)[0]
+        return correct_ans if correct else wrong_answer(correct_ans)
+
+
+class ScriptedResponder(object):
+    '''
+    Answers correct (1) or wrong (0) as in 'script', then always correct
+    '''
+    def __init__(self, script):
+        self.script = list(script)
+        self.n = 0
+
+    def __call__(self, protocol, correct_ans):
+        correct = self.script[self.n] if self.n < len(self.script) else 1
+        self.n += 1
+        return correct_ans if correct else wrong_answer(correct_ans)
+
+
+def wrong_answer(correct_ans):
+    return "right" if correct_ans == "left" else "left"
+
+def new_staircase(prototype):
+    '''
+    A staircase with no trials, as 'prototype' (a Psi with no trials) was made;
+    the likelihood and prior arrays are shared, the trials are not
+    '''
+    psi_obj = copy.copy(prototype)
+    psi_obj.stim = list()
+    psi_obj.response = list()
+    return psi_obj
+
+def make_prototype(grid = 'coarse', nTrials = 25):
+    '''
+    Staircase of 'grid' (GRIDS) with uniform priors, as the app makes them,
+    computing the next stimulus in the calling thread
+    '''
+    return Psi(Pfunction = 'Gumbel', nTrials = nTrials, thresholdPrior = ('uniform', None), slopePrior = ('uniform', None), guessPrior = ('uniform', None), lapsePrior = ('uniform', None), marginalize = True, thread = False, **GRIDS[grid])
+
+def run_session(prototype, responder, nTrials = 25, theta = 50, finger_dir = 1, max_responses = 1000, worker = None, session = None):
+    '''
+    One test of 'responder' (called with the protocol and the correct answer, returns "left" / "right");
+    worker: see PMProtocol
+
+    session: ExperimentSession (experiment_session.py) with a subject, the test runs on its staircases
+    (and its worker) and the subject is saved at the end, as in the app
+
+    Returns the PMProtocol at the end of the test
+    '''
+    psi_order, catch = psi_schedule(nTrials)
+    if session is None:
+        protocol = PMProtocol([new_staircase(prototype), new_staircase(prototype)], psi_order, catch, nTrials, partial(new_staircase, prototype), worker)
+    else:
+        session.set_staircases([new_staircase(prototype), new_staircase(prototype)])
+        protocol = session.start_test(psi_order, catch, nTrials, partial(new_staircase, prototype))
+    n = 0
+    while not protocol.done:
+        if n == max_responses:
+            raise RuntimeError('the test did not end after %d responses' % max_responses)
+        correct_ans = correct_answer(protocol.visual_stimulus(), theta, finger_dir)
+        protocol.respond(responder(protocol, correct_ans), correct_ans)
+        n += 1
+    if session is None:
+        protocol.close()
+    else:
+        session.save(protocol.subj_trial_info)
+        session.close()
+    return protocol
+
+def check_session(protocol, prototype):
+    '''
+    Problems found in the records of a finished test (empty list: none)
+        - every record is under its own trial number, within psi_order
+        - a catch trial shows the catch stimulus, a Psi trial the stimulus of its staircase
+        - a test that was not terminated has a record for every trial,
+          and its records replay exactly through fresh staircases (replay.py)
+    '''
+    # replay imports json_processing, which is only needed here
+    from replay import replay_subject
+
+    problems = list()
+    trials = dict((key, x) for key, x in protocol.subj_trial_info.items() if key != 'NOTE')
+    for key, trial in trials.items():
+        num = trial['trial_num']
+        if key != "TRIAL_%d" % num or not 0 <= num < len(protocol.psi_order):
+            problems.append('%s: trial_num %s' % (key, num))
+            continue
+        if 'Psi_obj' in trial:
+            kind = PSI_TYPE.index(trial['Psi_obj'])
+            expected = FALSE_REF[kind] + DEGREE_DIR[kind] * trial['Psi_stimulus(deg)']
+        else:
+            expected = [FALSE_REF[x] + DEGREE_DIR[x] * CATCH_DEGREE for x in [0, 1]]
+        if trial['Visual_stimulus(deg)'] not in np.atleast_1d(expected):
+            problems.append('%s: visual stimulus %s' % (key, trial['Visual_stimulus(deg)']))
+        if trial['correct_ans'] not in ['left', 'right'] or trial['response_correct'] != int(trial['response'] == trial['correct_ans']):
+            problems.append('%s: response' % key)
+
+    if protocol.fucked_up_cnt < 2:
+        for num, kind in enumerate(protocol.psi_order):
+            trial = trials.get("TRIAL_%d" % num)
+            if trial is None:
+                problems.append('TRIAL_%d missing' % num)
+            elif (kind == 2) != ('Psi_obj' not in trial) or (kind != 2 and trial['Psi_obj'] != PSI_TYPE[int(kind)]):
+                problems.append('TRIAL_%d is not a %s trial' % (num, 'catch' if kind == 2 else PSI_TYPE[int(kind)]))
+        if not problems:
+            mismatches = replay_subject(protocol.subj_trial_info, partial(new_staircase, prototype))['mismatches']
+            if mismatches:
+                problems.append('%d trials not reproduced by replay' % mismatches)
+    return problems
+
+def outcome(protocol):
+    if protocol.fucked_up_cnt == 2:
+        return 'terminated'
+    if protocol.fucked_up_cnt == 1:
+        return 'restarted'
+    return 'completed'
+
+def simulate_sessions(n_sessions, nTrials = 25, grid = 'coarse', seed = 0, check = True):
+    '''
+    'n_sessions' tests of simulated observers, with random thresholds (2 to 20 deg) and slopes of the grid
+
+    Returns one dict per session: outcome, true and estimated thresholds ('A' and 'B'), problems
+    '''
+    rng = np.random.default_rng(seed)
+    prototype = make_prototype(grid, nTrials)
+    results = list()
+    for i in range(n_sessions):
+        threshold = rng.uniform(2.0, 20.0)
+        slope = rng.choice(GRIDS[grid]['slope'])
+        protocol = run_session(prototype, SimulatedResponder(threshold, slope, rng = rng), nTrials)
+        results.append({'outcome': outcome(protocol), 'threshold': threshold,
+                        # (a staircase without trials has no estimate yet)
+                        'eThreshold': [float(x.eThreshold) if hasattr(x, 'eThreshold') else None for x in protocol.psi],
+                        'responses': len(protocol.psi_stims),
+                        'problems': check_session(protocol, prototype) if check else []})
+    return results
+
+def run_scenarios(grid = 'coarse', nTrials = 25, worker = None):
+    '''
+    Every scripted scenario (SCENARIOS) once (worker: see PMProtocol)
+
+    Returns (name, protocol, problems) per scenario
+    '''
+    prototype = make_prototype(grid, nTrials)
+    results = list()
+    for name, (script, fucked_up_cnt, note) in SCENARIOS.items():
+        protocol = run_session(prototype, ScriptedResponder(script), nTrials, worker = worker)
+        problems = check_session(protocol, prototype)
+        if protocol.fucked_up_cnt != fucked_up_cnt:
+            problems.append('fucked_up_cnt %d, expected %d' % (protocol.fucked_up_cnt, fucked_up_cnt))
+        if protocol.subj_trial_info.get('NOTE') != note:
+            problems.append('NOTE %r' % protocol.subj_trial_info.get('NOTE'))
+        results.append((name, protocol, problems))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Headless runs of the Psi-Marginal protocol of V2')
+    parser.add_argument('run', choices = ['simulate', 'scenarios'])
+    parser.add_argument('--sessions', type = int, default = 1000)
+    parser.add_argument('--trials', type = int, default = 25, choices = [25, 50], help = 'trials per staircase')
+    parser.add_argument('--grid', default = 'coarse', choices = sorted(GRIDS))
+    parser.add_argument('--jobs', type = int, default = 1, help = 'processes (simulate)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-check', action = 'store_true', help = 'simulate: only the throughput, without check_session')
+    parser.add_argument('--worker', action = 'store_true', help = 'scenarios: make the new staircases in the compute worker')
+    args = parser.parse_args()
+
+    if args.run == 'scenarios':
+        n_bad = 0
+        for name, protocol, problems in run_scenarios(args.grid, args.trials, shared_worker() if args.worker else None):
+            print('%-34s %-10s %3d responses, %3d records %s' % (name, outcome(protocol), len(protocol.psi_stims), len(protocol.subj_trial_info), 'ok' if not problems else '; '.join(problems)))
+            n_bad += bool(problems)
+        sys.exit(1 if n_bad else 0)
+
+    # One chunk of sessions per process, each with its own seed and prototype
+    jobs = max(1, args.jobs)
+    sizes = [args.sessions // jobs + (i < args.sessions % jobs) for i in range(jobs)]
+    t0 = time.perf_counter()
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers = jobs) as pool:
+            chunks = list(pool.map(simulate_sessions, sizes, [args.trials] * jobs, [args.grid] * jobs, [args.seed + i for i in range(jobs)], [not args.no_check] * jobs))
+    else:
+        chunks = [simulate_sessions(sizes[0], args.trials, args.grid, args.seed, not args.no_check)]
+    elapsed = time.perf_counter() - t0
+    results = [x for chunk in chunks for x in chunk]
+
+    n_responses = sum(x['responses'] for x in results)
+    print('%d sessions (%d responses) in %.2f s: %.0f sessions/min, %.0f responses/s, grid %s' % (len(results), n_responses, elapsed, 60.0 * len(results) / elapsed, n_responses / elapsed, args.grid))
+    for name in ['completed', 'restarted', 'terminated']:
+        print('    %-10s %d' % (name, sum(1 for x in results if x['outcome'] == name)))
+    finished = [x for x in results if x['outcome'] != 'terminated']
+    for i, kind in enumerate(PSI_TYPE):
+        errors = np.array([x['eThreshold'][i] - x['threshold'] for x in finished if x['eThreshold'][i] is not None])
+        if len(errors):
+            print('    threshold error %s: mean %+.2f deg, RMS %.2f deg' % (kind, errors.mean(), np.sqrt(np.mean(errors**2))))
+    bad = [x for x in results if x['problems']]
+    for x in bad[:10]:
+        print('    ' + '; '.join(x['problems']))
+    print('%d sessions with problems' % len(bad))
+    sys.exit(1 if bad else 0)
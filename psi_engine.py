@@ -0,0 +1,947 @@
+'''
+psi_engine.py
+
+[Objective]
+The Psi-marginal staircase used by the apps (main.py and V2/main.py),
+in a module of its own so that it can also be used without kivy,
+e.g. to refit the recorded sessions offline
+
+[Contents]
+    - erfc: NumPy version of the SciPy function the engine used
+      (use_scipy() or PSI_ENGINE_SCIPY=1 switches to SciPy's own, if it is installed)
+    - cartesian, pf, Psi: the staircase itself
+    - GenerateData: simulated responses of an observer (pm_protocol.py)
+      (Psi.plot imports matplotlib when it is called, so the apps never load it)
+    - stimLevels, mu, sigma, lapse, guessRate: the grid of the V2 protocol
+    - PsiGrid, refit_posteriors: the posteriors of many recorded staircases at once
+    - bootstrap_thresholds: confidence intervals of their thresholds
+'''
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from psi_worker import shared_worker, checkpoint, CURRENT
+
+def cartesian(arrays, out=None):
+    """Generate a cartesian product of input arrays.
+
+    Parameters
+    -----------------
+    arrays: list of array-like
+        1-D arrays to form the cartesian product of.
+    out: ndarray
+        Array to place the cartesian product in.
+
+    Returns
+    -----------------
+    out: ndarray
+        2-D array of shape (M, len(arrays)) containing cartesian products
+        formed of input arrays.
+
+    """
+    arrays = [np.asarray(x) for x in arrays]
+    shape = (len(x) for x in arrays)
+    dtype = arrays[0].dtype
+
+    ix = np.indices(shape)
+    ix = ix.reshape(len(arrays), -1).T
+
+    if out is None:
+        out = np.empty_like(ix, dtype = dtype)
+
+    for n, arr in enumerate(arrays):
+        out[:, n] = arrays[n][ix[:,n]]
+
+    return out
+
+# erfc is NumPy code, so that the apps do not need SciPy;
+# SciPy's own is used instead only when asked for (use_scipy(), or PSI_ENGINE_SCIPY=1)
+# and installed. test_psi_engine.py checks that both give the same numbers (benchmark.py engine times them).
+SCIPY = None
+
+# Rational approximations of erf / erfc (Cephes, ndtr.c, as in SciPy), highest degree first
+ERF_T = [9.60497373987051638749E0, 9.00260197203842689217E1, 2.23200534594684319226E3, 7.00332514112805075473E3, 5.55923013010394962768E4]
+ERF_U = [1.0, 3.35617141647503099647E1, 5.21357949780152679795E2, 4.59432382970980127987E3, 2.26290000613890934246E4, 4.92673942608635921086E4]
+ERFC_P = [2.46196981473530512524E-10, 5.64189564831068821977E-1, 7.46321056442269912687E0, 4.86371970985681366614E1, 1.96520832956077098242E2,
+          5.26445194995477358631E2, 9.34528527171957607540E2, 1.02755188689515710272E3, 5.57535335369399327526E2]
+ERFC_Q = [1.0, 1.32281951154744992508E1, 8.67072140885989742329E1, 3.54937778887819891062E2, 9.75708501743205489753E2,
+          1.82390916687909736289E3, 2.24633760818710981792E3, 1.65666309194161350182E3, 5.57535340817727675546E2]
+ERFC_R = [5.64189583547755073984E-1, 1.27536670759978104416E0, 5.01905042251180477414E0, 6.16021097993053585195E0, 7.40974269950448939160E0, 2.97886665372100240670E0]
+ERFC_S = [1.0, 2.26052863220117276590E0, 9.39603524938001434673E0, 1.20489539808096656605E1, 1.70814450747565897222E1, 9.60896809063285878198E0, 3.36907645100081516050E0]
+
+
+def use_scipy(flag=True):
+    """Compute erfc with SciPy (flag=False: with NumPy again).
+
+    Returns True if SciPy is used from now on, False if it is not installed
+    """
+    global SCIPY
+    SCIPY = None
+    if not flag:
+        return False
+    try:
+        import scipy.special
+    except ImportError:
+        print('SciPy is not installed, psi_engine uses its NumPy functions')
+        return False
+    SCIPY = scipy
+    return True
+
+def erfc(x):
+    """Complementary error function of an array, 1 - erf(x), to double precision."""
+    if SCIPY is not None:
+        return SCIPY.special.erfc(x)
+    x = np.asarray(x, dtype=np.float64)
+    a = np.abs(x)
+    # Each branch is computed everywhere, on arguments clipped to where it can be evaluated
+    # |x| < 1: 1 - erf(x), erf(x) = x T(x^2) / U(x^2)
+    z = np.minimum(x * x, 1.0)
+    small = 1.0 - x * np.polyval(ERF_T, z) / np.polyval(ERF_U, z)
+    # |x| >= 1: exp(-x^2) P(|x|) / Q(|x|) (R / S above 8), 2 - that for x < 0; exp(-x^2) is 0 above 27.3
+    c = np.minimum(a, 30.0)
+    large = np.exp(-x * x) * np.where(c < 8.0, np.polyval(ERFC_P, c) / np.polyval(ERFC_Q, c), np.polyval(ERFC_R, c) / np.polyval(ERFC_S, c))
+    large = np.where(x < 0, 2.0 - large, large)
+    return np.where(a < 1.0, small, large)
+
+if os.environ.get('PSI_ENGINE_SCIPY'):
+    use_scipy()
+
+"""
+Copyright © 2016, N. Niehof, Radboud University Nijmegen
+
+PsiMarginal is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PsiMarginal is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PsiMarginal. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+def pf(parameters, psyfun='cGauss'):
+    """Generate conditional probabilities from psychometric function.
+
+    Arguments
+    ---------
+        parameters: ndarray (float64) containing parameters as columns
+            mu   : threshold
+
+            sigma    : slope
+
+            gamma   : guessing rate (optional), default is 0.2
+
+            lambda  : lapse rate (optional), default is 0.04
+
+            x       : stimulus intensity
+
+        psyfun  : type of psychometric function.
+                'cGauss' cumulative Gaussian
+
+                'Gumbel' Gumbel, aka log Weibull
+
+    Returns
+    -------
+    1D-array of conditional probabilities p(response | mu,sigma,gamma,lambda,x)
+    """
+
+    # Unpack parameters
+    if np.size(parameters, 1) == 5:
+        [mu, sigma, gamma, llambda, x] = np.transpose(parameters)
+    elif np.size(parameters, 1) == 4:
+        [mu, sigma, llambda, x] = np.transpose(parameters)
+        gamma = llambda
+    elif np.size(parameters, 1) == 3:
+        [mu, sigma, x] = np.transpose(parameters)
+        gamma = 0.2
+        llambda = 0.04
+    else:  # insufficient number of parameters will give a flat line
+        psyfun = None
+        gamma = 0.2
+        llambda = 0.04
+    # Psychometric function
+    ones = np.ones(np.shape(mu))
+    if psyfun == 'cGauss':
+        # F(x; mu, sigma) = Normcdf(mu, sigma) = 1/2 * erfc(-sigma * (x-mu) /sqrt(2))
+        z = np.divide(np.subtract(x, mu), sigma)
+        p = 0.5 * erfc(-z / np.sqrt(2))
+    elif psyfun == 'Gumbel':
+        # F(x; mu, sigma) = 1 - exp(-10^(sigma(x-mu)))
+        p = ones - np.exp(-np.power((np.multiply(ones, 10.0)), (np.multiply(sigma, (np.subtract(x, mu))))))
+    elif psyfun == 'Weibull':
+        # F(x; mu, sigma)
+        p = 1 - np.exp(-(np.divide(x, mu)) ** sigma)
+    else:
+        # flat line if no psychometric function is specified
+        p = np.ones(np.shape(mu))
+    y = gamma + np.multiply((ones - gamma - llambda), p)
+    return y
+
+def GenerateData(parameters, psyfun='cGauss', ntrials=None, rng=None):
+    """Generate conditional probabilities from psychometric function.
+
+    Arguments
+    ---------
+        parameters: [1,4] or [1,5] ndarray (float64) containing parameters as columns
+            mu   : threshold
+
+            sigma    : slope
+
+            gamma   : guessing rate (optional), default is 0.2
+
+            lambda  : lapse rate (optional), default is 0.04, if not present we assume lambda = gamma
+
+            x       : stimulus intensity
+
+        psyfun  : type of psychometric function.
+                'cGauss' cumulative Gaussian
+
+                'Gumbel' Gumbel, aka log Weibull
+
+        ntrials : number of trials we want to simulate, default is a single scalar
+
+        rng : numpy Generator / RandomState to sample from, default is np.random
+
+    Returns
+    -------
+    scalar (ntrials=None) or 1D array of bernoulli variables sampled with probability p(r/mu,sigma,gamma,lambda,x)
+    """
+    lik = pf(parameters, psyfun=psyfun)
+    r = (np.random if rng is None else rng).binomial(1, lik, ntrials)
+    return r
+
+class Psi:
+    """Find the stimulus intensity with minimum expected entropy for each trial, to determine the psychometric function.
+
+    Psi adaptive staircase procedure for use in psychophysics.
+
+    Arguments
+    ---------
+        stimRange :
+            range of possible stimulus intensities.
+
+        Pfunction (str) : type of psychometric function to use.
+            'cGauss' cumulative Gaussian
+
+            'Gumbel' Gumbel, aka log Weibull
+
+        nTrials :
+            number of trials
+
+        threshold :
+            (alpha) range of possible threshold values to search
+
+        thresholdPrior (tuple) : type of prior probability distribution to use.
+            Also: slopePrior, guessPrior, lapsePrior.
+
+            ('normal',0,1): normal distribution, mean and standard deviation.
+
+            ('uniform',None) : uniform distribution, mean and standard deviation not defined.
+
+        slope :
+            (sigma) range of possible slope values to search
+
+        slopePrior :
+            see thresholdPrior
+
+        guessRate :
+            (gamma) range of possible guessing rate values to search
+
+        guessPrior :
+            see thresholdPrior
+
+        lapseRate :
+            (lambda) range of possible lapse rate values to search
+
+        lapsePrior :
+            see thresholdPrior
+
+        marginalize (bool) :
+            If True, marginalize out the lapse rate and guessing rate before finding the stimulus
+            intensity of lowest expected entropy. This uses the Prins (2013) method to include the guessing and lapse rate
+            into the probability disctribution. These rates are then marginalized out, and only the threshold and slope are included
+            in selection of the stimulus intensity.
+
+            If False, lapse rate and guess rate are included in the selection of stimulus intensity.
+
+        thread (bool) :
+            If True, addData computes the next stimulus as a job of the shared compute worker (psi_worker.py)
+            and returns at once; if False, in the calling thread.
+
+    How to use
+    ----------
+        Create a psi object instance with all relevant arguments. Selecting a correct search space for the threshold,
+        slope, guessing rate and lapse rate is important for the psi procedure to function well. If an estimate for
+        one of the parameters ends up at its (upper or lower) limit, the result is not reliable, and the procedure
+        should be repeated with a larger search range for that parameter.
+
+        Example:
+            >>> s   = range(-5,5) # possible stimulus intensities
+            obj = Psi(s)
+
+        The stimulus intensity to be used in the current trial can be found in the field xCurrent.
+
+        Example:
+            >>> stim = obj.xCurrent
+        NOTE: if obj.xCurrent returns None, the calculation is not yet finished.
+        wait() returns it once it is:
+            >>> stim = obj.wait()
+
+        After each trial, update the psi staircase with the subject response, by calling the addData method.
+
+        Example:
+            >>> obj.addData(resp)
+    """
+
+    def __init__(self, stimRange, Pfunction='cGauss', nTrials=50, threshold=None, thresholdPrior=('uniform', None),
+                 slope=None, slopePrior=('uniform', None),
+                 guessRate=None, guessPrior=('uniform', None), lapseRate=None, lapsePrior=('uniform', None),
+                 marginalize=True, thread=True):
+
+        # Psychometric function parameters
+        self.stimRange = stimRange  # range of stimulus intensities
+        self.version = 1.0
+        self.threshold = np.arange(-10, 10, 0.1)
+        self.slope = np.arange(0.005, 20, 0.1)
+        self.guessRate = np.arange(0.0, 0.11, 0.05)
+        self.lapseRate = np.arange(0.0, 0.11, 0.05)
+        self.marginalize = marginalize  # marginalize out nuisance parameters gamma and lambda?
+        self.psyfun = Pfunction
+        self.thread = thread
+        # the worker job computing the next stimulus (thread=True)
+        self.job = None
+
+        if threshold is not None:
+            self.threshold = threshold
+            if np.shape(self.threshold) == ():
+                self.threshold = np.expand_dims(self.threshold, 0)
+        if slope is not None:
+            self.slope = slope
+            if np.shape(self.slope) == ():
+                self.slope = np.expand_dims(self.slope, 0)
+        if guessRate is not None:
+            self.guessRate = guessRate
+            if np.shape(self.guessRate) == ():
+                self.guessRate = np.expand_dims(self.guessRate, 0)
+        if lapseRate is not None:
+            self.lapseRate = lapseRate
+            if np.shape(self.lapseRate) == ():
+                self.lapseRate = np.expand_dims(self.lapseRate, 0)
+
+        # Priors
+        self.thresholdPrior = thresholdPrior
+        self.slopePrior = slopePrior
+        self.guessPrior = guessPrior
+        self.lapsePrior = lapsePrior
+
+        self.priorMu = self.__genprior(self.threshold, *thresholdPrior)
+        self.priorSigma = self.__genprior(self.slope, *slopePrior)
+        self.priorGamma = self.__genprior(self.guessRate, *guessPrior)
+        self.priorLambda = self.__genprior(self.lapseRate, *lapsePrior)
+
+        # if guess rate equals lapse rate, and they have equal priors,
+        # then gamma can be left out, as the distributions will be the same
+        self.gammaEQlambda = all((all(self.guessRate == self.lapseRate), all(self.priorGamma == self.priorLambda)))
+        # likelihood: table of conditional probabilities p(response | alpha,sigma,gamma,lambda,x)
+        # prior: prior probability over all parameters p_0(alpha,sigma,gamma,lambda)
+        # The likelihood is computed one threshold at a time: the cartesian product of the whole grid
+        # took most of the time (and memory) of the construction, and a job of the compute worker
+        # can give way to a more urgent one between two thresholds (checkpoint)
+        if self.gammaEQlambda:
+            self.dimensions = (len(self.threshold), len(self.slope), len(self.lapseRate), len(self.stimRange))
+            self.likelihood = np.empty(self.dimensions)
+            for i in range(len(self.threshold)):
+                self.likelihood[i] = np.reshape(
+                    pf(cartesian((self.threshold[i:i+1], self.slope, self.lapseRate, self.stimRange)), psyfun=Pfunction), self.dimensions[1:])
+                checkpoint()
+            # row-wise products of prior probabilities
+            self.prior = np.reshape(
+                np.prod(cartesian((self.priorMu, self.priorSigma, self.priorLambda)), axis=1), self.dimensions[:-1])
+        else:
+            self.dimensions = (len(self.threshold), len(self.slope), len(self.guessRate), len(self.lapseRate), len(self.stimRange))
+            self.likelihood = np.empty(self.dimensions)
+            for i in range(len(self.threshold)):
+                self.likelihood[i] = np.reshape(
+                    pf(cartesian((self.threshold[i:i+1], self.slope, self.guessRate, self.lapseRate, self.stimRange)), psyfun=Pfunction), self.dimensions[1:])
+                checkpoint()
+            # row-wise products of prior probabilities
+            self.prior = np.reshape(
+                np.prod(cartesian((self.priorMu, self.priorSigma, self.priorGamma, self.priorLambda)), axis=1), self.dimensions[:-1])
+
+        # normalize prior
+        self.prior = self.prior / np.sum(self.prior)
+
+        # Set probability density function to prior
+        self.pdf = np.copy(self.prior)
+
+        # settings
+        self.iTrial = 0
+        self.nTrials = nTrials
+        self.stop = 0
+        self.response = []
+        self.stim = []
+
+        # Generate the first stimulus intensity
+        self.minEntropyStim()
+
+    def __genprior(self, x, distr='uniform', mu=0, sig=1):
+        """Generate prior probability distribution for variable.
+
+        Arguments
+        ---------
+            x   :  1D numpy array (float64)
+                    points to evaluate the density at.
+
+            distr :  string
+                    Distribution to use a prior :
+                        'uniform'   (default) discrete uniform distribution
+
+                        'normal'   normal distribution
+
+                        'gamma'    gamma distribution
+
+                        'beta'     beta distribution
+
+            mu :  scalar float
+                first parameter of distr distribution (check scipy for parameterization)
+
+            sig : scalar float
+                second parameter of distr distribution
+
+        Returns
+        -------
+        1D numpy array of prior probabilities (unnormalized)
+        """
+        if distr == 'uniform':
+            nx = len(x)
+            p = np.ones(nx) / nx
+        elif distr == 'normal':
+            p = np.exp(-(x-mu)**2 / (2.0*(sig)**2)) / np.sqrt(2.0*np.pi*(sig)**2)
+        elif distr == 'beta':
+            OnePx = (sig - 1.0) * np.log1p(-x) + (mu - 1.0) * np.log(x)
+            beta = math.gamma(mu) * math.gamma(sig) / math.gamma(mu + sig)
+            OnePx -= np.log(np.abs(beta))
+            p = np.exp(OnePx)
+        elif distr == 'gamma':
+            # Not scipy's gamma(mu, scale=sig): the prior the apps have always used (V1: ('gamma', 2, 20))
+            p = x ** (mu - 1) * (np.exp(-x)) / math.gamma(sig)
+        else:
+            nx = len(x)
+            p = np.ones(nx) / nx
+        return p
+
+    def meta_data(self):
+        import time
+        import sys
+        metadata = {}
+        date = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()))
+        metadata['date'] = date
+        metadata['Version'] = self.version
+        metadata['Python Version'] = sys.version
+        metadata['Numpy Version'] = np.__version__
+        try:
+            import scipy
+            metadata['Scipy Version '] = scipy.__version__
+        except ImportError:
+            metadata['Scipy Version '] = None
+        metadata['psyFunction'] = self.psyfun
+        metadata['thresholdGrid'] = self.threshold.tolist()
+        metadata['thresholdPrior'] = self.thresholdPrior
+        metadata['slopeGrid'] = self.slope.tolist()
+        metadata['slopePrior'] = self.slopePrior
+        metadata['gammaGrid'] = self.guessRate.tolist()
+        metadata['gammaPrior'] = self.guessPrior
+        metadata['lapseGrid'] = self.lapseRate.tolist()
+        metadata['lapsePrior'] = self.lapsePrior
+        return metadata
+
+    def __entropy(self, pdf):
+        """Calculate shannon entropy of posterior distribution.
+        Arguments
+        ---------
+            pdf :   ndarray (float64)
+                    posterior distribution of psychometric curve parameters for each stimuli
+
+
+        Returns
+        -------
+        1D numpy array (float64) : Shannon entropy of posterior for each stimuli
+        """
+        # Marginalize out all nuisance parameters, i.e. all except alpha and sigma
+        postDims = np.ndim(pdf)
+        if self.marginalize == True:
+            while postDims > 3:  # marginalize out second-to-last dimension, last dim is x
+                pdf = np.sum(pdf, axis=-2)
+                postDims -= 1
+        # find expected entropy, suppress divide-by-zero and invalid value warnings
+        # as this is handled by the NaN redefinition to 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy = np.multiply(pdf, np.log(pdf))
+        entropy[np.isnan(entropy)] = 0  # define 0*log(0) to equal 0
+        dimSum = tuple(range(postDims - 1))  # dimensions to sum over. also a Chinese dish
+        entropy = -(np.sum(entropy, axis=dimSum))
+        return entropy
+
+    def minEntropyStim(self):
+        """Find the stimulus intensity based on the expected information gain.
+
+        Minimum Shannon entropy is used as selection criterion for the stimulus intensity in the upcoming trial.
+        """
+        self.pdf = self.pdf
+        self.nX = len(self.stimRange)
+        self.nDims = np.ndim(self.pdf)
+
+        # make pdf the same dims as conditional prob table likelihood
+        self.pdfND = np.expand_dims(self.pdf, axis=self.nDims)  # append new axis
+        self.pdfND = np.tile(self.pdfND, (self.nX))  # tile along new axis
+
+        # Probabilities of response r (succes, failure) after presenting a stimulus
+        # with stimulus intensity x at the next trial, multiplied with the prior (pdfND)
+        self.pTplus1success = np.multiply(self.likelihood, self.pdfND)
+        self.pTplus1failure = self.pdfND - self.pTplus1success
+
+        # Probability of success or failure given stimulus intensity x, p(r|x)
+        self.sumAxes = tuple(range(self.nDims))  # sum over all axes except the stimulus intensity axis
+        self.pSuccessGivenx = np.sum(self.pTplus1success, axis=self.sumAxes)
+        self.pFailureGivenx = np.sum(self.pTplus1failure, axis=self.sumAxes)
+
+        # Posterior probability of parameter values given stimulus intensity x and response r
+        # p(alpha, sigma | x, r)
+        self.posteriorTplus1success = self.pTplus1success / self.pSuccessGivenx
+        self.posteriorTplus1failure = self.pTplus1failure / self.pFailureGivenx
+
+        # Expected entropy for the next trial at intensity x, producing response r
+        self.entropySuccess = self.__entropy(self.posteriorTplus1success)
+        self.entropyFailure = self.__entropy(self.posteriorTplus1failure)
+        self.expectEntropy = np.multiply(self.entropySuccess, self.pSuccessGivenx) + np.multiply(self.entropyFailure,
+                                                                                                 self.pFailureGivenx)
+        self.minEntropyInd = np.argmin(self.expectEntropy)  # index of smallest expected entropy
+        self.xCurrent = self.stimRange[self.minEntropyInd]  # stim intensity at minimum expected entropy
+
+        self.iTrial += 1
+        if self.iTrial == (self.nTrials - 1):
+            self.stop = 1
+
+    def addData(self, response):
+        """
+        Add the most recent response to start calculating the next stimulus intensity
+
+        Arguments
+        ---------
+            response: (int)
+                1: correct/right
+
+                0: incorrect/left
+        """
+        self.stim.append(self.xCurrent)
+        self.response.append(response)
+
+        self.xCurrent = None
+
+        # Keep the posterior probability distribution that corresponds to the recorded response
+        if response == 1:
+            # select the posterior that corresponds to the stimulus intensity of lowest entropy
+            self.pdf = self.posteriorTplus1success[Ellipsis, self.minEntropyInd]
+        elif response == 0:
+            self.pdf = self.posteriorTplus1failure[Ellipsis, self.minEntropyInd]
+
+        # normalize the pdf
+        self.pdf = self.pdf / np.sum(self.pdf)
+
+        # Marginalized probabilities per parameter
+        if self.gammaEQlambda:
+            self.pThreshold = np.sum(self.pdf, axis=(1, 2))
+            self.pSlope = np.sum(self.pdf, axis=(0, 2))
+            self.pLapse = np.sum(self.pdf, axis=(0, 1))
+            self.pGuess = self.pLapse
+        else:
+            self.pThreshold = np.sum(self.pdf, axis=(1, 2, 3))
+            self.pSlope = np.sum(self.pdf, axis=(0, 2, 3))
+            self.pLapse = np.sum(self.pdf, axis=(0, 1, 2))
+            self.pGuess = np.sum(self.pdf, axis=(0, 1, 3))
+
+        # Distribution means as expected values of parameters
+        self.eThreshold = np.sum(np.multiply(self.threshold, self.pThreshold))
+        self.eSlope = np.sum(np.multiply(self.slope, self.pSlope))
+        self.eLapse = np.sum(np.multiply(self.lapseRate, self.pLapse))
+        self.eGuess = np.sum(np.multiply(self.guessRate, self.pGuess))
+
+        # Distribution std of parameters
+        self.stdThreshold = np.sqrt(np.sum(np.multiply((self.threshold - self.eThreshold) ** 2, self.pThreshold)))
+        self.stdSlope = np.sqrt(np.sum(np.multiply((self.slope - self.eSlope) ** 2, self.pSlope)))
+        self.stdLapse = np.sqrt(np.sum(np.multiply((self.lapseRate - self.eLapse) ** 2, self.pLapse)))
+        self.stdGuess = np.sqrt(np.sum(np.multiply((self.guessRate - self.eGuess) ** 2, self.pGuess)))
+
+        # Start calculating the next minimum entropy stimulus
+
+        if self.thread:
+            self.job = shared_worker().submit(self, self.minEntropyStim, priority=CURRENT)
+        else:
+            self.minEntropyStim()
+
+    def wait(self):
+        """Wait until the next stimulus is computed (thread=True); returns xCurrent."""
+        if self.job is not None:
+            self.job.wait()
+        return self.xCurrent
+
+    def plot(self, muRef=None, sigmaRef=None, lapseRef=None, guessRef=None, save=False):
+        """
+        Plot marginal distribution of mu, sigma, lapse and posterior distribution of psychometric curve.
+        Title of the parameter posteriors indicate the mean +- sd of parameters marginal posterior.
+
+        Arguments
+        ---------
+            muRef : scalar float
+                    Reference value of mu used to generate the psychometric curve.
+
+            sigmaRef: scalar float
+                    Reference value of sigma used to generate the psychometric curve.
+
+            lapseRef: scalar float
+                    Reference value of lapse rate used to generate the psychometric curve.
+
+            guessRef: scalar float
+                    Reference value of lapse rate used to generate the psychometric curve.
+
+            psyfun: string
+                    Psychometric function used to generate the data
+
+            save: boolean
+                    Flag whether to save figure
+                    True : save figure
+                    False: don't save figure
+        """
+
+        import matplotlib.pyplot as plt
+
+        if all((muRef, sigmaRef, lapseRef)):
+            ref = True  # reference values exist
+            if guessRef:
+                nx = len(self.stimRange)
+                params = np.array(([np.tile(muRef, nx), np.tile(sigmaRef, nx), np.tile(guessRef, nx),
+                                    np.tile(lapseRef, nx), self.stimRange])).T
+                curve = pf(params, psyfun=self.psyfun)
+            else:  # assume guess rate and lapse are equal
+                nx = len(self.stimRange)
+                params = np.array(
+                    ([np.tile(muRef, nx), np.tile(sigmaRef, nx), np.tile(lapseRef, nx), self.stimRange])).T
+                curve = pf(params, psyfun=self.psyfun)
+        else:
+            ref = False
+
+        if self.gammaEQlambda:
+            postmean = np.sum(self.likelihood * self.pdfND, axis=(0, 1, 2))  # mean
+            poststd = np.sqrt(
+                np.sum(self.likelihood ** 2 * self.pdfND, axis=(0, 1, 2)) - postmean ** 2)  # std
+        else:
+            postmean = np.sum(self.likelihood * self.pdfND, axis=(0, 1, 2, 3))  # mean
+            poststd = np.sqrt(
+                np.sum(self.likelihood ** 2 * self.pdfND, axis=(0, 1, 2, 3)) - postmean ** 2)  # std
+
+        plt.figure(figsize=(8, 7))
+        plt.subplot(2, 2, 1)
+        if ref:
+            plt.plot(self.stimRange, curve, 'k', label='True')
+        plt.plot(self.stimRange, postmean, 'k--', label='Estimated')
+        plt.fill_between(self.stimRange, postmean + poststd, postmean - poststd,
+                         alpha=0.2, facecolor='k')
+        plt.plot(self.stim, self.response, 'ok', label='Response', markersize=5)
+        plt.title('Trial ' + str(self.iTrial - 1))
+        plt.legend(loc='upper left', frameon=False, fontsize=10)
+        plt.xlabel('x')
+        plt.ylabel('p(response)')
+
+        plt.subplot(2, 2, 2)
+        plt.plot(self.threshold, self.pThreshold, 'k')
+        plt.xlabel(r'$\mu$')
+        plt.ylabel('Posterior Probability')
+        plt.title('Posterior ' + r'$\mu$=' + str(np.round(self.eThreshold, 3)) +
+                  r' $\pm$ ' + str(np.round(self.stdThreshold, 3)))
+        plt.axvline(muRef, color='k')
+        plt.axvline(self.eThreshold, color='k', linestyle='dashed')
+
+        plt.subplot(2, 2, 3)
+        plt.plot(self.lapseRate, self.pLapse, 'k')
+        plt.xlabel(r'$\lambda$')
+        plt.ylabel('Posterior Probability')
+        plt.title('Posterior ' + r'$\lambda$=' + str(np.round(self.eLapse, 3)) +
+                  r' $\pm$ ' + str(np.round(self.stdLapse, 3)))
+        plt.axvline(lapseRef, color='k')
+        plt.axvline(self.eLapse, color='k', linestyle='dashed')
+
+        plt.subplot(2, 2, 4)
+        plt.plot(self.slope, self.pSlope, 'k')
+        plt.xlabel(r'$\sigma$')
+        plt.ylabel('Posterior Probability')
+        plt.title('Posterior ' + r'$\sigma$=' + str(np.round(self.eSlope, 3)) +
+                  r' $\pm$ ' + str(np.round(self.stdSlope, 3)))
+        plt.axvline(sigmaRef, color='k')
+        plt.axvline(self.eSlope, color='k', linestyle='dashed')
+        plt.tight_layout()
+        if save:
+            plt.savefig('PsiCurve.png')
+        plt.show()
+
+'''
+The grid of the V2 protocol
+mu = threshold parameter
+sigma = slope parameter
+stimLevels = delta angle
+'''
+mu = np.concatenate((np.arange(0.0, 15.2, 0.2), np.arange(15.25, 67.25, 0.25)))
+mu = np.delete(mu, 25)
+sigma = np.linspace(0.05, 1, 21)
+lapse = np.arange(0, 0.1, 0.01)
+guessRate = 0.5
+
+stimLevels = np.concatenate((np.arange(0.0, 15.2, 0.2), np.arange(15.25, 67.25, 0.25)))
+stimLevels = np.delete(stimLevels, 25)
+
+'''
+[Offline refit]
+Only the stimuli and the responses are saved, not the posteriors of the staircases.
+Replaying the trials one at a time through Psi.addData also computes the next stimulus
+(minEntropyStim) after every trial, which is by far the most expensive part and is
+of no use offline.
+
+With uniform priors the posterior of a staircase only depends on how many times each
+stimulus was answered correctly and wrongly:
+    log p(params | data) = S @ log(L) + F @ log(1 - L) + const
+    S, F: (staircases x stimuli) counts of correct and wrong responses
+    L: (stimuli x parameters) likelihood table of the grid
+so the posteriors of a whole group of staircases are a single matrix product.
+The groups are computed in a pool of threads that share the (large) tables.
+'''
+class PsiGrid(object):
+    """Log likelihood tables of a Psi parameter grid, shared by all the staircases refitted on it.
+
+    The priors are uniform, as in the apps. The defaults are the grid of the V2 protocol.
+
+    Arguments
+    ---------
+        stimRange : sorted 1D array of the possible stimulus intensities
+
+        Pfunction, threshold, slope, guessRate, lapseRate : as in Psi
+    """
+
+    def __init__(self, stimRange=stimLevels, Pfunction='Gumbel', threshold=mu, slope=sigma, guessRate=guessRate, lapseRate=lapse):
+        self.stimRange = np.atleast_1d(np.asarray(stimRange, dtype=float))
+        self.threshold = np.atleast_1d(np.asarray(threshold, dtype=float))
+        self.slope = np.atleast_1d(np.asarray(slope, dtype=float))
+        self.guessRate = np.atleast_1d(np.asarray(guessRate, dtype=float))
+        self.lapseRate = np.atleast_1d(np.asarray(lapseRate, dtype=float))
+        self.psyfun = Pfunction
+
+        # Same rule as in Psi: with equal grids (and equal uniform priors) gamma is left out
+        self.gammaEQlambda = np.array_equal(self.guessRate, self.lapseRate)
+        if self.gammaEQlambda:
+            axes = (self.slope, self.lapseRate)
+        else:
+            axes = (self.slope, self.guessRate, self.lapseRate)
+        self.dimensions = (len(self.threshold),) + tuple(len(x) for x in axes)
+
+        nX = len(self.stimRange)
+        nParams = int(np.prod(self.dimensions))
+        per = nParams // len(self.threshold)
+        # (stimuli x parameters), filled one threshold at a time to keep the cartesian product small
+        # log(0) is avoided: such a parameter set simply gets a negligible posterior
+        tiny = np.finfo(float).tiny
+        self.logSuccess = np.empty((nX, nParams))
+        self.logFailure = np.empty((nX, nParams))
+        for i, t in enumerate(self.threshold):
+            p = np.reshape(pf(cartesian((np.array([t]),) + axes + (self.stimRange,)), psyfun=Pfunction), (per, nX))
+            self.logSuccess[:, i * per:(i + 1) * per] = np.log(np.maximum(p, tiny)).T
+            self.logFailure[:, i * per:(i + 1) * per] = np.log(np.maximum(1.0 - p, tiny)).T
+
+    def nearest(self, stims):
+        """Indices in stimRange of the intensities nearest to the recorded stimuli (0 where the stimulus is NaN)."""
+        stims = np.asarray(stims, dtype=float)
+        valid = ~np.isnan(stims)
+        idx = np.clip(np.searchsorted(self.stimRange, np.where(valid, stims, self.stimRange[0])), 1, len(self.stimRange) - 1)
+        # nearest of the two neighbours
+        nearer_left = ~valid | (np.abs(stims - self.stimRange[idx - 1]) <= np.abs(self.stimRange[idx] - stims))
+        return np.where(nearer_left, idx - 1, idx)
+
+    def on_grid(self, stims):
+        """True where a recorded stimulus is one of the intensities of stimRange (False where it is NaN)."""
+        stims = np.asarray(stims, dtype=float)
+        return np.abs(self.stimRange[self.nearest(stims)] - stims) <= 1e-6
+
+    def stim_index(self, stims):
+        """Indices in stimRange of the recorded stimuli, -1 where the stimulus is NaN.
+
+        Raises ValueError if a stimulus is not on the grid.
+        """
+        stims = np.asarray(stims, dtype=float)
+        valid = ~np.isnan(stims)
+        if np.any(valid & ~self.on_grid(stims)):
+            raise ValueError('Some stimuli are not on the grid of stimulus intensities')
+        return np.where(valid, self.nearest(stims), -1)
+
+    def posteriors(self, success, failure):
+        """Posterior statistics of a group of staircases.
+
+        Arguments
+        ---------
+            success, failure : (staircases x stimuli) counts of correct and wrong responses
+
+        Returns
+        -------
+        dict of arrays with one row per staircase, named as the attributes of Psi:
+            pThreshold, pSlope, pLapse, pGuess : marginal posteriors
+
+            eThreshold, eSlope, eLapse, eGuess : posterior means
+
+            stdThreshold, stdSlope, stdLapse, stdGuess : posterior standard deviations
+        """
+        logpdf = np.dot(success, self.logSuccess) + np.dot(failure, self.logFailure)
+        logpdf -= np.max(logpdf, axis=1, keepdims=True)
+        pdf = np.exp(logpdf)
+        pdf /= np.sum(pdf, axis=1, keepdims=True)
+        pdf = np.reshape(pdf, (len(pdf),) + self.dimensions)
+
+        out = {}
+        if self.gammaEQlambda:
+            out['pThreshold'] = np.sum(pdf, axis=(2, 3))
+            out['pSlope'] = np.sum(pdf, axis=(1, 3))
+            out['pLapse'] = np.sum(pdf, axis=(1, 2))
+            out['pGuess'] = out['pLapse']
+        else:
+            out['pThreshold'] = np.sum(pdf, axis=(2, 3, 4))
+            out['pSlope'] = np.sum(pdf, axis=(1, 3, 4))
+            out['pLapse'] = np.sum(pdf, axis=(1, 2, 3))
+            out['pGuess'] = np.sum(pdf, axis=(1, 2, 4))
+
+        for name, grid in [('Threshold', self.threshold), ('Slope', self.slope), ('Lapse', self.lapseRate), ('Guess', self.guessRate)]:
+            p = out['p' + name]
+            out['e' + name] = np.dot(p, grid)
+            out['std' + name] = np.sqrt(np.sum(p * (grid - out['e' + name][:, None]) ** 2, axis=1))
+        return out
+
+
+def refit_posteriors(stims, responses, grid=None, jobs=1, group_size=64):
+    """Posteriors of many recorded staircases, without replaying them trial by trial.
+
+    Arguments
+    ---------
+        stims : (staircases x trials) array of the recorded stimulus intensities,
+            NaN where a staircase has no trial
+
+        responses : (staircases x trials) array, 1 (correct) or 0 (wrong);
+            any other value (e.g. -1 for a missing trial) is left out
+
+        grid : PsiGrid, the V2 grid by default
+
+        jobs (int) : number of threads computing the groups (None: one per core)
+
+        group_size (int) : number of staircases per matrix product
+
+    Returns
+    -------
+    dict of arrays, one row per staircase (see PsiGrid.posteriors), plus
+        nTrials : number of responses used for every staircase
+    """
+    if grid is None:
+        grid = PsiGrid()
+    stims = np.atleast_2d(np.asarray(stims, dtype=float))
+    responses = np.atleast_2d(np.asarray(responses))
+    n, nX = len(stims), len(grid.stimRange)
+
+    idx = grid.stim_index(stims)
+    used = (idx >= 0) & ((responses == 0) | (responses == 1))
+    rows = np.nonzero(used)[0]
+    flat = rows * nX + idx[used]
+    correct = responses[used] == 1
+    success = np.reshape(np.bincount(flat[correct], minlength=n * nX), (n, nX)).astype(float)
+    failure = np.reshape(np.bincount(flat[~correct], minlength=n * nX), (n, nX)).astype(float)
+
+    groups = [slice(i, i + group_size) for i in range(0, n, group_size)]
+    if jobs is None or jobs > 1:
+        with ThreadPoolExecutor(jobs) as pool:
+            results = list(pool.map(lambda g: grid.posteriors(success[g], failure[g]), groups))
+    else:
+        results = [grid.posteriors(success[g], failure[g]) for g in groups]
+
+    if results:
+        out = {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+    else:
+        out = grid.posteriors(np.zeros((0, nX)), np.zeros((0, nX)))
+    out['nTrials'] = np.sum(used, axis=1)
+    return out
+
+
+def bootstrap_thresholds(stims, responses, grid=None, nBoot=1000, confidence=0.95, seed=0, jobs=1, group_size=64):
+    """Bootstrap confidence intervals of the thresholds of many recorded staircases.
+
+    The trials of every staircase are resampled with replacement nBoot times and every
+    replicate is refitted on the grid (posterior mean of the threshold, as eThreshold).
+    The replicates of a staircase are refitted together, group_size at a time, with the
+    matrix product of PsiGrid.posteriors; the staircases are spread over a pool of threads.
+    Every staircase has its own random stream derived from 'seed', so the result does not
+    depend on the number of jobs.
+
+    Arguments
+    ---------
+        stims, responses, grid, jobs : as in refit_posteriors
+
+        nBoot (int) : number of bootstrap replicates
+
+        confidence (float) : level of the (percentile) confidence intervals
+
+        seed : int or numpy.random.SeedSequence
+
+    Returns
+    -------
+    dict of arrays, one value per staircase
+        eThreshold : threshold fitted on all the trials
+
+        ciLow, ciHigh : confidence interval of the threshold (NaN without trials)
+
+        stdBoot : standard deviation of the bootstrap thresholds
+
+        nTrials : number of responses used
+    """
+    if grid is None:
+        grid = PsiGrid()
+    stims = np.atleast_2d(np.asarray(stims, dtype=float))
+    responses = np.atleast_2d(np.asarray(responses))
+    n, nX = len(stims), len(grid.stimRange)
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    streams = root.spawn(n)
+
+    idx = grid.stim_index(stims)
+    used = (idx >= 0) & ((responses == 0) | (responses == 1))
+    alpha = (1.0 - confidence) / 2
+
+    def resample(row):
+        x = idx[row, used[row]]
+        r = responses[row, used[row]]
+        if len(x) == 0:
+            return np.nan, np.nan, np.nan
+        picks = np.random.default_rng(streams[row]).integers(0, len(x), size=(nBoot, len(x)))
+        thresholds = np.empty(nBoot)
+        for start in range(0, nBoot, group_size):
+            rows = np.arange(min(group_size, nBoot - start))[:, None] * nX
+            flat = (rows + x[picks[start:start + group_size]]).ravel()
+            correct = (r[picks[start:start + group_size]] == 1).ravel()
+            success = np.reshape(np.bincount(flat[correct], minlength=len(rows) * nX), (len(rows), nX))
+            failure = np.reshape(np.bincount(flat[~correct], minlength=len(rows) * nX), (len(rows), nX))
+            thresholds[start:start + len(rows)] = grid.posteriors(success.astype(float), failure.astype(float))['eThreshold']
+        low, high = np.quantile(thresholds, [alpha, 1.0 - alpha])
+        return low, high, np.std(thresholds)
+
+    if jobs is None or jobs > 1:
+        with ThreadPoolExecutor(jobs) as pool:
+            boot = list(pool.map(resample, range(n)))
+    else:
+        boot = [resample(row) for row in range(n)]
+
+    out = refit_posteriors(stims, responses, grid, jobs=jobs, group_size=group_size)
+    boot = np.reshape(np.array(boot, dtype=float), (n, 3))
+    return {'eThreshold': out['eThreshold'], 'ciLow': boot[:, 0], 'ciHigh': boot[:, 1], 'stdBoot': boot[:, 2], 'nTrials': out['nTrials']}
@@ -0,0 +1,110 @@
+'''
+psi_warmup.py
+
+[Objective]
+Build the Psi staircases in the background instead of at the import of main.py
+
+Psi(...) computes the whole likelihood table and the first stimulus when it is made,
+which kept the window from appearing while it ran.
+PsiWarmup runs the function making the staircases as a speculative job of the compute worker
+(psi_worker.py), started when the app starts (and again for every new subject),
+while the calibration and parameter screens are in use.
+A new start() supersedes the previous one: its build is stopped at the next threshold of the likelihood.
+'status' is a kivy property the screens can bind to:
+    - 'idle': nothing started
+    - 'running': the staircases are being made
+    - 'ready': done, when_ready() gives them at once
+    - 'failed': the function raised ('error' says why)
+The test screen only waits (when_ready) if it is reached before the staircases are ready.
+A failed build is never run on the main thread, where it would freeze the window for seconds:
+the apps tell the experimenter, and retry() submits it to the worker again once the message
+is dismissed; the screens waiting in when_ready get the staircases when the retry is done.
+
+[Usage]
+    psi_warmup = PsiWarmup()
+    psi_warmup.start(make_staircases, 25)      # make_staircases(25) runs in the compute worker
+    psi_warmup.when_ready(callback)            # callback(make_staircases(25)), on the main thread
+    psi_warmup.retry()                         # after status == 'failed'
+'''
+
+from functools import partial
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import OptionProperty, StringProperty
+from psi_worker import shared_worker, SPECULATIVE
+
+
+class PsiWarmup(EventDispatcher):
+    '''
+    Staircases made in the compute worker, handed over on the main thread
+    '''
+    status = OptionProperty('idle', options = ['idle', 'running', 'ready', 'failed'])
+    # What the function raised, once the status is 'failed'
+    error = StringProperty('')
+
+    def __init__(self, **kwargs):
+        super(PsiWarmup, self).__init__(**kwargs)
+        # what was started, (make, args), and its job in the worker
+        self.key = None
+        self.job = None
+        self.result = None
+        # True once the result has been handed over to a screen
+        self.used = False
+        self.waiting = list()
+
+    def start(self, make, *args):
+        '''
+        Run make(*args) in the compute worker, unless the same call is already running
+        or ready and not handed over yet
+        '''
+        if (make, args) == self.key and self.status in ['running', 'ready'] and not self.used:
+            return
+        worker = shared_worker()
+        # The build of the previous start is not wanted any more
+        worker.supersede(self)
+        self.key = (make, args)
+        self.result = None
+        self.used = False
+        self.error = ''
+        self.status = 'running'
+        self.job = worker.submit(self, make, *args, priority = SPECULATIVE, callback = self.finished)
+
+    def finished(self, job):
+        # In the worker thread; the properties are only changed on the main thread
+        Clock.schedule_once(partial(self.failed if job.error is not None else self.done, job))
+
+    def done(self, job, dt):
+        if job is not self.job:
+            return
+        self.result = job.result
+        self.status = 'ready'
+        self.call_waiting()
+
+    def failed(self, job, dt):
+        if job is not self.job:
+            return
+        # The worker has printed the traceback; the screens waiting in when_ready keep waiting for retry()
+        self.error = '%s: %s' % (type(job.error).__name__, job.error)
+        self.status = 'failed'
+
+    def retry(self):
+        '''
+        Run the last start() in the compute worker again, after it failed
+        '''
+        if self.status == 'failed':
+            make, args = self.key
+            self.start(make, *args)
+
+    def when_ready(self, callback):
+        '''
+        callback(result) now if the staircases are ready, or as soon as they are
+        '''
+        self.waiting.append(callback)
+        if self.status == 'ready':
+            self.call_waiting()
+
+    def call_waiting(self):
+        waiting, self.waiting = self.waiting, list()
+        self.used = True
+        for callback in waiting:
+            callback(self.result)
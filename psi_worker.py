@@ -0,0 +1,233 @@
+'''
+psi_worker.py
+
+[Objective]
+One long-lived thread computing the Psi staircases, instead of a new thread for every computation
+
+Psi.addData used to start a thread for the next stimulus at every trial, and the clearance of a
+failed start made its new staircase in a thread of its own, so that a computation could still finish
+on a staircase that had been replaced in the meantime. Here every computation is a job of a single
+worker thread, taken from a priority queue:
+    - CURRENT: the next stimulus of the trial on screen (Psi.addData)
+    - SPECULATIVE: work for later, e.g. the staircases of the next subject (psi_warmup.py)
+      or the new staircase after a failed start (pm_protocol.py)
+Jobs of the same priority run in the order they were submitted.
+
+Every job has a tag (the staircase it is for) and the generation of the tag when it was submitted.
+supersede(tag) starts a new generation, after a rollback or a reset: the queued jobs of the tag are
+cancelled, and a running one is stopped at its next checkpoint() (or its result is dropped).
+The worker only knows a tag while it has jobs that are not finished, so that the staircases
+and protocols used as tags are not kept alive by the worker once their test is over.
+Long jobs call checkpoint() between their steps (Psi builds its likelihood one threshold at a time);
+the queued jobs of a higher priority are run there first, so a trial never waits for a speculative build.
+
+[Usage]
+    worker = shared_worker()
+    job = worker.submit(tag, function, arg, priority = CURRENT)
+    job.wait()                       # function(arg), or None if the job was cancelled
+    worker.supersede(tag)            # cancel the jobs of 'tag' submitted so far
+'''
+
+import heapq
+import itertools
+import threading
+import traceback
+
+CURRENT = 0
+SPECULATIVE = 1
+
+# The worker running in this thread, if any (see checkpoint)
+local = threading.local()
+shared = None
+shared_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    '''
+    Raised in a running job by checkpoint() when the job has been superseded
+    '''
+
+
+class PsiJob(object):
+    '''
+    A function call queued in a PsiWorker
+
+    Once it is done: result (None if cancelled or failed), cancelled, error (the exception, if it raised)
+    '''
+    def __init__(self, tag, generation, priority, function, args, callback):
+        self.tag = tag
+        self.generation = generation
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.event = threading.Event()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout = None):
+        '''
+        Block until the job is done (or cancelled); returns its result
+        '''
+        self.event.wait(timeout)
+        return self.result
+
+    def finish(self, result = None, error = None, cancelled = False):
+        self.result, self.error, self.cancelled = result, error, cancelled
+        self.event.set()
+        # Not for a cancelled job: whoever superseded it does not want it any more
+        if self.callback is not None and not cancelled:
+            self.callback(self)
+
+
+class PsiWorker(object):
+    '''
+    A thread running jobs by priority (see [Objective]); the thread starts with the first job
+
+    Arguments
+    ---------
+        name : name of the thread
+    '''
+    def __init__(self, name = 'psi-worker'):
+        self.name = name
+        self.lock = threading.Condition()
+        # heap of (priority, order of submission, job)
+        self.queue = list()
+        self.order = itertools.count()
+        # Only for the tags with jobs not finished yet: generation, and number of such jobs
+        self.generations = dict()
+        self.live = dict()
+        # The job being run, and the ones it gave way to at a checkpoint on top of it
+        self.running = list()
+        self.thread = None
+
+    def submit(self, tag, function, *args, priority = SPECULATIVE, callback = None):
+        '''
+        Queue function(*args) for the staircase 'tag' (any hashable)
+
+        callback(job) is called in the worker thread once the job is done, unless it was cancelled
+        '''
+        with self.lock:
+            job = PsiJob(tag, self.generations.get(tag, 0), priority, function, args, callback)
+            self.live[tag] = self.live.get(tag, 0) + 1
+            heapq.heappush(self.queue, (priority, next(self.order), job))
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.loop, name = self.name, daemon = True)
+                self.thread.start()
+            self.lock.notify()
+        return job
+
+    def supersede(self, tag):
+        '''
+        Cancel the jobs of 'tag' submitted so far
+        '''
+        with self.lock:
+            if tag not in self.live:
+                # No job of the tag to cancel
+                return
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+            stale = [x[2] for x in self.queue if x[2].tag == tag]
+            if stale:
+                self.queue = [x for x in self.queue if x[2].tag != tag]
+                heapq.heapify(self.queue)
+        for job in stale:
+            self.release(job)
+            job.finish(cancelled = True)
+
+    def release(self, job):
+        '''
+        'job' is finished: forget its tag if it was the last job of the tag
+        '''
+        with self.lock:
+            self.live[job.tag] -= 1
+            if self.live[job.tag] == 0:
+                del self.live[job.tag]
+                self.generations.pop(job.tag, None)
+
+    def is_current(self, job):
+        with self.lock:
+            return job.generation == self.generations.get(job.tag, 0)
+
+    def pending(self):
+        '''
+        Number of jobs queued, not counting the running ones
+        '''
+        with self.lock:
+            return len(self.queue)
+
+    def loop(self):
+        local.worker = self
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                priority, order, job = heapq.heappop(self.queue)
+            self.execute(job)
+            # The last job (and its tag) is not kept until the next one
+            job = None
+
+    def execute(self, job):
+        if not self.is_current(job):
+            self.release(job)
+            job.finish(cancelled = True)
+            return
+        self.running.append(job)
+        try:
+            result = job.function(*job.args)
+        except JobCancelled:
+            self.release(job)
+            job.finish(cancelled = True)
+        except Exception as error:
+            traceback.print_exc()
+            self.release(job)
+            job.finish(error = error)
+        else:
+            # Superseded while it was running: the result is for a staircase that is gone
+            with self.lock:
+                current = self.is_current(job)
+                self.release(job)
+            if current:
+                job.finish(result)
+            else:
+                job.finish(cancelled = True)
+        finally:
+            self.running.pop()
+
+    def checkpoint(self):
+        '''
+        Called by the running job: stop it if it has been superseded,
+        otherwise run the queued jobs of a higher priority first
+        '''
+        job = self.running[-1]
+        if not self.is_current(job):
+            raise JobCancelled()
+        while True:
+            with self.lock:
+                if not self.queue or self.queue[0][0] >= job.priority:
+                    return
+                priority, order, urgent = heapq.heappop(self.queue)
+            self.execute(urgent)
+            urgent = None
+
+
+def checkpoint():
+    '''
+    In a job of a PsiWorker, see PsiWorker.checkpoint; nothing anywhere else
+    '''
+    worker = getattr(local, 'worker', None)
+    if worker is not None and worker.running:
+        worker.checkpoint()
+
+def shared_worker():
+    '''
+    The worker of the process, shared by the staircases of the apps
+    '''
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = PsiWorker()
+        return shared
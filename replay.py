@@ -0,0 +1,152 @@
+'''
+replay.py
+
+[Objective]
+Replay saved sessions through the current Psi engine, without kivy,
+to make sure that a change of the engine does not change the experiment
+
+Each subject's recorded trials are fed, in the order of the trial numbers,
+to two fresh staircases ('A' and 'B') built as in V2/main.py
+    - a Psi trial: the stimulus the staircase proposes (xCurrent) must be exactly
+      the recorded 'Psi_stimulus(deg)'; the recorded response is then added (addData)
+    - a catch trial: not given to the staircases; its visual stimulus must be the catch stimulus
+    - a clearance ('NOTE'): the cleared trials are gone from the file and the app restarted
+      the staircase they belonged to, so the remaining trials replay from fresh staircases
+
+Every addData (including the search of the next stimulus) is timed.
+Only the sessions recorded with the grid of the V2 protocol (psi_engine.py) can be replayed.
+
+[Limitation: clearances of the old app]
+The restart of a clearance is exact since the app runs the test with pm_protocol.PMProtocol:
+the failed response is dropped and the next trial of that staircase comes from the new one.
+Before, the app made the new staircase in a thread of its own, racing with the next trials:
+some of them could still come from the old staircase, which had seen the cleared trials.
+Those sessions cannot be told apart from a change of the engine, so a subject with a NOTE
+recorded by the old app (its trials have no TIMED_FIELD) is replayed but not checked:
+its differences are reported as 'unchecked' and do not count in the exit status.
+
+[Usage]
+python3 replay.py FILE [FILE ...] [--subjects SUBJ_1 SUBJ_2 ...] [--verbose]
+    The exit status is 1 if a recorded stimulus was not reproduced (unchecked clearances excepted)
+'''
+
+import sys
+import time
+import argparse
+
+import psi_engine
+from json_processing import load_session
+
+# False reference and direction of the slant line of each staircase, as in TestScreenPM
+FALSE_REF = {'A': 55, 'B': 45}
+DEGREE_DIR = {'A': -1, 'B': 1}
+# Stimulus of the catch trials
+CATCH_DEGREE = 35.0
+# Saved with every trial by the apps that run the test with PMProtocol (see latency_monitor.TrialTimer)
+TIMED_FIELD = 'stimulus_onset(s)'
+
+
+def new_psi(nTrials = 25):
+    '''
+    A staircase exactly as the app creates it, but computing the next stimulus in the calling thread
+    '''
+    return psi_engine.Psi(psi_engine.stimLevels, Pfunction = 'Gumbel', nTrials = nTrials, threshold = psi_engine.mu, thresholdPrior = ('uniform', None), slope = psi_engine.sigma, slopePrior = ('uniform', None), guessRate = psi_engine.guessRate, guessPrior = ('uniform', None), lapseRate = psi_engine.lapse, lapsePrior = ('uniform', None), marginalize = True, thread = False)
+
+def recorded_trials(trial_info):
+    '''
+    (trial number, record) of the trials of a subject, in the order of the trial numbers
+    '''
+    trials = [(int(key[6:]), record) for key, record in trial_info.items() if key[:6] == 'TRIAL_']
+    return sorted(trials, key = lambda x: x[0])
+
+def replay_subject(trial_info, make_psi = new_psi):
+    '''
+    Replay the trials of one subject
+
+    Arguments
+    ---------
+        trial_info : the 'subj_trial_info' of the subject
+
+        make_psi : function returning a new staircase; new_psi by default,
+            any engine with xCurrent and addData can be checked the same way
+
+    Returns
+    -------
+    dict with
+        trials : one dict per trial with trial_num, psi_obj ('A', 'B' or 'catch'),
+                 recorded and replayed stimulus, match (bool) and seconds (time of addData)
+        mismatches : number of trials that were not reproduced
+        note : the NOTE of a clearance, or None
+        checked : False for a clearance of the old app, which cannot be replayed exactly
+            (see [Limitation: clearances of the old app])
+    '''
+    psi = {'A': make_psi(), 'B': make_psi()}
+    rows = list()
+    for num, trial in recorded_trials(trial_info):
+        if 'Psi_obj' not in trial:
+            visual = trial.get('Visual_stimulus(deg)')
+            catch_stims = [FALSE_REF[x] + DEGREE_DIR[x] * CATCH_DEGREE for x in ['A', 'B']]
+            rows.append({'trial_num': num, 'psi_obj': 'catch', 'recorded': visual, 'replayed': None, 'match': visual is None or visual in catch_stims, 'seconds': 0.0})
+            continue
+
+        name = trial['Psi_obj']
+        replayed = float(psi[name].xCurrent)
+        recorded = trial['Psi_stimulus(deg)']
+        match = replayed == recorded
+        # The slant line drawn for the stimulus
+        if 'Visual_stimulus(deg)' in trial:
+            match = match and trial['Visual_stimulus(deg)'] == FALSE_REF[name] + DEGREE_DIR[name] * replayed
+
+        t0 = time.perf_counter()
+        psi[name].addData(trial['response_correct'])
+        seconds = time.perf_counter() - t0
+        rows.append({'trial_num': num, 'psi_obj': name, 'recorded': recorded, 'replayed': replayed, 'match': match, 'seconds': seconds})
+
+    note = trial_info.get('NOTE')
+    checked = note is None or any(TIMED_FIELD in trial for num, trial in recorded_trials(trial_info))
+    return {'trials': rows, 'mismatches': sum(1 for x in rows if not x['match']), 'note': note, 'checked': checked}
+
+def replay_session(path, subjects = None, make_psi = new_psi):
+    '''
+    Replay the Psi-Marginal subjects of a session file (.json or .jsonl.gz)
+
+    subjects: only these subject IDs (all by default)
+
+    Yields (subject ID, result of replay_subject)
+    '''
+    for subj, record in load_session(path):
+        if subjects is not None and subj not in subjects:
+            continue
+        if record['subj_info'].get('Staircase used') != 'Psi-Marginal':
+            continue
+        yield subj, replay_subject(record['subj_trial_info'], make_psi)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay saved sessions through the current Psi engine')
+    parser.add_argument('files', nargs = '+')
+    parser.add_argument('--subjects', nargs = '+', default = None)
+    parser.add_argument('--verbose', action = 'store_true', help = 'print every trial')
+    args = parser.parse_args()
+
+    n_subj, n_bad, n_unchecked = 0, 0, 0
+    for path in args.files:
+        for subj, result in replay_session(path, args.subjects):
+            n_subj += 1
+            psi_rows = [x for x in result['trials'] if x['psi_obj'] != 'catch']
+            times = [x['seconds'] for x in psi_rows] or [0.0]
+            print('%s %s: %d Psi trials, %d catch trials, %d not reproduced, %.3f s/trial (max %.3f s)' % (path, subj, len(psi_rows), len(result['trials']) - len(psi_rows), result['mismatches'], sum(times) / len(times), max(times)))
+            if result['note'] is not None:
+                print('    NOTE: ' + result['note'])
+            if not result['checked']:
+                print('    unchecked: a clearance of the old app, whose restart raced with the next trials (see replay.py)')
+            for row in result['trials']:
+                if args.verbose or not row['match']:
+                    print('    TRIAL_%d %-5s recorded %s replayed %s %s %.3f s' % (row['trial_num'], row['psi_obj'], row['recorded'], row['replayed'], 'ok' if row['match'] else 'DIFFERENT', row['seconds']))
+            if result['mismatches'] and not result['checked']:
+                n_unchecked += 1
+            elif result['mismatches']:
+                n_bad += 1
+
+    print('%d subjects replayed, %d with differences, %d more in unchecked clearances of the old app' % (n_subj, n_bad, n_unchecked))
+    sys.exit(1 if n_bad else 0)
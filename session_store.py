@@ -0,0 +1,363 @@
+'''
+session_store.py
+
+[Objective]
+Crash-consistent storage of the session files written by the app
+
+kivy's JsonStore rewrites the whole json file in place on every put,
+so losing power while the file is being written truncates the day's file
+and every subject that was already saved in it is gone with it.
+
+SafeJsonStore keeps the JsonStore interface (put, get, exists, keys...)
+but every sync goes through a temporary file:
+    1) dump everything to '<filename>.tmp'
+    2) flush and fsync the temporary file
+    3) atomically rename it over '<filename>'
+    4) fsync the folder so that the rename itself is on the disk
+At any moment the session file is therefore either the previous complete
+version or the new complete version, never a half-written one.
+
+Subjects can be batched so that several of them share one fsync.
+Subjects waiting in a batch are only in memory, so call flush() whenever
+the app is paused or stopped (the apps do it in on_pause and on_stop).
+
+A SafeJsonStore can be shared by several threads (the sessions of
+experiment_session.py): puts, deletes and syncs hold the store's lock,
+so a sync never dumps a subject that is half put.
+
+recover_sessions() is meant to run at app start.
+It puts back the leftovers of an interrupted sync, salvages the complete
+subjects of a truncated file and quarantines the files it cannot read.
+With archive=True it also brings the archive of every session file up to date (see below).
+The apps only let it touch the files named as their own session files
+(SESSION_NAME), not any json file of the folder they were started in.
+
+SessionArchive is a compressed copy of the session for copying off the devices.
+It is a gzip-framed json lines file ('.jsonl.gz'):
+    - every subject is one line {"SUBJ_XX": {...}} in compact json
+    - every line is compressed as its own gzip member and appended to the file
+The members together are a valid gzip stream, so the archive can be read
+back line by line with gzip.open (see json_processing.read_archive), and an
+interrupted append can only damage the last subject.
+The json file is the reference, the archive follows it:
+    - a subject put again is appended again, the last line of a subject is its record
+      (SessionArchive.read and json_processing.load_session keep the last one)
+    - the archive is appended after the json file is renamed into place, so a crash
+      in between leaves subjects that are only in the json file: recover_sessions
+      appends the subjects whose last line differs from the json file, and rewrites an
+      archive whose last subject was cut off (the original is quarantined)
+'''
+
+import os
+import re
+import gzip
+import json
+import zlib
+import threading
+from kivy.storage.jsonstore import JsonStore
+
+# Suffixes of the files that are not session files themselves
+TMP_SUFFIX = '.tmp'
+CORRUPT_SUFFIX = '.corrupt'
+# Names of the session files of the apps after their prefix: '<timestamp>.json',
+# the timestamp being "%Y%m%d_%H:%M:%S" (or "%Y%m%d_%H_%M_%S" on Windows), after a '.' on android
+SESSION_NAME = r'\.?\d{8}_\d{2}[:_]\d{2}[:_]\d{2}\.json'
+
+
+def fsync_folder(folder):
+    """Make a rename inside 'folder' durable.
+
+    Opening a folder is not possible on Windows, where it is simply skipped.
+    """
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(filename, text):
+    """Replace the content of 'filename' with 'text' without ever leaving a partial file.
+
+    Arguments
+    ---------
+        filename : path of the file to (re)write
+
+        text : str or bytes, the complete new content
+    """
+    tmp_name = filename + TMP_SUFFIX
+    with open(tmp_name, 'wb' if isinstance(text, bytes) else 'w') as fd:
+        fd.write(text)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_name, filename)
+    fsync_folder(os.path.dirname(os.path.abspath(filename)))
+
+
+class SessionArchive(object):
+    """Append-only compressed archive of the subjects, one gzip member per subject.
+
+    Arguments
+    ---------
+        filename : path of the archive, conventionally ending with '.jsonl.gz'
+
+        compresslevel (int) : gzip compression level
+    """
+
+    def __init__(self, filename, compresslevel=6):
+        self.filename = filename
+        self.compresslevel = compresslevel
+
+    def encode(self, records):
+        """The gzip members of (subject ID, subject record) pairs, one per subject."""
+        return b''.join(gzip.compress((json.dumps({key: value}, separators=(',', ':')) + '\n').encode('utf-8'), self.compresslevel)
+                        for key, value in records)
+
+    def append(self, records):
+        """Append (subject ID, subject record) pairs to the archive with a single fsync."""
+        with open(self.filename, 'ab') as fd:
+            fd.write(self.encode(records))
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def read(self):
+        """Read the subjects of the archive back.
+
+        Returns
+        -------
+        (dict of the subjects, with the last record of a subject appended more than once,
+         False if the archive ends with a damaged subject, which is left out)
+        """
+        subjects = {}
+        if not os.path.exists(self.filename):
+            return subjects, True
+        try:
+            with gzip.open(self.filename, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        subjects.update(json.loads(line))
+        except (OSError, EOFError, ValueError, zlib.error):
+            return subjects, False
+        return subjects, True
+
+
+class SafeJsonStore(JsonStore):
+    """JsonStore with atomic syncs and optional batching of the puts.
+
+    Arguments
+    ---------
+        filename : path of the json file
+
+        batch_size (int) : number of puts that are collected before they are
+            written to the disk together. 1 (default) writes every put right away.
+
+        archive : SessionArchive (optional)
+            Every subject that is written to the json file is appended to it as well.
+    """
+
+    def __init__(self, filename, batch_size=1, archive=None, **kwargs):
+        self.batch_size = max(1, int(batch_size))
+        self.archive = archive
+        # number of puts that are not on the disk yet
+        self.pending = 0
+        # subjects that are not in the archive yet
+        self.unarchived = []
+        self.lock = threading.RLock()
+        super(SafeJsonStore, self).__init__(filename, **kwargs)
+
+    def put(self, key, **values):
+        with self.lock:
+            return super(SafeJsonStore, self).put(key, **values)
+
+    def delete(self, key):
+        with self.lock:
+            return super(SafeJsonStore, self).delete(key)
+
+    def store_put(self, key, value):
+        super(SafeJsonStore, self).store_put(key, value)
+        self.pending += 1
+        if key not in self.unarchived:
+            self.unarchived.append(key)
+        # Only ask for a sync when the batch is full
+        return self.pending >= self.batch_size
+
+    def store_delete(self, key):
+        super(SafeJsonStore, self).store_delete(key)
+        self.pending += 1
+        return self.pending >= self.batch_size
+
+    def store_sync(self):
+        with self.lock:
+            if not self._is_changed:
+                return
+            atomic_write(self.filename, json.dumps(self._data, indent=self.indent, sort_keys=self.sort_keys))
+            if self.archive is not None:
+                self.archive.append([(key, self._data[key]) for key in self.unarchived if key in self._data])
+            self._is_changed = False
+            self.pending = 0
+            self.unarchived = []
+
+    def flush(self):
+        """Write the subjects waiting in the current batch."""
+        with self.lock:
+            if self.pending > 0:
+                self.store_sync()
+
+
+def salvage(text):
+    """Read as many complete subjects as possible from a truncated session file.
+
+    A session file is a single json object whose values are the subjects,
+    so the members are decoded one by one until the text breaks off.
+
+    Returns
+    -------
+    dict of the complete subjects (empty if nothing could be read)
+    """
+    decoder = json.JSONDecoder()
+    salvaged = {}
+    idx = text.find('{')
+    if idx < 0:
+        return salvaged
+    idx += 1
+    n = len(text)
+    while True:
+        while idx < n and text[idx] in ' \t\r\n,':
+            idx += 1
+        if idx >= n or text[idx] == '}':
+            return salvaged
+        try:
+            key, idx = decoder.raw_decode(text, idx)
+            while idx < n and text[idx] in ' \t\r\n':
+                idx += 1
+            if idx >= n or text[idx] != ':':
+                return salvaged
+            idx += 1
+            while idx < n and text[idx] in ' \t\r\n':
+                idx += 1
+            value, idx = decoder.raw_decode(text, idx)
+        except ValueError:
+            return salvaged
+        salvaged[key] = value
+
+
+def quarantine(filename):
+    """Move an unreadable file out of the way without deleting anything."""
+    target = filename + CORRUPT_SUFFIX
+    n = 1
+    while os.path.exists(target):
+        target = ''.join([filename, CORRUPT_SUFFIX, str(n)])
+        n += 1
+    os.replace(filename, target)
+    return target
+
+
+def is_readable(filename):
+    try:
+        with open(filename, 'r') as f:
+            json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def update_archive(filename, subjects):
+    """Append to the archive 'filename' the subjects of a session file it does not have (see [Objective]).
+
+    Returns
+    -------
+    True if the archive was changed
+    """
+    archive = SessionArchive(filename)
+    archived, complete = archive.read()
+    if not complete:
+        # Rewrite what could be read; the damaged original is kept next to it
+        quarantine(filename)
+        atomic_write(filename, archive.encode(archived.items()))
+    missing = [(key, value) for key, value in subjects.items() if archived.get(key) != value]
+    if missing:
+        archive.append(missing)
+    return bool(missing) or not complete
+
+
+def recover_sessions(folder, prefix='', pattern=None, archive=False):
+    """Repair or quarantine the session files left behind by a crash.
+
+    Arguments
+    ---------
+        folder : the folder the session files are saved in
+
+        prefix : only the files whose name starts with 'prefix' are checked
+
+        pattern : regular expression the rest of the name (after 'prefix') must match,
+            e.g. SESSION_NAME; None: any '.json' file
+
+        archive : True if the session files 'X.json' have a SessionArchive 'X.jsonl.gz',
+            which is brought up to date with them (see update_archive)
+
+    Returns
+    -------
+    dict with the lists of file names that were 'restored', 'repaired', 'quarantined' and 'archived'
+    """
+    report = {'restored': [], 'repaired': [], 'quarantined': [], 'archived': []}
+    if not os.path.isdir(folder):
+        return report
+
+    def is_session(name):
+        if not (name.startswith(prefix) and name.endswith('.json')):
+            return False
+        return pattern is None or re.fullmatch(pattern, name[len(prefix):]) is not None
+
+    names = sorted(os.listdir(folder))
+
+    # 1) An interrupted sync: a complete temporary file is newer than the session file
+    for name in names:
+        if not (name.endswith(TMP_SUFFIX) and is_session(name[:-len(TMP_SUFFIX)])):
+            continue
+        tmp_name = os.path.join(folder, name)
+        if is_readable(tmp_name):
+            target = tmp_name[:-len(TMP_SUFFIX)]
+            os.replace(tmp_name, target)
+            report['restored'].append(target)
+        else:
+            # The temporary file was never finished, the session file is still intact
+            quarantine(tmp_name)
+            report['quarantined'].append(tmp_name)
+
+    # 2) Session files that cannot be read
+    for name in sorted(os.listdir(folder)):
+        if not is_session(name):
+            continue
+        filename = os.path.join(folder, name)
+        if is_readable(filename):
+            continue
+        with open(filename, 'r', errors='replace') as f:
+            subjects = salvage(f.read())
+        # The original bytes are always kept next to the repaired file
+        quarantine(filename)
+        report['quarantined'].append(filename)
+        if subjects:
+            atomic_write(filename, json.dumps(subjects))
+            report['repaired'].append(filename)
+
+    # 3) Archives behind their session file (a crash between the rename and the append)
+    if archive:
+        for name in sorted(os.listdir(folder)):
+            if not is_session(name):
+                continue
+            filename = os.path.join(folder, name)
+            with open(filename, 'r') as f:
+                subjects = json.load(f)
+            if not isinstance(subjects, dict):
+                continue
+            archive_name = filename[:-len('json')] + 'jsonl.gz'
+            if update_archive(archive_name, subjects):
+                report['archived'].append(archive_name)
+
+    fsync_folder(folder)
+    return report
@@ -0,0 +1,122 @@
+'''
+test_psi_engine.py
+
+[Objective]
+Numerical equivalence of the NumPy functions of psi_engine with SciPy,
+which the engine used before (erfc in pf, norm/beta/gamma pdfs in Psi.__genprior),
+and of the priors with the formulas of the original app
+
+The comparisons with SciPy are skipped when it is not installed;
+the checks against math.erfc and the original formulas always run.
+
+[Usage]
+python3 -m pytest -q test_psi_engine.py
+'''
+
+import math
+import numpy as np
+import pytest
+
+import psi_engine
+
+genprior = psi_engine.Psi._Psi__genprior
+
+# Down to the smallest normal double (erfc(26.5) ~ 1e-307)
+X_ERFC = np.concatenate([np.linspace(-26.5, 26.5, 20001), [0.0, 1.0, -1.0, 8.0, -8.0, np.inf, -np.inf]])
+
+# The priors of the apps (the slope prior of V1 is ('gamma', 2, 20)) and a few more
+PRIORS = {
+    'normal': [(np.linspace(-3, 3, 31), 0, 1), (np.linspace(-10, 30, 41), 5, 7.5)],
+    'beta': [(np.linspace(0.01, 0.99, 50), 1, 10), (np.linspace(0.01, 0.99, 50), 2.5, 3)],
+    'gamma': [(np.linspace(0.05, 1, 21), 2, 20), (np.linspace(0.2, 3, 15), 2, 0.5), (np.linspace(0.1, 10, 40), 3.5, 3.5)],
+}
+
+
+def rel_error(a, b):
+    a, b = np.asarray(a, dtype = float), np.asarray(b, dtype = float)
+    same = (a == b) | (np.isnan(a) & np.isnan(b))
+    return float(np.max(np.where(same, 0.0, np.abs(a - b) / np.maximum(np.abs(b), 1e-300))))
+
+@pytest.fixture
+def numpy_engine():
+    '''
+    psi_engine with its NumPy functions, whatever PSI_ENGINE_SCIPY says
+    '''
+    psi_engine.use_scipy(False)
+    yield psi_engine
+    psi_engine.use_scipy(False)
+
+@pytest.fixture
+def scipy():
+    return pytest.importorskip('scipy')
+
+def pf_parameters(n = 2001):
+    '''
+    Columns mu, sigma, gamma, lambda, x of pf over a wide range of stimuli
+    '''
+    x = np.linspace(-40, 40, n)
+    return np.column_stack([np.full(n, 5.0), np.full(n, 3.0), np.full(n, 0.5), np.full(n, 0.02), x])
+
+
+def test_erfc_math(numpy_engine):
+    assert rel_error(numpy_engine.erfc(X_ERFC), [math.erfc(v) for v in X_ERFC]) <= 1e-13
+    assert np.isnan(numpy_engine.erfc(np.nan))
+
+def test_uniform_prior():
+    x = np.linspace(-1, 1, 7)
+    assert np.array_equal(genprior(None, x, 'uniform'), np.ones(7) / 7)
+    # An unknown distribution is uniform as well
+    assert np.array_equal(genprior(None, x, 'cauchy', 0, 1), np.ones(7) / 7)
+
+def test_gamma_prior_original_app():
+    # Not SciPy's gamma(mu, scale = sig): the formula the apps have always used
+    for x, mu, sig in PRIORS['gamma']:
+        assert np.array_equal(genprior(None, x, 'gamma', mu, sig), x ** (mu - 1) * (np.exp(-x)) / math.gamma(sig))
+
+
+def test_erfc_scipy(numpy_engine, scipy):
+    from scipy import special
+    assert rel_error(numpy_engine.erfc(X_ERFC), special.erfc(X_ERFC)) <= 1e-13
+    assert numpy_engine.use_scipy()
+    assert np.array_equal(numpy_engine.erfc(X_ERFC), special.erfc(X_ERFC))
+
+@pytest.mark.parametrize('columns', [5, 4, 3])
+def test_pf_scipy(numpy_engine, scipy, columns):
+    from scipy import stats
+    parameters = pf_parameters()
+    mu, sigma, gamma, llambda, x = parameters.T
+    if columns == 4:
+        parameters = parameters[:, [0, 1, 3, 4]]
+        gamma = llambda
+    elif columns == 3:
+        parameters = parameters[:, [0, 1, 4]]
+        gamma, llambda = 0.2, 0.04
+    expected = gamma + (1 - gamma - llambda) * stats.norm.cdf(x, mu, sigma)
+    assert rel_error(numpy_engine.pf(parameters), expected) <= 1e-13
+    numpy_engine.use_scipy()
+    assert rel_error(numpy_engine.pf(parameters), expected) <= 1e-13
+
+def test_pf_gumbel(numpy_engine):
+    parameters = pf_parameters()
+    mu, sigma, gamma, llambda, x = parameters.T
+    expected = gamma + (1 - gamma - llambda) * (1 - np.exp(-10.0 ** (sigma * (x - mu))))
+    assert rel_error(numpy_engine.pf(parameters, 'Gumbel'), expected) <= 1e-15
+
+def test_normal_prior_scipy(scipy):
+    from scipy import stats
+    for x, mu, sig in PRIORS['normal']:
+        assert rel_error(genprior(None, x, 'normal', mu, sig), stats.norm.pdf(x, mu, sig)) <= 1e-13
+
+def test_beta_prior_scipy(scipy):
+    from scipy import stats
+    for x, mu, sig in PRIORS['beta']:
+        assert rel_error(genprior(None, x, 'beta', mu, sig), stats.beta.pdf(x, mu, sig)) <= 1e-12
+
+def test_gamma_prior_scipy(scipy):
+    # The original formula is SciPy's gamma(mu) (scale 1) times gamma(mu) / gamma(sig):
+    # the same prior once normalized, whatever sig is
+    from scipy import stats
+    for x, mu, sig in PRIORS['gamma']:
+        prior = genprior(None, x, 'gamma', mu, sig)
+        assert rel_error(prior, stats.gamma.pdf(x, mu) * math.gamma(mu) / math.gamma(sig)) <= 1e-13
+        assert rel_error(prior / prior.sum(), stats.gamma.pdf(x, mu) / stats.gamma.pdf(x, mu).sum()) <= 1e-13
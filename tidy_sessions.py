@@ -0,0 +1,188 @@
+'''
+tidy_sessions.py
+
+[Objective]
+Normalize all the session files of a directory tree in a single process
+(replaces tidy_json.sh, which started a python interpreter per file and deleted
+the original whether or not the tidy copy had been written)
+
+For every session file ('*.json', outputs of an earlier run excepted)
+    1) the file is parsed and every subject is checked against the trial schema
+       (see validate_session); an invalid file is reported and left alone
+    2) the output is written to a temporary file, synced and renamed into place,
+       and the folder is synced (session_store.atomic_write)
+       - tidy: '<name>_tidy.json', indented like python3 -mjson.tool
+       - compact: '<name>_compact.json', no whitespace
+       - binary: '<name>_binary.jsonl.gz', gzip-framed json lines as written by the app
+         (see session_store.SessionArchive), read back with json_processing.read_archive
+         (not '<name>.jsonl.gz', which is the archive the app keeps itself)
+    3) the output is read back and compared with the input
+    4) only then is the input deleted (unless --keep is given)
+The archive the app keeps next to the input ('<name>.jsonl.gz') is left where it is:
+json_processing reads only one copy of every session (see json_processing.SESSION_COPIES),
+so the output and the archive are not loaded twice.
+Files are processed in parallel (--jobs), the results are reported in the order of the names.
+
+[Usage]
+python3 tidy_sessions.py [ROOT ...] [--format tidy|compact|binary] [--keep] [--check] [--jobs N]
+    ROOT: folders to walk (current folder by default)
+    --check: only validate, nothing is written or deleted
+    The exit status is 1 if a file could not be normalized
+'''
+
+import os
+import sys
+import gzip
+import json
+import argparse
+from functools import partial
+
+# session_store imports kivy, which would otherwise take the options of this tool for its own
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+
+from json_processing import load_session, parse_sessions
+from session_store import atomic_write, fsync_folder
+
+# Name of the output of every format, from the name of the input without '.json'
+OUTPUT_NAMES = {'tidy': '%s_tidy.json', 'compact': '%s_compact.json', 'binary': '%s_binary.jsonl.gz'}
+OUTPUT_SUFFIXES = ('_tidy.json', '_compact.json')
+
+
+def find_sessions(root):
+    '''
+    Paths of the session files under 'root', sorted; hidden folders (e.g. caches) are skipped
+    '''
+    found = list()
+    for folder, subfolders, names in os.walk(root):
+        subfolders[:] = sorted(x for x in subfolders if x[0] != '.' and x != '__pycache__')
+        for name in sorted(names):
+            if name[0] != '.' and name[-5:] == '.json' and not name.endswith(OUTPUT_SUFFIXES):
+                found.append(os.path.join(folder, name))
+    return found
+
+def is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+def validate_session(data):
+    '''
+    Check the subjects of a session file against the trial schema
+
+    Every subject must have 'subj_info', 'subj_anth' and 'subj_trial_info' (dictionaries);
+    the keys of 'subj_trial_info' are 'TRIAL_<n>' or 'NOTE' (the message of a clearance);
+    every trial has 'response' and 'response_correct' (0 or 1);
+    a Psi trial has 'Psi_obj' ('A' or 'B') and a numeric 'Psi_stimulus(deg)'
+
+    Returns the list of the problems found (empty if the file is valid)
+    '''
+    if not isinstance(data, dict):
+        return ['not a dictionary of subjects']
+    problems = list()
+    for subj, record in data.items():
+        if not isinstance(record, dict):
+            problems.append('%s: not a dictionary' % subj)
+            continue
+        for key in ['subj_info', 'subj_anth', 'subj_trial_info']:
+            if not isinstance(record.get(key), dict):
+                problems.append('%s: %s is missing' % (subj, key))
+        for key, trial in (record.get('subj_trial_info') or {}).items():
+            where = '/'.join([subj, key])
+            if key == 'NOTE':
+                if not isinstance(trial, str):
+                    problems.append('%s: not a text' % where)
+                continue
+            if key[:6] != 'TRIAL_' or not key[6:].isdigit():
+                problems.append('%s: unknown key' % where)
+                continue
+            if not isinstance(trial, dict):
+                problems.append('%s: not a dictionary' % where)
+                continue
+            if 'response' not in trial:
+                problems.append('%s: response is missing' % where)
+            if trial.get('response_correct') not in [0, 1] or isinstance(trial.get('response_correct'), bool):
+                problems.append('%s: response_correct is not 0 or 1' % where)
+            if 'Psi_obj' in trial:
+                if trial['Psi_obj'] not in ['A', 'B']:
+                    problems.append('%s: Psi_obj is not A or B' % where)
+                if not is_number(trial.get('Psi_stimulus(deg)')):
+                    problems.append('%s: Psi_stimulus(deg) is not a number' % where)
+    return problems
+
+def encode(data, fmt):
+    '''
+    The bytes of the output file of 'data' in the format 'fmt'
+    '''
+    if fmt == 'tidy':
+        return (json.dumps(data, indent = 4) + '\n').encode('utf-8')
+    if fmt == 'compact':
+        return json.dumps(data, separators = (',', ':')).encode('utf-8')
+    # One gzip member per subject, as SessionArchive.append
+    return b''.join(gzip.compress((json.dumps({key: value}, separators = (',', ':')) + '\n').encode('utf-8')) for key, value in data.items())
+
+def normalize_file(path, fmt = 'tidy', keep = False, check = False):
+    '''
+    Validate, convert and verify one session file (see [Objective])
+
+    Returns a dict with
+        status: 'valid' (check only), 'done', 'invalid' or 'failed'
+        output: the output file (None if nothing was written)
+        problems: list of messages
+    '''
+    result = {'status': 'failed', 'output': None, 'problems': []}
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        result['problems'].append('cannot be read: %s' % e)
+        return result
+
+    result['problems'] = validate_session(data)
+    if result['problems']:
+        result['status'] = 'invalid'
+        return result
+    if check:
+        result['status'] = 'valid'
+        return result
+
+    output = OUTPUT_NAMES[fmt] % path[:-len('.json')]
+    try:
+        # The rename of the output is on the disk before the input can be deleted
+        atomic_write(output, encode(data, fmt))
+        result['output'] = output
+        # The input is only deleted once the output gives back exactly the same subjects
+        if dict(load_session(output)) != data:
+            result['problems'].append('the output does not match the input')
+            return result
+        if not keep:
+            os.remove(path)
+            fsync_folder(os.path.dirname(os.path.abspath(path)))
+    except (OSError, ValueError, EOFError) as e:
+        result['problems'].append(str(e))
+        return result
+    result['status'] = 'done'
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Validate and normalize the session files of a directory tree')
+    parser.add_argument('roots', nargs = '*', default = ['.'])
+    parser.add_argument('--format', default = 'tidy', choices = sorted(OUTPUT_NAMES))
+    parser.add_argument('--keep', action = 'store_true', help = 'do not delete the inputs')
+    parser.add_argument('--check', action = 'store_true', help = 'only validate the files')
+    parser.add_argument('--jobs', type = int, default = None, help = 'number of processes (all the cores by default)')
+    args = parser.parse_args()
+
+    paths = [path for root in args.roots for path in find_sessions(root)]
+    work = partial(normalize_file, fmt = args.format, keep = args.keep, check = args.check)
+    counts = dict()
+    for path, result in parse_sessions(paths, args.jobs, parse = work):
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if result['status'] in ['done', 'valid']:
+            print(' '.join([path, '->', result['output'] or 'valid']))
+        else:
+            print(' '.join([path, result['status'] + ':']))
+            for problem in result['problems']:
+                print('    ' + problem)
+
+    print(', '.join('%d %s' % (n, status) for status, n in sorted(counts.items())) or 'no session files')
+    sys.exit(1 if counts.get('invalid') or counts.get('failed') else 0)